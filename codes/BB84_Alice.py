@@ -2,10 +2,16 @@
 # by Manuel Maiuolo (manuelmaiuolo@gmail.com)
 # BB84_Alice.py - version 1.0
 
-from random import randint
+import sys
+from threading import Condition, Thread, Event
 from BB84_client import BB84Client
 from BB84lib import *
+from BB84codec import encode_frame, decode_frame
+from BB84cascade import ParityOracle
+from BB84privacy import toeplitz_seed, toeplitz_hash, verification_hash
+from BB84checkpoint import StreamCheckpoint, checkpoint_path, checkpoint_frames, stream_start_payload, parse_stream_resume
 from CUlib import *
+from BB84script import script_from_arguments
 
 class AliceActions():
     ## Direct actions
@@ -17,137 +23,287 @@ class AliceActions():
     
     # Server
     SEND_QUBITS = "send quantum state to Bob via public quantum channel"
+    STREAM_QUBITS = "stream n new random qubits to Bob in frames (each frame is sifted while the next ones are sent)"
 
-    ## Indirect actions
-    SEND_B = "SEND_B"
-    RECEIVE_B1 = "RECEIVE_B1"
-    SEND_SOME_A = "SEND_SOME_A"
+    ## Indirect actions (opcodes)
+    SEND_B = OP_SEND_B
+    RECEIVE_B1 = OP_RECEIVE_B1
+    SEND_SOME_A = OP_SEND_SOME_A
+    RECEIVE_FRAME_B1 = OP_FRAME_B1
+    STREAM_RESUME = OP_STREAM_RESUME
+    RECONCILE = OP_RECONCILE
+    SEND_PARITIES = OP_PARITY_QUERIES
+    VERIFY = OP_VERIFY
+    AMPLIFY = OP_AMPLIFY
+    SCRIPT_ROUND = OP_SCRIPT_ROUND
     
 
 class Alice(BB84Client):
-    def __init__(self):
+    MAX_STREAM_QUBITS = 10**8
+
+    def __init__(self, session_id = DEFAULT_SESSION, script = None):
         
         self.menu_structure = [
             AliceActions.GENERATE_BITS,
             AliceActions.PREPARE_QUBITS,
             AliceActions.SEND_QUBITS,
+            AliceActions.STREAM_QUBITS,
             AliceActions.CLEAR,
             AliceActions.CHANGE_INFO_SHOW_METHOD
             ]
         
         menu_functions = (len(self.menu_structure), self.menu_choice, self.show_menu)
-        super().__init__("Alice", self.handle_response, menu_functions)
+        response_handlers = {
+            AliceActions.SEND_B: self.__send_b,
+            AliceActions.RECEIVE_B1: self.__receive_b1,
+            AliceActions.SEND_SOME_A: self.__send_some_a,
+            AliceActions.RECEIVE_FRAME_B1: self.__receive_frame_b1,
+            AliceActions.STREAM_RESUME: self.__on_stream_resume,
+            AliceActions.RECONCILE: self.__on_reconcile,
+            AliceActions.SEND_PARITIES: self.__send_parities,
+            AliceActions.VERIFY: self.__verify,
+            AliceActions.AMPLIFY: self.__amplify,
+            AliceActions.SCRIPT_ROUND: self.__on_script_round
+            }
+        super().__init__("Alice", response_handlers, menu_functions, session_id, script)
         
         self.a = ""
         self.b = ""
-        self.basis = []
-        self.qubits = []
+        self.basis = BasisBatch()
+        self.qubits = QubitBatch()
 
         self.info_show_method_compact = False
         
         self.up_to_date = True
         self.is_bob_up_to_date = True
 
+        # streaming mode: frames sent but not sifted yet (index -> (a, b)) and sifted frames (index -> (a, b))
+        self.stream_window = {}
+        self.stream_sifted = {}
+        self.stream_condition = Condition()
+        # checkpoints of the sifted frames (BB84_CHECKPOINT, None: no checkpoints) and first frame agreed with Bob
+        self.stream_checkpoint = None
+        self.stream_resumed = Event()
+        self.stream_first_frame = 0
 
-    def handle_response(self, response):
+        # error reconciliation: answers Bob's parity queries on the string a
+        self.parity_oracle = None
+        # final key, after privacy amplification
+        self.secret_key = ""
 
-        if response.find(AliceActions.SEND_B) == 0:
-            self.send_message(AliceActions.SEND_B)
-            if self.is_bob_up_to_date:  # Bob is up to date with Alice
-                if self.b == '':
-                    self.send_message('.')
-                else:
-                    self.send_message(self.b)
-            else:  # Bob is not up to date with Alice
-                self.send_message(',')
 
-        elif response.find(AliceActions.RECEIVE_B1) == 0:
-            self.__receive_b1(response[len(AliceActions.RECEIVE_B1):])
+    def __send_b(self, request):
+        if self.is_bob_up_to_date:  # Bob is up to date with Alice
+            self.send_message(AliceActions.SEND_B, self.codec.encode_bits(self.b))
+        else:  # Bob is not up to date with Alice
+            self.send_message(AliceActions.SEND_B, self.codec.encode_bits(None))
 
-        elif response.find(AliceActions.SEND_SOME_A) == 0:
-            self.__send_some_a(response[len(AliceActions.SEND_SOME_A):])
-            
-        # else: another message from server -> not important if not considered
-
-
-    def __generate_bits(self):
-        print("Enter the number 'n' of bits for each string", end="\n > ")
-        # 0 is valid <-> reset a and b
-        n = input_int(0, 50, "Error: enter an integer between 0 and 50\n > ")
-        self.a, self.b = "", ""
-        # start (pseudo-)random bit generation:
-        for _ in range(n):
-            self.a += str(randint(0, 1))
-            self.b += str(randint(0, 1))
+
+    def __generate_bits(self, n = None):
+        if n is None:
+            print("Enter the number 'n' of bits for each string", end="\n > ")
+            # 0 is valid <-> reset a and b
+            n = input_int(0, 50, "Error: enter an integer between 0 and 50\n > ")
+        # (pseudo-)random bit generation, all bits at once
+        self.a = bits_to_string(random_bits(n))
+        self.b = bits_to_string(random_bits(n))
         # done
         self.up_to_date = False
         self.is_bob_up_to_date = False
 
 
     def __prepare_qubits(self):
-        self.basis = []
-        self.qubits = []
-        n = len(self.a)  # due to construction: == len(self.b)
-        for i in range(n):  # bit by bit
-            # basis
-            basis = Basis()
-            basis.set_from_b(self.b[i])
-            self.basis.append(basis)
-            # qubit
-            qubit = Qubit()
-            qubit.set_from_a_and_basis(self.a[i], basis)
-            self.qubits.append(qubit)
+        # all qubits at once: basis from b, polarization from a and basis
+        with self.metrics.phase('prepare'):
+            self.basis = BasisBatch.from_b(self.b)
+            self.qubits = QubitBatch()
+            self.qubits.set_from_a_and_basis(self.a, self.basis)
         # done
         self.up_to_date = True
 
 
-    def __receive_b1(self, b1):
-        new_a = ''  # will be the new string a after the removals, but with spaces
-        new_b = ''  # will be the new string b after the removals
+    def __receive_b1(self, payload):
+        b1, clicks = self.codec.decode_detections(payload)
+        with self.metrics.phase('sift'):
+            new_a, same_basis = sift(self.a, self.b, b1, clicks)
+        self.metrics.throughput('sifted_key_bits', len(new_a))
         
-        for i in range(len(b1)):
-            if b1[i] == self.b[i]:
-                new_a += self.a[i]
-                new_b += self.b[i]
-            else:
-                new_a += ' '
-        
-        print("[Process] discard qubits where Bob measured in different basis than Alice prepared")
+        print("[Process] discard qubits where Bob measured in different basis than Alice prepared (or his detector did not click)")
         print_in_table([
             ["string a", self.a],
             ["string b", self.b],
-            ["Bob's string b'", b1],
-            ["new string a", new_a]
+            ["Bob's string b'", mark_no_clicks(b1, clicks)],
+            ["new string a", blank_string(self.a, same_basis)]
             ])
         print()
 
-        self.a = new_a.replace(' ', '')
-        self.b = new_b
+        self.a = bits_to_string(new_a)
+        self.b = bits_to_string(bits_from_string(self.b)[same_basis])
         # update also basis and qubits
         self.__prepare_qubits()
         
         self.show_information(_end='\n > ')
 
 
-    def __send_some_a(self, req_a):
-        if (len(req_a) != len(self.a)) or (not self.is_bob_up_to_date):  # request not up to date
-            self.send_message(AliceActions.SEND_SOME_A)
-            self.send_message('.')
+    def __stream_qubits(self, n = None):
+        if n is None:
+            print(f"Enter the number 'n' of qubits to stream (frames of {FRAME_QUBITS} qubits)", end="\n > ")
+            n = input_int(1, self.MAX_STREAM_QUBITS, f"Error: enter an integer between 1 and {self.MAX_STREAM_QUBITS}\n > ")
+        frames_count = (n + FRAME_QUBITS - 1) // FRAME_QUBITS
+        self.stream_window = {}
+        self.stream_sifted = {}
+        # Bob will not be up to date until the whole stream is sifted
+        self.is_bob_up_to_date = False
+        
+        first_frame = self.__start_stream(n, frames_count)
+        if first_frame is None:
+            print("Stream interrupted: Bob did not answer in time!", end="\n\n")
+            return None
+        for index in range(first_frame, frames_count):
+            # only the frames in the window are kept: memory does not grow with n
+            size = min(FRAME_QUBITS, n - index * FRAME_QUBITS)
+            with self.metrics.phase('prepare'):
+                a = random_bits(size)
+                b = random_bits(size)
+                qubits = QubitBatch()
+                qubits.set_from_a_and_basis(a, BasisBatch.from_b(b))
+            with self.stream_condition:
+                if not self.stream_condition.wait_for(lambda: len(self.stream_window) < STREAM_WINDOW, REQUEST_TIMEOUT):
+                    print("Stream interrupted: Bob did not announce his bases in time!", end="\n\n")
+                    return None
+                self.stream_window[index] = (a, b)
+                self.metrics.set('stream_window_frames', len(self.stream_window))
+            self.send_message(OP_QUBIT_FRAME, encode_frame(index, self.codec.encode_qubits(qubits)))
+
+        # wait for the last frames to be sifted
+        with self.stream_condition:
+            if not self.stream_condition.wait_for(lambda: len(self.stream_window) == 0, REQUEST_TIMEOUT):
+                print("Stream interrupted: Bob did not announce his bases in time!", end="\n\n")
+                return None
+        
+        # new strings a and b: the frames in the checkpoint, then the other sifted frames, in order
+        committed_frames = 0
+        a, b = "", ""
+        if self.stream_checkpoint is not None:
+            committed_frames = self.stream_checkpoint.frames
+            a, b = (bits_to_string(bits) for bits in self.stream_checkpoint.sifted())
+            self.stream_checkpoint.remove()
+            self.stream_checkpoint = None
+        self.a = a + "".join(bits_to_string(self.stream_sifted[index][0]) for index in range(committed_frames, frames_count))
+        self.b = b + "".join(bits_to_string(self.stream_sifted[index][1]) for index in range(committed_frames, frames_count))
+        self.stream_sifted = {}
+        self.__prepare_qubits()
+        self.is_bob_up_to_date = True
+        return OP_STREAM_END, str(frames_count), False
+
+
+    def __start_stream(self, n, frames_count):
+        # announce the stream: first frame to send (None if Bob did not answer)
+        # with checkpoints: a stream of n qubits interrupted before goes on from the last checkpoint that Bob has too
+        path = checkpoint_path(self.client_name, self.session_id)
+        if path is None:
+            self.stream_checkpoint = None
+            self.send_message(OP_STREAM_START, stream_start_payload(n))
+            return 0
+        self.stream_checkpoint = StreamCheckpoint(path, checkpoint_frames())
+        stream_id = self.stream_checkpoint.open(n)
+        self.stream_resumed.clear()
+        self.send_message(OP_STREAM_START, stream_start_payload(n, stream_id, self.stream_checkpoint.commit_points()))
+        if not self.stream_resumed.wait(REQUEST_TIMEOUT):
+            return None
+        self.stream_checkpoint.resume(self.stream_first_frame)
+        if self.stream_first_frame > 0:
+            print(f"[Process] Stream resumed from the checkpoint: frame {self.stream_first_frame + 1} of {frames_count}",
+                  f"({self.stream_checkpoint.sifted_bits} bits already sifted)")
+        return self.stream_first_frame
+
+
+    def __on_stream_resume(self, payload):
+        self.stream_first_frame, _ = parse_stream_resume(payload)
+        self.stream_resumed.set()
+
+
+    def __receive_frame_b1(self, payload):
+        # Bob measured a frame: announce b for the same frame, then discard the qubits measured in different basis
+        index, payload = decode_frame(payload)
+        with self.stream_condition:
+            frame = self.stream_window.get(index)
+        if frame is None:  # frame of an interrupted stream
+            return
+        a, b = frame
+        self.send_message(OP_FRAME_B, encode_frame(index, self.codec.encode_bits(b)))
+        with self.metrics.phase('sift'):
+            new_a, same_basis = sift(a, b, *self.codec.decode_detections(payload))
+        self.metrics.throughput('sifted_key_bits', len(new_a))
+        with self.stream_condition:
+            self.stream_sifted[index] = (new_a, b[same_basis])
+            del self.stream_window[index]
+            if self.stream_checkpoint is not None:  # every checkpoint_frames() frames sifted in order: to the disk
+                self.stream_checkpoint.update(self.stream_sifted)
+            self.metrics.set('stream_window_frames', len(self.stream_window))
+            self.stream_condition.notify_all()
+
+
+    def __on_reconcile(self, payload):
+        seed = int(payload.decode('utf-8').split('\n')[0])
+        self.parity_oracle = ParityOracle(self.a, seed)
+        print("[Process] Cascade: Bob is asking the parities of blocks of the string a to correct his string a'", end="\n > ")
+
+
+    def __send_parities(self, payload):
+        if self.parity_oracle is None:
+            return
+        parities = self.parity_oracle.parities(self.codec.decode_parity_queries(payload))
+        self.send_message(OP_PARITIES, self.codec.encode_bits(parities))
+
+
+    def __verify(self, payload):
+        # hash of the reconciled string a with the public seed: the server compares it with the other one
+        self.send_message(AliceActions.VERIFY, self.codec.encode_bits(verification_hash(self.a, int(payload.decode('utf-8')))))
+
+
+    def __amplify(self, payload):
+        # compress the string a with a new random Toeplitz matrix, whose seed is sent to Bob in clear
+        length = int(payload.decode('utf-8'))
+        if not self.is_bob_up_to_date:
+            self.send_message(AliceActions.AMPLIFY, self.codec.encode_bits(None))
+            return
+        seed = toeplitz_seed(len(self.a), length)
+        self.secret_key = bits_to_string(toeplitz_hash(self.a, seed))
+        self.send_message(AliceActions.AMPLIFY, self.codec.encode_bits(seed))
+        print(f"[Process] Privacy amplification: string a compressed to a secret key of {len(self.secret_key)} bits")
+        self.store_key(self.secret_key)
+        self.show_information(_end='\n > ')
+
+
+    def __on_script_round(self, payload):
+        # scripted mode: the server asks the qubits of a new round (sent from another thread: while a stream
+        # is sent, the bases announced by Bob arrive on this one)
+        mode, n = payload.decode('utf-8').split('\n')
+        Thread(target=self.__run_script_round, args=(mode, int(n))).start()
+
+
+    def __run_script_round(self, mode, n):
+        if mode == 'stream':
+            request = self.__stream_qubits(n)
+        else:
+            self.__generate_bits(n)
+            self.__prepare_qubits()
+            request = self.menu_choice(self.menu_structure.index(AliceActions.SEND_QUBITS))
+        if request is not None:
+            request_type, request_info, _ = request
+            self.send_message(request_type, request_info)
+
+
+    def __send_some_a(self, payload):
+        length, positions = self.codec.decode_key_request(payload)
+        if (length != len(self.a)) or (not self.is_bob_up_to_date):  # request not up to date
+            self.send_message(AliceActions.SEND_SOME_A, self.codec.encode_revealed_bits(None, positions))
             return
         
         # create obfuscated string a: only requested bits are shown
-        info_a = ''
-        i = 0
-        for ch in req_a:
-            if ch == '?':
-                info_a += self.a[i]
-            else:  # ch == 'x'
-                info_a += 'x'
-            i += 1
-
-        # send obfuscated string a to server for comparison with bits in string a' from Bob
-        self.send_message(AliceActions.SEND_SOME_A)
-        self.send_message(info_a)
+        # and send it to server for comparison with bits in string a' from Bob
+        self.send_message(AliceActions.SEND_SOME_A, self.codec.encode_revealed_bits(self.a, positions))
     
 
     def menu_choice(self, choice):
@@ -165,9 +321,14 @@ class Alice(BB84Client):
         
         elif choice == self.menu_structure.index(AliceActions.SEND_QUBITS):
             # send qubits
-            info = quantum_list_to_compact_string(self.qubits)
+            request_type = OP_SEND_QUBITS
+            info = self.codec.encode_qubits(self.qubits)
             # Bob will be up to date (even if Eve eavesdrops, because from Eve to Bob is automatic)
             self.is_bob_up_to_date = self.up_to_date
+
+        elif choice == self.menu_structure.index(AliceActions.STREAM_QUBITS):
+            # stream new qubits: at the end, tell the server that all the frames are sifted
+            return self.__stream_qubits()
                 
         elif choice == self.menu_structure.index(AliceActions.CLEAR):
             # clear CLI screen and show menu again
@@ -185,7 +346,7 @@ class Alice(BB84Client):
         else:  # not a valid choice
             return None
         
-        return self.menu_structure[choice], info, wait_to_continue
+        return request_type, info, wait_to_continue
 
 
     def show_information(self, _end="\n"):
@@ -206,6 +367,8 @@ class Alice(BB84Client):
                 ["basis", self.basis],
                 ["encoded qubits", self.qubits]
                 ], min_cols = 2)
+        if self.secret_key:
+            print_in_table([["secret key", self.secret_key]])
         
         if not self.up_to_date:
             print(" Note: basis and qubits are not updated to last generated a and b. Select action",
@@ -229,6 +392,10 @@ class Alice(BB84Client):
 
 if __name__ == "__main__":
 
-    set_title("Alice")
-    alice = Alice()
+    # optional argument: session id (clients with the same session id exchange the key together)
+    # or --script file: scripted mode, session of the script (see BB84script.py)
+    script, arguments = script_from_arguments(sys.argv[1:])
+    session_id = script['session'] if script is not None else (arguments[0] if arguments else DEFAULT_SESSION)
+    set_title("Alice" if session_id == DEFAULT_SESSION else f"Alice [{session_id}]")
+    alice = Alice(session_id, script)
     alice.connect()
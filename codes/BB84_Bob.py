@@ -2,10 +2,17 @@
 # by Manuel Maiuolo (manuelmaiuolo@gmail.com)
 # BB84_Bob.py - version 1.0
 
+import sys
+from math import ceil
+import numpy as np
 from BB84_client import BB84Client
 from BB84lib import *
+from BB84codec import encode_frame, decode_frame
+from BB84cascade import Cascade
+from BB84privacy import toeplitz_hash, verification_hash
+from BB84checkpoint import StreamCheckpoint, checkpoint_path, checkpoint_frames, parse_stream_start, stream_resume_payload
 from CUlib import *
-from time import sleep as WaitSeconds
+from BB84script import script_from_arguments
 
 class BobActions():
     ## Direct actions
@@ -16,15 +23,23 @@ class BobActions():
 
     # Server: None
 
-    ## Indirect actions
-    RECEIVE_QUBITS = "RECEIVE_QUBITS"
-    SEND_B1 = "SEND_B1"
-    RECEIVE_B = "RECEIVE_B"
-    SEND_SOME_A1 = "SEND_SOME_A1"
+    ## Indirect actions (opcodes)
+    RECEIVE_QUBITS = OP_RECEIVE_QUBITS
+    SEND_B1 = OP_SEND_B1
+    RECEIVE_B = OP_RECEIVE_B
+    SEND_SOME_A1 = OP_SEND_SOME_A1
+    STREAM_START = OP_STREAM_START
+    RECEIVE_FRAME = OP_QUBIT_FRAME
+    RECEIVE_FRAME_B = OP_FRAME_B
+    STREAM_END = OP_STREAM_END
+    RECONCILE = OP_RECONCILE
+    RECEIVE_PARITIES = OP_PARITIES
+    VERIFY = OP_VERIFY
+    AMPLIFY = OP_AMPLIFY
     
 
 class Bob(BB84Client):
-    def __init__(self):
+    def __init__(self, session_id = DEFAULT_SESSION, script = None):
         
         self.menu_structure = [
             BobActions.SET_RECEIVING_QUBITS_RATE,
@@ -33,38 +48,182 @@ class Bob(BB84Client):
             ]
 
         menu_functions = (len(self.menu_structure), self.menu_choice, self.show_menu)
-        super().__init__("Bob", self.handle_response, menu_functions)
+        response_handlers = {
+            BobActions.RECEIVE_QUBITS: self.__on_receive_qubits,
+            BobActions.SEND_B1: self.__send_b1,
+            BobActions.RECEIVE_B: self.__receive_b,
+            BobActions.SEND_SOME_A1: self.__send_some_a1,
+            BobActions.STREAM_START: self.__on_stream_start,
+            BobActions.RECEIVE_FRAME: self.__on_receive_frame,
+            BobActions.RECEIVE_FRAME_B: self.__on_receive_frame_b,
+            BobActions.STREAM_END: self.__on_stream_end,
+            BobActions.RECONCILE: self.__on_reconcile,
+            BobActions.RECEIVE_PARITIES: self.__on_receive_parities,
+            BobActions.VERIFY: self.__verify,
+            BobActions.AMPLIFY: self.__amplify
+            }
+        super().__init__("Bob", response_handlers, menu_functions, session_id, script)
         
         self.a1 = ""
         self.b1 = ""
-        self.basis = []
-        self.qubits = []
+        self.basis = BasisBatch()
+        self.qubits = QubitBatch()
+        # 1 where Bob's detector clicked (noisy channel): positions without click are discarded with sifting
+        self.clicks = np.ones(0, dtype=np.uint8)
 
         self.info_show_method_compact = False
-        self.receive_qubits_rate = 'fast'
+        self.receive_qubits_rate = 'fast' if script is None else script['rate']
 
+        # streaming mode: frames measured but not sifted yet (index -> (a', b')) and sifted frames (index -> (a', b'))
+        self.stream_measured = {}
+        self.stream_sifted = {}
+        self.stream_received = 0  # qubits received in the current stream
+        self.stream_progress = None
+        self.stream_checkpoint = None  # checkpoints of the sifted frames (BB84_CHECKPOINT, None: no checkpoints)
 
-    def handle_response(self, response):
-        
-        if response.find(BobActions.RECEIVE_QUBITS) == 0:
-            self.send_message(TXT_WAIT)
-            self.__receive_qubits(response[len(BobActions.RECEIVE_QUBITS):])
-            self.send_message(TXT_CONTINUE)  # allow other clients to continue their scripts
+        # error reconciliation in progress (None if not started)
+        self.cascade = None
+        # final key, after privacy amplification
+        self.secret_key = ""
+
+
+    def __on_receive_qubits(self, payload):
+        self.send_message(OP_WAIT)
+        self.__receive_qubits(*self.codec.decode_detected_qubits(payload))
+        self.send_message(OP_CONTINUE)  # allow other clients to continue their scripts
+
+
+    def __on_stream_start(self, payload):
+        self.send_message(OP_WAIT)
+        n, stream_id, commit_points = parse_stream_start(payload)
+        self.stream_measured = {}
+        self.stream_sifted = {}
+        self.stream_received = 0
+        self.stream_checkpoint = None
+        if stream_id is not None:
+            # Alice has checkpoints: the stream goes on from the last one in common (0 if Bob has none)
+            first_frame, sifted_bits = 0, 0
+            path = checkpoint_path(self.client_name, self.session_id)
+            if path is not None:
+                self.stream_checkpoint = StreamCheckpoint(path, checkpoint_frames())
+                self.stream_checkpoint.open(n, stream_id)
+                first_frame = max(set(commit_points) & set(self.stream_checkpoint.commit_points()) | {0})
+                self.stream_checkpoint.resume(first_frame)
+                sifted_bits = self.stream_checkpoint.sifted_bits
+            self.stream_received = min(n, first_frame * FRAME_QUBITS)
+            self.send_message(OP_STREAM_RESUME, stream_resume_payload(first_frame, sifted_bits))
+        if self.stream_progress is not None:  # previous stream interrupted
+            self.stream_progress.finish(redraw=False)
+        self.stream_progress = ProgressRenderer(n, self.__draw_stream_progress)
+        self.stream_progress.update(self.stream_received)
+
+
+    def __on_receive_frame(self, payload):
+        # measure the frame in random basis and announce b' for it
+        index, payload = decode_frame(payload)
+        received, clicks = self.codec.decode_detected_qubits(payload)
+        with self.metrics.phase('measure'):
+            b1 = random_bits(len(received))
+            a1 = received.measure(BasisBatch.from_b(b1))
+        self.stream_measured[index] = (a1, b1, clicks)
+        self.stream_received += len(received)
+        if self.stream_progress is not None:
+            self.stream_progress.update(self.stream_received)
+        self.metrics.set('stream_measured_frames', len(self.stream_measured))
+        self.send_message(OP_FRAME_B1, encode_frame(index, self.codec.encode_detections(b1, clicks)))
+
+
+    def __on_receive_frame_b(self, payload):
+        # Alice announced b for a measured frame: discard the qubits measured in different basis
+        index, payload = decode_frame(payload)
+        frame = self.stream_measured.pop(index, None)
+        if frame is None:  # frame of an interrupted stream
+            return
+        a1, b1, clicks = frame
+        with self.metrics.phase('sift'):
+            new_a1, same_basis = sift(a1, b1, self.codec.decode_bits(payload), clicks)
+        self.metrics.throughput('sifted_key_bits', len(new_a1))
+        self.metrics.set('stream_measured_frames', len(self.stream_measured))
+        self.stream_sifted[index] = (new_a1, b1[same_basis])
+        if self.stream_checkpoint is not None:  # every checkpoint_frames() frames sifted in order: to the disk
+            self.stream_checkpoint.update(self.stream_sifted)
+
+
+    def __on_stream_end(self, payload):
+        # new strings a' and b': the sifted frames, in order
+        frames_count = int(payload.decode('utf-8'))
+        if self.stream_progress is not None:
+            self.stream_progress.finish()
+            self.stream_progress = None
+            print()
+        # the frames in the checkpoint, then the other sifted frames
+        committed_frames = 0
+        a1, b1 = "", ""
+        if self.stream_checkpoint is not None:
+            committed_frames = self.stream_checkpoint.frames
+            a1, b1 = (bits_to_string(bits) for bits in self.stream_checkpoint.sifted())
+            self.stream_checkpoint.remove()
+            self.stream_checkpoint = None
+        self.a1 = a1 + "".join(bits_to_string(self.stream_sifted[index][0]) for index in range(committed_frames, frames_count))
+        self.b1 = b1 + "".join(bits_to_string(self.stream_sifted[index][1]) for index in range(committed_frames, frames_count))
+        self.stream_measured = {}
+        self.stream_sifted = {}
+        self.clicks = np.ones(len(self.a1), dtype=np.uint8)
+        # measured qubits are in the state given by a' and b'
+        self.basis = BasisBatch.from_b(self.b1)
+        self.qubits = QubitBatch()
+        self.qubits.set_from_a_and_basis(self.a1, self.basis)
+        self.send_message(OP_CONTINUE)  # allow other clients to continue their scripts
+
+
+    def __on_reconcile(self, payload):
+        seed, qber = payload.decode('utf-8').split('\n')
+        self.cascade = Cascade(self.a1, float(qber), int(seed))
+        self.__ask_parities()
+
+
+    def __on_receive_parities(self, payload):
+        if self.cascade is None:
+            return
+        self.cascade.receive_parities(self.codec.decode_bits(payload))
+        self.__ask_parities()
 
-        elif response.find(BobActions.SEND_B1) == 0:
-            self.send_message(BobActions.SEND_B1)
-            if self.b1 == '':
-                self.send_message('.')
-            else:
-                self.send_message(self.b1)
 
-        elif response.find(BobActions.RECEIVE_B) == 0:
-            self.__receive_b(response[len(BobActions.RECEIVE_B):])
+    def __ask_parities(self):
+        # parities of many blocks in each message; when nothing is left to ask, the string a' is corrected
+        queries = self.cascade.next_queries()
+        if queries:
+            self.send_message(OP_PARITY_QUERIES, self.codec.encode_parity_queries(queries))
+            return
+        cascade = self.cascade
+        self.cascade = None
+        self.a1 = bits_to_string(cascade.key)
+        self.qubits = QubitBatch()
+        self.qubits.set_from_a_and_basis(self.a1, self.basis)
+        print(f"[Process] Cascade: {cascade.corrected} bits of the string a' corrected,",
+              f"{cascade.leaked_bits} parities received in {cascade.round_trips} round trips.")
+        self.show_information(_end='\n > ')
+        self.send_message(OP_RECONCILE, str(cascade.corrected))
+
+
+    def __verify(self, payload):
+        # hash of the reconciled string a' with the public seed: the server compares it with the other one
+        self.send_message(BobActions.VERIFY, self.codec.encode_bits(verification_hash(self.a1, int(payload.decode('utf-8')))))
+
 
-        elif response.find(BobActions.SEND_SOME_A1) == 0:
-            self.__send_some_a1(response[len(BobActions.SEND_SOME_A1):])
-            
-        # else: another message from server -> not important if not considered
+    def __amplify(self, payload):
+        # same Toeplitz matrix of Alice (seed received in clear): same secret key if a' == a
+        seed = self.codec.decode_bits(payload)
+        if (seed is not None) and (len(seed) >= len(self.a1)):
+            self.secret_key = bits_to_string(toeplitz_hash(self.a1, seed))
+            print(f"[Process] Privacy amplification: string a' compressed to a secret key of {len(self.secret_key)} bits")
+            self.store_key(self.secret_key)
+            self.show_information(_end='\n > ')
+        self.send_message(BobActions.AMPLIFY)
+
+
+    def __send_b1(self, request):
+        self.send_message(BobActions.SEND_B1, self.codec.encode_detections(self.b1, self.clicks))
 
 
     def __set_receiving_qubits_rate(self):
@@ -82,20 +241,28 @@ class Bob(BB84Client):
             self.receive_qubits_rate = 'instant'
 
 
-    def __print_info_during_simulation(self, wait_for):
-        if wait_for <= 0:
-            return
+    def __draw_reception(self, progress, state):
         clear()
-        print(" Receiving qubits . . .")
-        self.show_information()
-        WaitSeconds(wait_for)
+        print(f" Receiving qubits . . . {progress.summary()}")
+        self.show_information(window=PROGRESS_WINDOW, state=state)
 
 
-    def __receive_qubits(self, qubits_str):   
+    def __draw_reception_summary(self, progress, state):
+        # one line, rewritten in place
+        print(f"\r Receiving qubits . . . {progress.summary()}", end='', flush=True)
+
+
+    def __draw_stream_progress(self, progress, state):
+        # one line, rewritten in place
+        print(f"\r Receiving a stream of qubits . . . {progress.summary()}", end='', flush=True)
+
+
+    def __receive_qubits(self, received, clicks):   
         self.a1 = ""
         self.b1 = ""
-        self.basis = []
-        self.qubits = []
+        self.clicks = clicks
+        self.basis = BasisBatch()
+        self.qubits = QubitBatch()
         
         if self.receive_qubits_rate == 'slow':
             wait_long = 1.2
@@ -105,77 +272,87 @@ class Bob(BB84Client):
             wait_long = 0
         wait_short = 0.5 * wait_long
         
-        for qubit_str in qubits_str:
-            self.__print_info_during_simulation(wait_long)
-            # qubit
-            self.qubits.append(Qubit(qubit_str))
-            self.__print_info_during_simulation(wait_short)
-            # string b'
-            self.b1 += str(randint(0, 1))
-            self.__print_info_during_simulation(wait_short)
-            # basis
-            basis = Basis()
-            basis.set_from_b(self.b1[-1])
-            self.basis.append(basis)
-            self.__print_info_during_simulation(wait_short)
-            # string a'
-            measurement = self.qubits[-1].measure(basis)
-            self.a1 += '0' if (measurement == +1) else '1'
-        clear()
+        # all qubits at once: random basis choice, then measurement
+        with self.metrics.phase('measure'):
+            b1_bits = random_bits(len(received))
+            basis = BasisBatch.from_b(b1_bits)
+            measured = received.copy()
+            a1_bits = measured.measure(basis)
 
+        b1_chars, a1_chars = bits_to_string(b1_bits), bits_to_string(a1_bits)
+        if (wait_long > 0) and (len(received) <= PACED_MAX_QUBITS):
+            # show the reception qubit by qubit: the renderer redraws the last PROGRESS_WINDOW qubits in its own thread,
+            # from a snapshot of new objects for each step (never from the attributes of this thread)
+            progress = ProgressRenderer(len(received), self.__draw_reception)
+            for i in range(len(received)):
+                first = max(0, i + 1 - PROGRESS_WINDOW)
+                wait_seconds(wait_long)
+                # qubit
+                shown_qubits = QubitBatch.concatenate([measured[first:i], received[i:i+1]])
+                progress.update(i, (first, shown_qubits, b1_chars[first:i], basis[first:i], a1_chars[first:i]))
+                wait_seconds(wait_short)
+                # string b'
+                progress.update(i, (first, shown_qubits, b1_chars[first:i+1], basis[first:i], a1_chars[first:i]))
+                wait_seconds(wait_short)
+                # basis
+                progress.update(i, (first, shown_qubits, b1_chars[first:i+1], basis[first:i+1], a1_chars[first:i]))
+                wait_seconds(wait_short)
+                # string a'
+                progress.update(i + 1, (first, shown_qubits, b1_chars[first:i+1], basis[first:i+1], a1_chars[first:i+1]))
+            # last frame: the whole table, measured
+            progress.update(len(received), (0, measured, b1_chars, basis, a1_chars))
+            progress.finish()
+        elif wait_long > 0:
+            # too many qubits to show one by one: only the summary, in PACED_STEPS steps (then the last qubits)
+            progress = ProgressRenderer(len(received), self.__draw_reception_summary)
+            step = ceil(len(received) / PACED_STEPS)
+            for done in range(step, len(received) + step, step):
+                wait_seconds(wait_long)
+                progress.update(min(done, len(received)))
+            progress.finish()
+            print()
+            self.show_information(window=PROGRESS_WINDOW, state=(0, measured, b1_chars, basis, a1_chars))
 
-    def __receive_b(self, b):
-        new_a1 = ''  # will be the new string a' after the removals, but with spaces
-        new_b1 = ''  # will be the new string b' after the removals
-        new_basis = []
-        new_qubits = []
-        
-        for i in range(len(b)):
-            if b[i] == self.b1[i]:
-                new_a1 += self.a1[i]
-                new_b1 += self.b1[i]
-                new_basis.append(self.basis[i])
-                new_qubits.append(self.qubits[i])
-            else:
-                new_a1 += ' '
+        self.qubits = measured
+        self.b1 = b1_chars
+        self.basis = basis
+        self.a1 = a1_chars
+
+
+    def __receive_b(self, payload):
+        b = self.codec.decode_bits(payload)
+        with self.metrics.phase('sift'):
+            new_a1, same_basis = sift(self.a1, self.b1, b, self.clicks)
+        self.metrics.throughput('sifted_key_bits', len(new_a1))
         
-        print("[Process] discard qubits where Bob measured in different basis than Alice prepared")
+        print("[Process] discard qubits where Bob measured in different basis than Alice prepared (or his detector did not click)")
         print_in_table([
             ["string a'", self.a1],
-            ["string b'", self.b1],
+            ["string b'", mark_no_clicks(self.b1, self.clicks)],
             ["Alice's string b", b],
-            ["new string a'", new_a1]
+            ["new string a'", blank_string(self.a1, same_basis)]
             ])
         print()
 
-        self.a1 = new_a1.replace(' ', '')
-        self.b1 = new_b1
+        self.a1 = bits_to_string(new_a1)
+        self.b1 = bits_to_string(bits_from_string(self.b1)[same_basis])
+        self.clicks = self.clicks[same_basis]
         # update also basis and qubits
-        self.basis = new_basis
-        self.qubits = new_qubits
+        self.basis = self.basis[same_basis]
+        self.qubits = self.qubits[same_basis]
         
         self.show_information(_end='\n > ')
 
 
-    def __send_some_a1(self, req_a1):
-        if len(req_a1) != len(self.a1):  # request not up to date
-            self.send_message(BobActions.SEND_SOME_A)
-            self.send_message('.')
+    def __send_some_a1(self, payload):
+        length, positions = self.codec.decode_key_request(payload)
+        if length != len(self.a1):  # request not up to date
+            self.send_message(BobActions.SEND_SOME_A1, self.codec.encode_revealed_bits(None, positions))
             return
         
         # create obfuscated string a': only requested bits are shown
-        info_a1 = ''
-        i = 0
-        for ch in req_a1:
-            if ch == '?':
-                info_a1 += self.a1[i]
-            else:  # ch == 'x'
-                info_a1 += 'x'
-            i += 1
-
-        # send obfuscated string a' to server for comparison with bits in string a from Alice
-        self.send_message(BobActions.SEND_SOME_A1)
-        self.send_message(info_a1)
+        # and send it to server for comparison with bits in string a from Alice
+        self.send_message(BobActions.SEND_SOME_A1, self.codec.encode_revealed_bits(self.a1, positions))
         
 
     def menu_choice(self, choice):
@@ -202,24 +379,35 @@ class Bob(BB84Client):
             return None
 
 
-    def show_information(self, _end="\n"):
+    def show_information(self, _end="\n", window = None, state = None):
+        # window: show only the last qubits (at most window); state: (first, qubits, string b', basis, string a') of a
+        # reception in progress, from the qubit first on, to show instead of the current information
+        first, qubits, b1, basis, a1 = (0, self.qubits, self.b1, self.basis, self.a1) if state is None else state
+        if (window is not None) and (len(qubits) > window):
+            skipped = len(qubits) - window
+            first += skipped
+            qubits, b1, basis, a1 = qubits[skipped:], b1[skipped:], basis[skipped:], a1[skipped:]
         method = 'compact' if self.info_show_method_compact else 'normal'
         print(f"[Bob's current information ({method} method)]")
+        if first > 0:
+            print(f"(qubits {first + 1} to {first + len(qubits)})")
 
         if self.info_show_method_compact:  # compact method
             print_in_table([
-                ["encoded qubits", quantum_list_to_compact_string(self.qubits)],
-                ["string b'", self.b1],
-                ["basis", quantum_list_to_compact_string(self.basis)],
-                ["string a'", self.a1]
+                ["encoded qubits", quantum_list_to_compact_string(qubits)],
+                ["string b'", b1],
+                ["basis", quantum_list_to_compact_string(basis)],
+                ["string a'", a1]
                 ], min_cols = 2)
         else:  # normal method
             print_in_table([
-                ["encoded qubits", self.qubits],
-                ["string b'", list(self.b1)],
-                ["basis", self.basis],
-                ["string a'", list(self.a1)]
+                ["encoded qubits", qubits],
+                ["string b'", list(b1)],
+                ["basis", basis],
+                ["string a'", list(a1)]
                 ], min_cols = 2)
+        if self.secret_key:
+            print_in_table([["secret key", self.secret_key]])
         
         print(end=_end)
 
@@ -234,6 +422,10 @@ class Bob(BB84Client):
 
 if __name__ == "__main__":
     
-    set_title("Bob")
-    bob = Bob()
+    # optional argument: session id (clients with the same session id exchange the key together)
+    # or --script file: scripted mode, session of the script (see BB84script.py)
+    script, arguments = script_from_arguments(sys.argv[1:])
+    session_id = script['session'] if script is not None else (arguments[0] if arguments else DEFAULT_SESSION)
+    set_title("Bob" if session_id == DEFAULT_SESSION else f"Bob [{session_id}]")
+    bob = Bob(session_id, script)
     bob.connect()
@@ -2,64 +2,116 @@
 # by Manuel Maiuolo (manuelmaiuolo@gmail.com)
 # BB84_Eve.py - version 1.0
 
+import sys
+from math import ceil
 from BB84_client import BB84Client
 from BB84lib import *
+from BB84codec import encode_frame, decode_frame
+from BB84attacks import STRATEGIES, InterceptResendAttack, FixedBasisAttack
 from CUlib import *
-from time import sleep as WaitSeconds
+from BB84script import script_from_arguments, strategy_from_script
+from BB84checkpoint import parse_stream_start, parse_stream_resume
 
 class EveActions():
     ## Direct actions
     # Local
     SET_RECEIVING_QUBITS_RATE = "set the rate at which to show eavesdropped qubits from Alice"
+    SET_STRATEGY = "set the eavesdropping strategy"
     CLEAR = "clear the CLI screen"
     CHANGE_INFO_SHOW_METHOD = "change how Eve's current information are shown"
     
     # Server: None
     
-    ## Indirect actions
-    RECEIVE_QUBITS = "RECEIVE_QUBITS"
-    SEND_QUBITS = "SEND_QUBITS"
+    ## Indirect actions (opcodes)
+    RECEIVE_QUBITS = OP_RECEIVE_QUBITS
+    SEND_QUBITS = OP_SEND_QUBITS
+    STREAM_START = OP_STREAM_START
+    QUBIT_FRAME = OP_QUBIT_FRAME
+    STREAM_END = OP_STREAM_END
+    STREAM_RESUME = OP_STREAM_RESUME
     
 
 class Eve(BB84Client):
-    def __init__(self):
+    def __init__(self, session_id = DEFAULT_SESSION, script = None):
         
         self.menu_structure = [
             EveActions.SET_RECEIVING_QUBITS_RATE,
+            EveActions.SET_STRATEGY,
             EveActions.CLEAR,
             EveActions.CHANGE_INFO_SHOW_METHOD
             ]
 
         menu_functions = (len(self.menu_structure), self.menu_choice, self.show_menu)
-        super().__init__("Eve", self.handle_response, menu_functions)
+        response_handlers = {
+            EveActions.RECEIVE_QUBITS: self.__on_receive_qubits,
+            EveActions.STREAM_START: self.__on_stream_start,
+            EveActions.QUBIT_FRAME: self.__on_receive_frame,
+            EveActions.STREAM_END: self.__on_stream_end,
+            EveActions.STREAM_RESUME: self.__on_stream_resume
+            }
+        super().__init__("Eve", response_handlers, menu_functions, session_id, script)
         
         self.a_eve = ""
         self.b_eve = ""
-        self.basis = []
-        self.qubits = []
+        self.basis = BasisBatch()
+        self.qubits = QubitBatch()
 
         self.info_show_method_compact = False
-        self.receive_qubits_rate = 'fast'
+        self.receive_qubits_rate = 'fast' if script is None else script['rate']
+        self.frames_eavesdropped = 0  # streaming mode
+        self.qubits_eavesdropped = 0
+        self.stream_progress = None
+        self.strategy = InterceptResendAttack() if script is None else strategy_from_script(script)
 
 
-    def handle_response(self, response):
-        
-        if response.find(EveActions.RECEIVE_QUBITS) == 0:
-            self.send_message(TXT_WAIT)
-            self.__receive_qubits(response[len(EveActions.RECEIVE_QUBITS):])
-            self.send_message(TXT_CONTINUE)  # allow other clients to continue their scripts
-
-            # wait for server to be ready to receive again
-            WaitSeconds(0.5)
-            # now automatically send qubits to Bob
-            info = ""  # will be qubits
-            for qubit in self.qubits:
-                info += str(qubit.value)
-            self.send_message(EveActions.SEND_QUBITS)
-            self.send_message(info)
-            print("Quantum state sent to Bob.", end="\n\n")
-            
-        # else: another message from server -> not important if not considered
+    def __on_receive_qubits(self, payload):
+        self.send_message(OP_WAIT)
+        self.__receive_qubits(self.codec.decode_qubits(payload))
+        self.send_message(OP_CONTINUE)  # allow other clients to continue their scripts
+
+        # now automatically send qubits to Bob
+        info = self.codec.encode_qubits(self.qubits)
+        self.send_message(EveActions.SEND_QUBITS, info)
+        print("Quantum state sent to Bob.", end="\n\n")
+
+
+    def __on_stream_start(self, payload):
+        self.frames_eavesdropped = 0
+        self.qubits_eavesdropped = 0
+        if self.stream_progress is not None:  # previous stream interrupted
+            self.stream_progress.finish(redraw=False)
+        self.stream_progress = ProgressRenderer(parse_stream_start(payload)[0], self.__draw_stream_progress)
+
+
+    def __on_stream_resume(self, payload):
+        # stream resumed from a checkpoint of Alice and Bob: the frames before it are not sent again
+        first_frame, _ = parse_stream_resume(payload)
+        self.qubits_eavesdropped = first_frame * FRAME_QUBITS
+        if self.stream_progress is not None:
+            self.stream_progress.update(min(self.qubits_eavesdropped, self.stream_progress.total))
+
+
+    def __on_receive_frame(self, payload):
+        # intercept-resend frame by frame: only the last frame is kept
+        index, payload = decode_frame(payload)
+        interception = self.strategy.attack(self.codec.decode_qubits(payload))
+        self.send_message(EveActions.QUBIT_FRAME, encode_frame(index, self.codec.encode_qubits(interception.qubits)))
+        self.qubits = interception.qubits
+        self.basis = BasisBatch.from_b(interception.basis_bits)
+        self.b_eve = blank_string(bits_to_string(interception.basis_bits), interception.intercepted)
+        self.a_eve = blank_string(bits_to_string(interception.guesses), interception.intercepted)
+        self.frames_eavesdropped += 1
+        self.qubits_eavesdropped += len(interception.qubits)
+        if self.stream_progress is not None:
+            self.stream_progress.update(self.qubits_eavesdropped)
+
+
+    def __on_stream_end(self, payload):
+        if self.stream_progress is not None:
+            self.stream_progress.finish()
+            self.stream_progress = None
+            print()
+        print(f"Stream eavesdropped: {self.frames_eavesdropped} frames sent to Bob (the last one is shown).", end="\n\n")
 
 
     def __set_receiving_qubits_rate(self):
@@ -77,20 +129,45 @@ class Eve(BB84Client):
             self.receive_qubits_rate = 'instant'
 
 
-    def __print_info_during_simulation(self, wait_for):
-        if wait_for <= 0:
-            return
+    def __set_strategy(self):
+        # only the strategies that resend qubits: the quantum channel of the server carries one photon per qubit
+        strategies = [strategy for strategy in STRATEGIES.values() if strategy.resends_qubits]
+        print(f"Select the eavesdropping strategy [current strategy: {self.strategy}]")
+        print_menu_options([strategy.name for strategy in strategies])
+        print("----", end="\n > ")
+        strategy = strategies[input_int(1, len(strategies), f"Error: enter a valid choice (an integer number from 1 to {len(strategies)})\n----\n > ") - 1]
+        print("Enter the percentage of qubits to intercept (from 1 to 100)", end="\n > ")
+        fraction = input_int(1, 100, "Error: enter a valid number! (integer between 1 and 100)\n > ") / 100
+        if strategy is FixedBasisAttack:
+            print("Select the basis of the measurements", "1) Z", "2) X", sep='\n')
+            print("----", end="\n > ")
+            self.strategy = FixedBasisAttack(fraction, input_int(1, 2, "Error: enter a valid choice (1 or 2)\n----\n > ") - 1)
+        else:
+            self.strategy = strategy(fraction)
+        print(f"Strategy: {self.strategy}", end="\n > ")
+
+
+    def __draw_reception(self, progress, state):
         clear()
-        print(" Receiving qubits . . .")
-        self.show_information()
-        WaitSeconds(wait_for)
+        print(f" Receiving qubits . . . {progress.summary()}")
+        self.show_information(window=PROGRESS_WINDOW, state=state)
+
+
+    def __draw_reception_summary(self, progress, state):
+        # one line, rewritten in place
+        print(f"\r Receiving qubits . . . {progress.summary()}", end='', flush=True)
+
 
+    def __draw_stream_progress(self, progress, state):
+        # one line, rewritten in place
+        print(f"\r Eavesdropping a stream of qubits . . . {progress.summary()}", end='', flush=True)
 
-    def __receive_qubits(self, qubits_str):        
+
+    def __receive_qubits(self, received):        
         self.a_eve = ""
         self.b_eve = ""
-        self.basis = []
-        self.qubits = []
+        self.basis = BasisBatch()
+        self.qubits = QubitBatch()
         
         if self.receive_qubits_rate == 'slow':
             wait_long = 1.2
@@ -100,25 +177,51 @@ class Eve(BB84Client):
             wait_long = 0
         wait_short = 0.5 * wait_long
         
-        for qubit_str in qubits_str:
-            self.__print_info_during_simulation(wait_long)
-            # qubit
-            self.qubits.append(Qubit(qubit_str))
-            self.__print_info_during_simulation(wait_short)
-            # string b'
-            self.b_eve += str(randint(0, 1))
-            self.__print_info_during_simulation(wait_short)
-            # basis
-            basis = Basis()
-            basis.set_from_b(self.b_eve[-1])
-            self.basis.append(basis)
-            self.__print_info_during_simulation(wait_short)
-            # string a'
-            measurement = self.qubits[-1].measure(basis)
-            self.a_eve += '0' if (measurement == +1) else '1'
+        # all qubits at once: measurement (or guess) of the strategy, then the qubits to resend
+        interception = self.strategy.attack(received)
+        basis = BasisBatch.from_b(interception.basis_bits)
+        measured = interception.qubits
+        # positions not intercepted are shown blank
+        b_eve_chars = blank_string(bits_to_string(interception.basis_bits), interception.intercepted)
+        a_eve_chars = blank_string(bits_to_string(interception.guesses), interception.intercepted)
 
-        clear()
-        self.__print_info_during_simulation(0.5)
+        if (wait_long > 0) and (len(received) <= PACED_MAX_QUBITS):
+            # show the reception qubit by qubit: the renderer redraws the last PROGRESS_WINDOW qubits in its own thread,
+            # from a snapshot of new objects for each step (never from the attributes of this thread)
+            progress = ProgressRenderer(len(received), self.__draw_reception)
+            for i in range(len(received)):
+                first = max(0, i + 1 - PROGRESS_WINDOW)
+                wait_seconds(wait_long)
+                # qubit
+                shown_qubits = QubitBatch.concatenate([measured[first:i], received[i:i+1]])
+                progress.update(i, (first, shown_qubits, b_eve_chars[first:i], basis[first:i], a_eve_chars[first:i]))
+                wait_seconds(wait_short)
+                # string b
+                progress.update(i, (first, shown_qubits, b_eve_chars[first:i+1], basis[first:i], a_eve_chars[first:i]))
+                wait_seconds(wait_short)
+                # basis
+                progress.update(i, (first, shown_qubits, b_eve_chars[first:i+1], basis[first:i+1], a_eve_chars[first:i]))
+                wait_seconds(wait_short)
+                # string a
+                progress.update(i + 1, (first, shown_qubits, b_eve_chars[first:i+1], basis[first:i+1], a_eve_chars[first:i+1]))
+            # last frame: the whole table, measured
+            progress.update(len(received), (0, measured, b_eve_chars, basis, a_eve_chars))
+            progress.finish()
+        elif wait_long > 0:
+            # too many qubits to show one by one: only the summary, in PACED_STEPS steps (then the last qubits)
+            progress = ProgressRenderer(len(received), self.__draw_reception_summary)
+            step = ceil(len(received) / PACED_STEPS)
+            for done in range(step, len(received) + step, step):
+                wait_seconds(wait_long)
+                progress.update(min(done, len(received)))
+            progress.finish()
+            print()
+            self.show_information(window=PROGRESS_WINDOW, state=(0, measured, b_eve_chars, basis, a_eve_chars))
+
+        self.qubits = measured
+        self.b_eve = b_eve_chars
+        self.basis = basis
+        self.a_eve = a_eve_chars
 
 
     def menu_choice(self, choice):
@@ -127,6 +230,11 @@ class Eve(BB84Client):
             # set receiving qubits rate
             self.__set_receiving_qubits_rate()
             return None
+
+        elif choice == self.menu_structure.index(EveActions.SET_STRATEGY):
+            # set eavesdropping strategy
+            self.__set_strategy()
+            return None
                 
         elif choice == self.menu_structure.index(EveActions.CLEAR):
             # clear CLI screen and show menu again
@@ -145,23 +253,32 @@ class Eve(BB84Client):
             return None
 
 
-    def show_information(self, _end="\n"):
+    def show_information(self, _end="\n", window = None, state = None):
+        # window: show only the last qubits (at most window); state: (first, qubits, string b, basis, string a) of a
+        # reception in progress, from the qubit first on, to show instead of the current information
+        first, qubits, b_eve, basis, a_eve = (0, self.qubits, self.b_eve, self.basis, self.a_eve) if state is None else state
+        if (window is not None) and (len(qubits) > window):
+            skipped = len(qubits) - window
+            first += skipped
+            qubits, b_eve, basis, a_eve = qubits[skipped:], b_eve[skipped:], basis[skipped:], a_eve[skipped:]
         method = 'compact' if self.info_show_method_compact else 'normal'
         print(f"[Eve's current information ({method} method)]")
+        if first > 0:
+            print(f"(qubits {first + 1} to {first + len(qubits)})")
 
         if self.info_show_method_compact:  # compact method
             print_in_table([
-                ["encoded qubits eavesdropped", quantum_list_to_compact_string(self.qubits)],
-                ["string b chosen by Eve", self.b_eve],
-                ["basis according to string b", quantum_list_to_compact_string(self.basis)],
-                ["string a according to Eve", self.a_eve]
+                ["encoded qubits eavesdropped", quantum_list_to_compact_string(qubits)],
+                ["string b chosen by Eve", b_eve],
+                ["basis according to string b", quantum_list_to_compact_string(basis)],
+                ["string a according to Eve", a_eve]
                 ], min_cols = 2)
         else:  # normal method
             print_in_table([
-                ["encoded qubits eavesdropped", self.qubits],
-                ["string b chosen by Eve", list(self.b_eve)],
-                ["basis according to string b", self.basis],
-                ["string a according to Eve", list(self.a_eve)]
+                ["encoded qubits eavesdropped", qubits],
+                ["string b chosen by Eve", list(b_eve)],
+                ["basis according to string b", basis],
+                ["string a according to Eve", list(a_eve)]
                 ], min_cols = 2)
         
         print(end=_end)
@@ -170,7 +287,8 @@ class Eve(BB84Client):
     def show_menu(self, prefix = ''):
         print(prefix, end='')
         self.show_information(_end='')
-        print("Eve's presence automatically ensures that the qubits sent by Alice are eavesdropped by Eve,\nand the new qubits for Bob are sent by Eve.\n")
+        print("Eve's presence automatically ensures that the qubits sent by Alice are eavesdropped by Eve,\nand the new qubits for Bob are sent by Eve.")
+        print(f"Eavesdropping strategy: {self.strategy}\n")
         print("[Eve's direct actions]")
         print_menu_options(self.menu_structure)
         print("------\nEnter the number of the action to be performed", end="\n > ")
@@ -178,6 +296,10 @@ class Eve(BB84Client):
 
 if __name__ == "__main__":
     
-    set_title("Eve")
-    eve = Eve()
+    # optional argument: session id (clients with the same session id exchange the key together)
+    # or --script file: scripted mode, session of the script (see BB84script.py)
+    script, arguments = script_from_arguments(sys.argv[1:])
+    session_id = script['session'] if script is not None else (arguments[0] if arguments else DEFAULT_SESSION)
+    set_title("Eve" if session_id == DEFAULT_SESSION else f"Eve [{session_id}]")
+    eve = Eve(session_id, script)
     eve.connect()
@@ -0,0 +1,153 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84_batch.py - version 1.0
+
+# Unattended runs of the real multi-process topology: server, Alice, Bob and (optionally) Eve are started as
+# separate processes talking over local sockets, all in scripted mode with the same script (see BB84script.py),
+# without console and at full speed. When they exit, their results are merged in one JSON document.
+# usage as library:  from BB84_batch import run_batch;  results = run_batch({'n': 10**5, 'stream': True, 'rounds': 3})
+# usage as script:   python BB84_batch.py [script.json] [--n n] [--rounds r] [--stream] [--session id]
+#                    [--eve [--strategy {intercept-resend,fixed-basis,breidbart}] [--intercept p]]
+#                    [--sample-bits k] [--no-reconcile] [--no-amplify] [--timeout seconds]
+#                    [--length-km l] [--attenuation dB] [--depolarization p] [--bit-flip p] [--detector-efficiency e] [--dark-count p]
+#                    [--async] [--rng {pcg64,philox,crypto}] [--seed s] [--key-pool directory] [--logs directory] [--output file]
+#                    [--checkpoint directory [--checkpoint-frames k]]
+# Secret keys go to a temporary key pool (unless --key-pool); the output tells if Alice and Bob got the same keys.
+# With --checkpoint, a run of the same script interrupted before goes on from its checkpoints (see BB84checkpoint.py).
+
+import os
+import sys
+import json
+import socket
+import tempfile
+import subprocess
+from time import perf_counter, sleep
+from CUlib import SERVER_PORT
+from BB84script import complete_script, results_path
+
+CODES_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SERVER_STARTUP = 10  # seconds to wait for the server to accept connections
+
+
+def run_batch(script, asynchronous = False, environment = None, logs = None):
+    # run the script on server and clients (separate processes): merged results (dict)
+    # environment: variables for the processes (e.g. BB84_SEED); logs: directory of their console output
+    directory = tempfile.mkdtemp(prefix='bb84_batch_')
+    script = complete_script(dict(script, results=os.path.join(directory, 'results')))
+    script_path = os.path.join(directory, 'script.json')
+    with open(script_path, 'w') as file:
+        json.dump(script, file)
+    variables = {'BB84_KEY_POOL': os.path.join(directory, 'key_pool')}
+    variables.update(os.environ)
+    variables.update(environment or {})
+    if logs is not None:
+        os.makedirs(logs, exist_ok=True)
+
+    parties = ['server', 'Alice', 'Bob'] + (['Eve'] if script['eve'] else [])
+    scripts = {party: f"BB84_{party}.py" for party in parties}
+    scripts['server'] = 'BB84_server_async.py' if asynchronous else 'BB84_server.py'
+    start = perf_counter()
+    processes = {}
+    for party in parties:
+        output = open(os.path.join(logs, f"{party}.log") if logs is not None else os.devnull, 'w')
+        processes[party] = subprocess.Popen([sys.executable, scripts[party], '--script', script_path], cwd=CODES_DIRECTORY,
+                                            stdin=subprocess.DEVNULL, stdout=output, stderr=subprocess.STDOUT, env=variables)
+        output.close()
+        if party == 'server':
+            wait_server(processes['server'])
+
+    # every process exits at the end of the script (or when the server gives up)
+    deadline = start + script['timeout'] * (script['rounds'] + 2)
+    exit_codes = {}
+    for party, process in processes.items():
+        try:
+            exit_codes[party] = process.wait(max(0, deadline - perf_counter()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+            exit_codes[party] = 'killed'
+
+    results = {'script': script, 'seconds': perf_counter() - start, 'exit_codes': exit_codes}
+    for party in parties:
+        try:
+            with open(results_path(script, party)) as file:
+                results[party] = json.load(file)
+        except FileNotFoundError:
+            results[party] = None
+    alice, bob = results['Alice'], results['Bob']
+    results['keys_match'] = (alice is not None) and (bob is not None) and (alice['secret_key_sha256'] == bob['secret_key_sha256'])
+    results['ok'] = (all(code == 0 for code in exit_codes.values()) and (results['server'] is not None)
+                     and ('error' not in results['server']) and results['keys_match'])
+    return results
+
+
+def wait_server(process):
+    # until the server accepts connections (an empty connection is discarded by the server)
+    deadline = perf_counter() + SERVER_STARTUP
+    while perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"the server exited with code {process.returncode}")
+        try:
+            socket.create_connection(('localhost', SERVER_PORT), timeout=1).close()
+            return
+        except OSError:
+            sleep(0.05)
+    raise RuntimeError(f"the server did not accept connections in {SERVER_STARTUP} seconds")
+
+
+if __name__ == "__main__":
+    import argparse
+    from BB84attacks import STRATEGIES
+    from BB84random import KINDS
+
+    parser = argparse.ArgumentParser(description="Run server and clients in scripted mode and merge their results (JSON)")
+    parser.add_argument("script", nargs='?', default=None, help="script (JSON file, see BB84script.py); the options below override it")
+    parser.add_argument("--n", type=int, default=None, help="qubits sent by Alice in each round")
+    parser.add_argument("--rounds", type=int, default=None, help="key exchanges, one after the other")
+    parser.add_argument("--stream", action="store_true", default=None, help="send the qubits in frames")
+    parser.add_argument("--session", default=None, help="session id of the clients")
+    parser.add_argument("--eve", action="store_true", default=None, help="Eve is connected and attacks the qubits")
+    parser.add_argument("--strategy", choices=[name for name, strategy in STRATEGIES.items() if strategy.resends_qubits], default=None, help="attack of Eve")
+    parser.add_argument("--intercept", type=float, default=None, help="fraction of the qubits attacked by Eve")
+    parser.add_argument("--sample-bits", type=int, default=None, help="bits of the key compared to detect Eve (0: no detection)")
+    parser.add_argument("--no-reconcile", dest="reconcile", action="store_false", default=None, help="do not correct Bob's key with Cascade")
+    parser.add_argument("--no-amplify", dest="amplify", action="store_false", default=None, help="do not compress the keys")
+    parser.add_argument("--timeout", type=float, default=None, help="seconds to wait for the clients and for each round")
+    for name, help_text in [("length-km", "length of the fiber towards Bob"), ("attenuation", "attenuation of the fiber (dB/km)"),
+                            ("depolarization", "probability that a qubit is depolarized"), ("bit-flip", "probability that the value of a qubit is flipped"),
+                            ("detector-efficiency", "probability that Bob's detector clicks for a photon"), ("dark-count", "probability of a dark count for each pulse")]:
+        parser.add_argument(f"--{name}", type=float, default=None, help=help_text)
+    parser.add_argument("--async", dest="asynchronous", action="store_true", help="use BB84_server_async.py")
+    parser.add_argument("--rng", choices=KINDS, default=None, help="random generator of every process (BB84_RNG)")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the run (BB84_SEED)")
+    parser.add_argument("--key-pool", default=None, help="directory of the key pools (default: temporary)")
+    parser.add_argument("--checkpoint", default=None, help="directory of the checkpoints (BB84_CHECKPOINT)")
+    parser.add_argument("--checkpoint-frames", type=int, default=None, help="frames of a stream between two checkpoints (BB84_CHECKPOINT_FRAMES)")
+    parser.add_argument("--logs", default=None, help="directory of the console output of each process")
+    parser.add_argument("--output", default=None, help="save the results in this JSON file (default: print them)")
+    args = parser.parse_args()
+
+    script = {}
+    if args.script is not None:
+        with open(args.script) as file:
+            script = json.load(file)
+    for key in ['n', 'rounds', 'stream', 'session', 'eve', 'strategy', 'intercept', 'sample_bits', 'reconcile', 'amplify', 'timeout']:
+        if getattr(args, key) is not None:
+            script[key] = getattr(args, key)
+    channel = dict(script.get('channel', {}))
+    for key in ['length_km', 'attenuation', 'depolarization', 'bit_flip', 'detector_efficiency', 'dark_count']:
+        if getattr(args, key) is not None:
+            channel[key] = getattr(args, key)
+    script['channel'] = channel
+    environment = {}
+    for variable, value in [('BB84_RNG', args.rng), ('BB84_SEED', args.seed), ('BB84_KEY_POOL', args.key_pool),
+                            ('BB84_CHECKPOINT', args.checkpoint), ('BB84_CHECKPOINT_FRAMES', args.checkpoint_frames)]:
+        if value is not None:
+            environment[variable] = str(value)
+
+    results = run_batch(script, args.asynchronous, environment, args.logs)
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=1)
+    else:
+        print(json.dumps(results, indent=1))
+    sys.exit(0 if results['ok'] else 1)
@@ -0,0 +1,196 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84_benchmark.py - version 1.0
+
+# Micro-benchmarks of the hot paths of BB84lib and CUlib, for n = 10^2 ... 10^7 qubits (or bits)
+# - throughput (qubits/s, best of some repetitions), peak memory (tracemalloc), scaling exponent (time ~ n^k)
+# - results can be saved as a JSON baseline and compared with a later run: slower cases are reported as regressions
+# usage: python BB84_benchmark.py [--max-n 10000000] [--cases sift ...] [--save baseline.json] [--compare baseline.json]
+
+import argparse
+import io
+import json
+import tracemalloc
+from contextlib import redirect_stdout
+from time import perf_counter
+import numpy as np
+from BB84lib import *
+from BB84codec import CODECS
+from CUlib import print_in_table
+
+
+## cases: function(n) -> function without arguments to be measured (preparation is not measured)
+
+def case_qubit_set_from_a_and_basis(n):
+    # one Qubit instance at a time (how clients worked before the batch engine)
+    a = bits_to_string(random_bits(n))
+    basis = list(BasisBatch.from_b(random_bits(n)))
+    def run():
+        for i in range(n):
+            Qubit().set_from_a_and_basis(a[i], basis[i])
+    return run
+
+def case_batch_set_from_a_and_basis(n):
+    a = random_bits(n)
+    basis = BasisBatch.from_b(random_bits(n))
+    return lambda: QubitBatch().set_from_a_and_basis(a, basis)
+
+def case_qubit_measure(n):
+    qubits = list(QubitBatch.from_bits(random_bits(n), random_bits(n)))
+    basis = list(BasisBatch.from_b(random_bits(n)))
+    def run():
+        for i in range(n):
+            qubits[i].measure(basis[i])
+    return run
+
+def case_batch_measure(n):
+    qubits = QubitBatch.from_bits(random_bits(n), random_bits(n))
+    basis = BasisBatch.from_b(random_bits(n))
+    return lambda: qubits.measure(basis)
+
+def case_compact_string_list(n):
+    qubits = list(QubitBatch.from_bits(random_bits(n), random_bits(n)))
+    return lambda: quantum_list_to_compact_string(qubits)
+
+def case_compact_string_batch(n):
+    qubits = QubitBatch.from_bits(random_bits(n), random_bits(n))
+    return lambda: quantum_list_to_compact_string(qubits)
+
+def case_generate_bits(n):
+    # strings a and b of Alice
+    return lambda: (bits_to_string(random_bits(n)), bits_to_string(random_bits(n)))
+
+def case_sift(n):
+    # as in Alice.__receive_b1 / Bob.__receive_b: strings in, sifted array and mask out
+    a, b, b1 = (bits_to_string(random_bits(n)) for _ in range(3))
+    return lambda: sift(a, b, b1)
+
+def case_sample_mask(n):
+    # as in BB84_server.__detect_eavesdropping: 1% of the key, key-request for a text and a binary client
+    count = max(1, n // 100)
+    def run():
+        positions = sample_positions(n, count)
+        CODECS['text'].encode_key_request(n, positions)
+        CODECS['binary'].encode_key_request(n, positions)
+    return run
+
+def case_print_in_table(n):
+    # as in the normal method of show_information: one column per qubit
+    a = bits_to_string(random_bits(n))
+    qubits = QubitBatch.from_bits(random_bits(n), random_bits(n))
+    rows = [["string a", list(a)], ["encoded qubits", qubits]]
+    def run():
+        with redirect_stdout(io.StringIO()):
+            print_in_table(rows, min_cols = 2)
+    return run
+
+
+# name -> (case, largest n: per-qubit Python loops are limited to keep the suite short)
+CASES = {
+    'qubit_set_from_a_and_basis': (case_qubit_set_from_a_and_basis, 10**5),
+    'batch_set_from_a_and_basis': (case_batch_set_from_a_and_basis, 10**7),
+    'qubit_measure': (case_qubit_measure, 10**5),
+    'batch_measure': (case_batch_measure, 10**7),
+    'compact_string_list': (case_compact_string_list, 10**5),
+    'compact_string_batch': (case_compact_string_batch, 10**7),
+    'generate_bits': (case_generate_bits, 10**7),
+    'sift': (case_sift, 10**7),
+    'sample_mask': (case_sample_mask, 10**7),
+    'print_in_table': (case_print_in_table, 10**5)
+    }
+
+
+def measure_case(case, n, repeat):
+    # (best time in seconds, peak memory in bytes) of one case at one size
+    run = case(n)
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        run()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    run = case(n)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def scaling_exponent(sizes, seconds):
+    # slope of log(time) vs log(n): 1 <-> linear; only sizes with measurable times are used
+    points = [(n, t) for n, t in zip(sizes, seconds) if t > 1e-4]
+    if len(points) < 2:
+        return None
+    return float(np.polyfit(np.log([n for n, _ in points]), np.log([t for _, t in points]), 1)[0])
+
+
+def run_benchmarks(names = None, max_n = 10**7, repeat = 3):
+    # results: case name -> {'sizes', 'seconds', 'throughput', 'peak_memory', 'exponent'}
+    results = {}
+    for name in (names or CASES):
+        case, case_max_n = CASES[name]
+        sizes = [10**k for k in range(2, 8) if 10**k <= min(max_n, case_max_n)]
+        seconds = []
+        peaks = []
+        for n in sizes:
+            elapsed, peak = measure_case(case, n, repeat)
+            seconds.append(elapsed)
+            peaks.append(peak)
+        results[name] = {
+            'sizes': sizes,
+            'seconds': seconds,
+            'throughput': [n / t if t > 0 else None for n, t in zip(sizes, seconds)],
+            'peak_memory': peaks,
+            'exponent': scaling_exponent(sizes, seconds)
+            }
+    return results
+
+
+def compare(results, baseline, tolerance = 0.25):
+    # cases/sizes slower than the baseline by more than tolerance: list of (name, n, ratio)
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = dict(zip(baseline[name]['sizes'], baseline[name]['seconds']))
+        for n, seconds in zip(result['sizes'], result['seconds']):
+            if n in old and old[n] > 1e-4 and seconds > old[n] * (1 + tolerance):
+                regressions.append((name, n, seconds / old[n]))
+    return regressions
+
+
+def print_results(results):
+    rows = [["case", "n", "time (s)", "qubits/s", "peak memory (KiB)", "exponent"]]
+    for name, result in results.items():
+        exponent = '-' if result['exponent'] is None else f"{result['exponent']:.2f}"
+        for n, seconds, throughput, peak in zip(result['sizes'], result['seconds'], result['throughput'], result['peak_memory']):
+            rows.append([name, f"10^{len(str(n)) - 1}", f"{seconds:.6f}",
+                         '-' if throughput is None else f"{throughput:.3g}", f"{peak / 1024:.1f}", exponent])
+    print_in_table(rows)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the hot paths of BB84lib and CUlib.")
+    parser.add_argument("--cases", nargs='+', choices=list(CASES), default=None, help="cases to run (default: all)")
+    parser.add_argument("--max-n", type=int, default=10**7, help="largest size")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions of each measure (the best one is kept)")
+    parser.add_argument("--save", default=None, help="save the results as JSON baseline")
+    parser.add_argument("--compare", default=None, help="JSON baseline to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="slowdown reported as regression (0.25 <-> 25%%)")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.cases, args.max_n, args.repeat)
+    print_results(results)
+    if args.save is not None:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for name, n, ratio in regressions:
+            print(f"REGRESSION: {name} at n = {n} is {ratio:.2f} times slower than the baseline")
+        if regressions:
+            raise SystemExit(1)
+        print("No regressions compared with the baseline.")
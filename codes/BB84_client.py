@@ -3,21 +3,57 @@
 # BB84_client.py - version 1.0
 
 import socket
+import hashlib
 from threading import Thread, Event
 from CUlib import *
+from BB84codec import CODECS, DEFAULT_CODEC
+from BB84random import configure_from_environment
+from BB84keypool import KeyPool, client_pool_path
+from BB84metrics import default_metrics, serve_from_environment
+from BB84trace import start_from_environment as start_trace_from_environment
+from BB84script import start_headless, write_results
 
 class BB84Client:
-    def __init__(self, client_name, function_handle_response, menu_functions):
+    def __init__(self, client_name, response_handlers, menu_functions, session_id = DEFAULT_SESSION, script = None):
         self.host = "127.0.0.1"
         self.port = SERVER_PORT
         self.client_name = client_name
+        configure_from_environment(client_name)  # random stream of this party (BB84_RNG, BB84_SEED)
+        # numbers of this party on http://127.0.0.1:<12086 Alice, 12087 Bob, 12088 Eve>/metrics (BB84_METRICS_PORT)
+        self.metrics = default_metrics()
+        self.metrics_endpoint = serve_from_environment(client_name)
+        # messages, typed lines and random seed of this party (BB84_TRACE), for BB84replay.py
+        self.trace = start_trace_from_environment(client_name, session_id)
+        self.session_id = session_id  # clients with the same session id exchange the key together
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connection = Connection(self.socket)
+        self.connection.peer = 'server'
+        # wire encoding of the payloads: chosen by the server when connecting
+        self.codec = CODECS[DEFAULT_CODEC]
+        # persistent pool of the secret keys of this party (opened with the first key)
+        self.key_pool = None
+        # secret keys stored in this run (results of the scripted mode)
+        self.keys_stored = 0
+        self.key_bits_stored = 0
+        self.key_digest = hashlib.sha256()
+        # scripted mode (BB84script.py): no menu and no console, the server drives the rounds
+        self.script = script
+        if script is not None:
+            start_headless()
 
         self.connected = False
         self.ready = False
         self.waiting = False
         
-        self.function_handle_response = function_handle_response
+        # dispatch table: opcode -> function(payload as bytes)
+        self.response_handlers = {
+            OP_NOT_READY: self.__on_not_ready,
+            OP_READY: self.__on_ready,
+            OP_WAIT: self.__on_wait,
+            OP_CONTINUE: self.__on_continue,
+            OP_SCRIPT_END: self.__on_script_end
+            }
+        self.response_handlers.update(response_handlers)
         self.menu_max_choices, self.menu_choice, self.show_menu = menu_functions
         
         self.th_handle_responses = Thread(target = self.handle_responses)
@@ -27,18 +63,20 @@ class BB84Client:
         try:
             # connect and send client name to server
             self.socket.connect((self.host, self.port))
-            send(self.socket, self.client_name)
-            print(f"Connection attempt to server as {self.client_name}...")
+            # offer the known codecs (in order of preference) and ask for the session together with the name
+            send(self.connection, OP_HELLO, '\n'.join([self.client_name, ','.join(CODECS), self.session_id]))
+            print(f"Connection attempt to server as {self.client_name} (session '{self.session_id}')...")
             # wait to be connected
-            response = receive(self.socket)
-            if response != TXT_CLIENT_CONNECTED:
-                self.disconnect(response)
+            opcode, response = receive(self.connection)
+            if opcode != OP_CLIENT_CONNECTED:
+                self.disconnect(response.decode('utf-8'))
+            self.codec = CODECS[response.decode('utf-8')]
             # if here: server is ready to take requests
             self.connected = True
             print("Connected succesfully!\nWaiting for all necessary clients...")
 
             self.th_handle_responses.start()
-            if self.menu_max_choices > 0:  # if there is at least one action in the menu
+            if (self.menu_max_choices > 0) and (self.script is None):  # if there is at least one action in the menu
                 self.th_handle_menu.start()
 
         except Exception as e:
@@ -50,18 +88,30 @@ class BB84Client:
         print(log)
         self.socket.close()
         self.connected = False
-        input("Press [Enter] to exit . . .")
+        if self.script is None:
+            read_line("Press [Enter] to exit . . .")
         exit()
 
-    def send_message(self, msg):
-        send(self.socket, msg)
+    def send_message(self, opcode, payload=b''):
+        send(self.connection, opcode, payload)
+
+    def store_key(self, key):
+        # append a secret key to the key pool of this party and session (directory BB84_KEY_POOL)
+        if self.key_pool is None:
+            self.key_pool = KeyPool(client_pool_path(self.client_name, self.session_id))
+        self.key_pool.append(key)
+        self.keys_stored += 1
+        self.key_bits_stored += len(key)
+        self.key_digest.update(key.encode('ascii') + b'\n')
+        self.metrics.throughput('secret_key_bits', len(key))
+        print(f"[Process] Secret key stored in the key pool '{self.key_pool.path}' ({self.key_pool.available()} bytes available)")
 
     def handle_menu(self):
         while self.connected:  # main loop
             while self.connected:  # input loop
                 valid = True
                 try:
-                    choice = int(input()) - 1
+                    choice = int(read_line()) - 1
                 except ValueError:
                     choice = -1
                 #except Exception:  # already disconnected
@@ -90,12 +140,8 @@ class BB84Client:
             if request is not None:
                 request_type, request_info, wait_to_continue = request
                 if request_info is not None:
-                    # send type of action
-                    self.send_message(request_type)
-                    # send info about action
-                    if request_info == '':
-                        request_info = '.'
-                    self.send_message(request_info)
+                    # send type of action and info about action
+                    self.send_message(request_type, request_info)
                     print("Request sent to server!", end="\n\n")
                 else:
                     print("Request NOT sent to server: no information would be sent!", end="\n\n")
@@ -104,46 +150,59 @@ class BB84Client:
                 self.show_menu()
             else:
                 self.waiting = True
-                self.send_message(TXT_WAIT)
+                self.send_message(OP_WAIT)
 
     def handle_responses(self):
         while self.connected:
             try:
-                response = receive(self.socket)
-                while response != '':  # loop to manage multiple requests for direct messages
-                    
-                    if response.find(TXT_NOT_READY) == 0:
-                        response = response[len(TXT_NOT_READY):]
-                        self.ready = False
-                        clear()
-                        print("Waiting for all necessary clients...")
-                        
-                    elif response.find(TXT_READY) == 0:
-                        response = response[len(TXT_READY):]
-                        self.ready = True
-                        clear()
-                        self.show_menu()
-                        
-                    elif response.find(TXT_WAIT) == 0:
-                        response = response[len(TXT_WAIT):]
-                        self.waiting = True
-                        clear()
-                        print("[Simulation in progress]")
-                        
-                    elif response.find(TXT_CONTINUE) == 0:
-                        response = response[len(TXT_CONTINUE):]
-                        self.waiting = False
-                        clear()
-                        self.show_menu()
-                    # possible other elifs
-                    else:
-                        self.function_handle_response(response)
-                        response = ''
-                    
+                opcode, payload = receive(self.connection)
+                handler = self.response_handlers.get(opcode)
+                if handler is not None:
+                    handler(payload)
+                # else: another message from server -> not important if not considered
+
             except ConnectionResetError:
                 self.disconnect("The server has been closed.")
                 break
 
+    def __on_not_ready(self, payload):
+        self.ready = False
+        clear()
+        print("Waiting for all necessary clients...")
+
+    def __on_ready(self, payload):
+        self.ready = True
+        clear()
+        self.show_menu()
+
+    def __on_wait(self, payload):
+        self.waiting = True
+        clear()
+        print("[Simulation in progress]")
+
+    def __on_continue(self, payload):
+        self.waiting = False
+        clear()
+        self.show_menu()
+
+    def __on_script_end(self, payload):
+        # scripted mode completed: results of this party, then disconnect
+        if self.script is None:
+            return
+        write_results(self.script, self.client_name, self.script_results())
+        self.connected = False
+        self.socket.close()
+
+    def script_results(self):
+        # secret keys of this run: Alice and Bob agree if they have the same digest
+        return {
+            'party': self.client_name,
+            'session': self.session_id,
+            'secret_keys': self.keys_stored,
+            'secret_key_bits': self.key_bits_stored,
+            'secret_key_sha256': self.key_digest.hexdigest()
+            }
+
 
 if __name__ == '__main__':
 
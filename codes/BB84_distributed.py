@@ -0,0 +1,406 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84_distributed.py - version 1.0
+
+# Distributed headless simulation: a coordinator splits a run (or a sweep) in tasks and hands them to worker
+# processes, on this machine or on any host that can reach it, over the framed sockets of CUlib.py:
+# - run: the n qubits are split in ranges of RANGE_FRAMES frames, and every range has its own random streams,
+#   derived from the seed of the run and from the index of the range: keys and numbers do not depend on the number
+#   of workers nor on which worker computed which range. Totals, decoy counts and (optionally) the sifted keys are
+#   merged in the order of the ranges, whatever the order in which they arrive.
+# - sweep: every point of the grid of BB84_sweep.py is a task, with the same random stream it has in sweep()
+# A worker connects with OP_HELLO, then gets OP_WORK_TASK (JSON) and answers OP_WORK_RESULT (JSON + packed sifted
+# keys), one task at a time, until OP_WORK_END; the task of a worker that disconnects goes to another worker.
+# usage as library:  totals = run_distributed(10**9, workers=8, seed=1)
+#                    rows = sweep_distributed({'n': [1000, 10000], 'intercept': [0, 0.5, 1]}, repetitions=200, workers=8)
+# usage as script:   python BB84_distributed.py run n [--eve [--strategy s] [--intercept p]] [--decoy] [--length-km l] [--attenuation dB]
+#                    [--depolarization p] [--bit-flip p] [--detector-efficiency e] [--dark-count p] [--rng {pcg64,philox,crypto}]
+#                    [--seed s] [--frame-size f] [--range-frames r] [--keys path] [--workers w] [--listen host] [--port p]
+#                    python BB84_distributed.py sweep [--n n n ...] [--intercept p p ...] ... [--repetitions r] [--workers w] [--json file]
+#                    python BB84_distributed.py worker [--host h] [--port p]   (on every host lending its CPU)
+# The coordinator listens on --listen:--port and starts --workers local workers (0: only the workers started by hand,
+# with --host <address of the coordinator>; --listen 0.0.0.0 to accept them from other hosts).
+
+import os
+import sys
+import json
+import socket
+import subprocess
+from collections import deque
+from struct import Struct
+from threading import Thread, Lock, Condition
+from time import perf_counter, sleep
+import numpy as np
+from CUlib import *
+from BB84_simulation import stream_frames, noisy_channel
+from BB84_sweep import PARAMETERS, grid_points, run_point
+from BB84random import RandomSource, KINDS, PARTIES
+from BB84channel import ChannelModel
+from BB84attacks import InterceptResendAttack, STRATEGIES
+from BB84decoy import DecoySource, DecoyStatistics, INTENSITIES, PROBABILITIES
+from BB84checkpoint import Checkpoint
+
+COORDINATOR_HOST = '127.0.0.1'
+COORDINATOR_PORT = 12090
+RANGE_FRAMES = 64  # frames of each task of a run (64 frames of FRAME_QUBITS: about 0.3 s of work)
+WORKER_CONNECT = 10  # seconds a worker tries to connect to a coordinator not started yet
+RESULT_HEADER = Struct('!I')  # bytes of the JSON of a result (then the packed keys of Alice and Bob)
+
+
+def range_sources(kind, seed, index):
+    # independent stream for each party in the range of frames with this index, all derived from the seed of the run
+    return {party: RandomSource(kind, np.random.SeedSequence(seed, spawn_key=(index, PARTIES.index(party)))) for party in PARTIES}
+
+
+def run_range(task):
+    # executed in a worker: the frames of one range, with the random streams of the range
+    start = perf_counter()
+    strategy = None if task['strategy'] is None else STRATEGIES[task['strategy'][0]](task['strategy'][1])
+    decoy = None if task['decoy'] is None else DecoySource(*task['decoy'])
+    statistics = None if decoy is None else DecoyStatistics(decoy)
+    streams = range_sources(task['kind'], task['seed'], task['index'])
+    sifted_length = 0
+    errors = 0
+    keys = ([], [])
+    for key_alice, key_bob in stream_frames(task['qubits'], task['eve'], task['frame_size'], ChannelModel(**task['channel']),
+                                            streams, strategy, decoy, 0, statistics):
+        sifted_length += len(key_alice)
+        errors += int((key_alice != key_bob).sum())
+        if task['keys']:
+            keys[0].append(key_alice)
+            keys[1].append(key_bob)
+    result = {
+        'sifted_length': sifted_length,
+        'errors': errors,
+        'decoy': None if statistics is None else statistics.get_state(),
+        'seconds': perf_counter() - start
+        }
+    if not task['keys']:
+        return result, None
+    return result, tuple(np.concatenate(frames) if frames else np.zeros(0, dtype=np.uint8) for frames in keys)
+
+
+def run_task(task):
+    # result of a task of any type: (JSON result, sifted keys of Alice and Bob or None)
+    if task['type'] == 'range':
+        return run_range(task)
+    seed_sequence = np.random.SeedSequence(task['seed'], spawn_key=(task['index'],))  # = SeedSequence(seed).spawn(...)[index]
+    return run_point((task['point'], task['repetitions'], seed_sequence, task['kind'])), None
+
+
+def result_payload(result, keys = None):
+    # payload of OP_WORK_RESULT: RESULT_HEADER + JSON + packed key of Alice + packed key of Bob
+    body = json.dumps(result, separators=(',', ':')).encode('utf-8')
+    payload = RESULT_HEADER.pack(len(body)) + body
+    if keys is not None:
+        payload += np.packbits(keys[0]).tobytes() + np.packbits(keys[1]).tobytes()
+    return payload
+
+def parse_result(payload):
+    # (result, keys or None): the keys are as long as the sifted length of the result
+    length, = RESULT_HEADER.unpack_from(payload)
+    start = RESULT_HEADER.size + length
+    result = json.loads(payload[RESULT_HEADER.size:start])
+    if len(payload) == start:
+        return result, None
+    count = result['sifted_length']
+    size = (count + 7) // 8
+    alice = np.unpackbits(np.frombuffer(payload, dtype=np.uint8, count=size, offset=start), count=count)
+    bob = np.unpackbits(np.frombuffer(payload, dtype=np.uint8, count=size, offset=start + size), count=count)
+    return result, (alice, bob)
+
+
+class Coordinator:
+    # hands out the tasks to the workers that connect, one task at a time for each worker, and merges the results
+    # in the order of the tasks: on_result(index, result, keys) is called once for every task, index after index
+    def __init__(self, tasks, on_result, host = COORDINATOR_HOST, port = COORDINATOR_PORT):
+        self.tasks = tasks
+        self.on_result = on_result
+        self.pending = deque(range(len(tasks)))  # tasks not given to a worker (or given back by a disconnected one)
+        self.results = {}  # index -> (result, keys) of the tasks completed before the ones preceding them
+        self.merged = 0  # tasks merged
+        self.connected = 0  # workers connected now
+        self.workers = {}  # name -> tasks completed
+        self.lock = Lock()
+        self.changed = Condition(self.lock)
+        self.listener = socket.create_server((host, port))
+        self.listener.settimeout(1)  # accept() looks every second if the coordinator is closed
+        self.closed = False
+        self.host = host
+        self.port = self.listener.getsockname()[1]  # port 0: any free port
+
+    def run(self, local_workers = 0):
+        # until every task is merged; local_workers: worker processes started on this machine
+        accepting = Thread(target=self.__accept, daemon=True)
+        accepting.start()
+        host = COORDINATOR_HOST if self.host in ('', '0.0.0.0') else self.host
+        processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker', '--host', host, '--port', str(self.port)],
+                                      stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL) for _ in range(local_workers)]
+        try:
+            with self.lock:
+                while self.merged < len(self.tasks):
+                    self.changed.wait(1)
+                    if processes and (self.connected == 0) and all(process.poll() is not None for process in processes):
+                        raise RuntimeError("all the local workers exited before the end of the tasks")
+        finally:
+            self.closed = True
+            accepting.join()  # then the port is free again
+            self.listener.close()
+            for process in processes:
+                try:
+                    process.wait(WORKER_CONNECT)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+    def __accept(self):
+        while not self.closed:
+            try:
+                connection_socket, _ = self.listener.accept()
+            except socket.timeout:
+                continue
+            Thread(target=self.__serve_worker, args=(connection_socket,), daemon=True).start()
+
+    def __serve_worker(self, connection_socket):
+        connection = Connection(connection_socket)
+        name = None
+        index = None
+        try:
+            opcode, payload = receive(connection)
+            lines = payload.decode('utf-8').split('\n')
+            if (opcode != OP_HELLO) or (lines[0] != 'worker'):
+                send(connection, OP_REJECTED, "Connection refused: not a worker")
+                return
+            name = connection.peer = lines[1] if len(lines) > 1 else str(connection_socket.getpeername())
+            send(connection, OP_CLIENT_CONNECTED, name)
+            with self.lock:
+                self.connected += 1
+                self.workers.setdefault(name, 0)
+            try:
+                while True:
+                    index = self.__next_task()
+                    if index is None:
+                        break
+                    send(connection, OP_WORK_TASK, json.dumps(self.tasks[index]))
+                    opcode, payload = receive(connection)
+                    if opcode != OP_WORK_RESULT:
+                        raise ConnectionResetError(f"unexpected opcode {opcode}")
+                    self.__completed(index, *parse_result(payload), name)
+                    index = None
+                send(connection, OP_WORK_END)
+            finally:
+                with self.lock:
+                    self.connected -= 1
+                    if index is not None:  # given to another worker
+                        self.pending.appendleft(index)
+                    self.changed.notify_all()
+        except (OSError, ValueError):  # also ConnectionResetError
+            if index is not None:
+                print(f"Worker {name} disconnected: its task {index} goes to another worker")
+        finally:
+            connection.close()
+
+    def __next_task(self):
+        # index of the next task (None: all the tasks are merged); waits while the last tasks are in progress,
+        # so that the task of a worker that disconnects can be given to the others
+        with self.lock:
+            while (not self.pending) and (self.merged < len(self.tasks)):
+                self.changed.wait()
+            return self.pending.popleft() if self.pending else None
+
+    def __completed(self, index, result, keys, name):
+        with self.lock:
+            self.workers[name] += 1
+            self.results[index] = (result, keys)
+            while self.merged in self.results:
+                self.on_result(self.merged, *self.results.pop(self.merged))
+                self.merged += 1
+            self.changed.notify_all()
+
+
+class Worker:
+    # connects to a coordinator and runs its tasks until it has no more
+    def __init__(self, host = COORDINATOR_HOST, port = COORDINATOR_PORT, name = None):
+        self.host = host
+        self.port = port
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.tasks_done = 0
+
+    def run(self):
+        connection = Connection(self.__connect())
+        connection.peer = 'coordinator'
+        try:
+            send(connection, OP_HELLO, f"worker\n{self.name}")
+            opcode, payload = receive(connection)
+            if opcode != OP_CLIENT_CONNECTED:
+                print(payload.decode('utf-8'))
+                return self.tasks_done
+            while True:
+                opcode, payload = receive(connection)
+                if opcode == OP_WORK_END:
+                    break
+                if opcode == OP_WORK_TASK:
+                    send(connection, OP_WORK_RESULT, result_payload(*run_task(json.loads(payload))))
+                    self.tasks_done += 1
+        except ConnectionResetError:
+            print("Connection closed by the coordinator")
+        finally:
+            connection.close()
+        return self.tasks_done
+
+    def __connect(self):
+        # the coordinator may start after its workers
+        deadline = perf_counter() + WORKER_CONNECT
+        while True:
+            try:
+                return socket.create_connection((self.host, self.port))
+            except OSError:
+                if perf_counter() > deadline:
+                    raise
+                sleep(0.1)
+
+
+def run_distributed(n, eve=False, frame_size=FRAME_QUBITS, channel=None, strategy=None, decoy=None, kind='pcg64', seed=None,
+                    workers=None, range_frames=RANGE_FRAMES, keys=None, host=COORDINATOR_HOST, port=COORDINATOR_PORT):
+    # totals of run_stream(), computed by the workers range by range
+    # decoy: DecoySource (None: single photons); seed: None for fresh entropy (reported in the totals, to repeat the run)
+    # workers: local worker processes (default: all the CPU cores; 0: only workers started by hand)
+    # keys: path where the sifted keys of Alice and Bob are written in order, as the streams 'a' and 'b' of a
+    # BB84checkpoint.Checkpoint (Checkpoint(path).load(), then .read('a'))
+    start = perf_counter()
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    if eve and strategy is None:
+        strategy = InterceptResendAttack()
+    qubits = range_frames * frame_size
+    tasks = [{
+        'type': 'range',
+        'index': index,
+        'qubits': min(qubits, n - first),
+        'frame_size': frame_size,
+        'eve': eve,
+        'strategy': None if not eve else [strategy.name, strategy.fraction],
+        'channel': noisy_channel(channel, 0.0).as_dict(),
+        'decoy': None if decoy is None else [decoy.intensities.tolist(), decoy.probabilities.tolist()],
+        'kind': kind,
+        'seed': seed,
+        'keys': keys is not None
+        } for index, first in enumerate(range(0, n, qubits))]
+
+    statistics = None if decoy is None else DecoyStatistics(decoy)
+    totals = {'sifted_length': 0, 'errors': 0, 'first_key_bits': None, 'worker_seconds': 0.0}
+    output = None
+    if keys is not None:
+        output = Checkpoint(keys)
+        output.truncate({'a': 0, 'b': 0})
+
+    def merge(index, result, sifted):
+        # results of the ranges, in order
+        if totals['first_key_bits'] is None:
+            totals['first_key_bits'] = perf_counter() - start
+        totals['sifted_length'] += result['sifted_length']
+        totals['errors'] += result['errors']
+        totals['worker_seconds'] += result['seconds']
+        if statistics is not None:
+            state = statistics.get_state()
+            statistics.set_state({name: np.add(counts, result['decoy'][name]) for name, counts in state.items()})
+        if output is not None:
+            output.append('a', sifted[0])
+            output.append('b', sifted[1])
+            output.commit({'n': n, 'seed': seed, 'ranges': index + 1})
+
+    coordinator = Coordinator(tasks, merge, host, port)
+    coordinator.run((os.cpu_count() or 1) if workers is None else workers)
+    sifted_length, errors = totals['sifted_length'], totals['errors']
+    return {
+        'n': n,
+        'eve': eve,
+        'frame_size': frame_size,
+        'sifted_length': sifted_length,
+        'errors': errors,
+        'qber': errors / sifted_length if sifted_length > 0 else None,
+        'decoy': None if statistics is None else statistics.estimate(),
+        'seed': seed,
+        'ranges': len(tasks),
+        'workers': coordinator.workers,
+        'time to first key bits (s)': totals['first_key_bits'],
+        'time of the workers (s)': totals['worker_seconds'],
+        'total time (s)': perf_counter() - start
+        }
+
+
+def sweep_distributed(grid, repetitions = 100, seed = 0, workers = None, kind = 'pcg64', host = COORDINATOR_HOST, port = COORDINATOR_PORT):
+    # rows of BB84_sweep.sweep() (same numbers), one point of the grid for each task
+    points = grid_points(grid)
+    tasks = [{'type': 'point', 'index': index, 'point': point, 'repetitions': repetitions, 'seed': seed, 'kind': kind}
+             for index, point in enumerate(points)]
+    rows = []
+    coordinator = Coordinator(tasks, lambda index, row, keys: rows.append(row), host, port)
+    coordinator.run((os.cpu_count() or 1) if workers is None else workers)
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Headless BB84 simulation split among worker processes, on this and other hosts")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="one streamed run, split in ranges of frames")
+    sweep_parser = commands.add_parser("sweep", help="Monte Carlo sweep, one point for each task")
+    worker_parser = commands.add_parser("worker", help="work for a coordinator")
+
+    run_parser.add_argument("n", type=int, help="number of qubits sent by Alice")
+    run_parser.add_argument("--eve", action="store_true", help="Eve attacks the qubits (default: intercept-resend of every qubit)")
+    run_parser.add_argument("--strategy", choices=list(STRATEGIES), default=InterceptResendAttack.name, help="attack of Eve")
+    run_parser.add_argument("--intercept", type=float, default=1.0, help="fraction of the qubits attacked by Eve")
+    run_parser.add_argument("--decoy", action="store_true", help="decoy-state source: signal, decoy and vacuum pulses")
+    run_parser.add_argument("--intensities", type=float, nargs=3, default=INTENSITIES, help="mean photons of signal, decoy and vacuum pulses")
+    run_parser.add_argument("--decoy-probabilities", type=float, nargs=3, default=PROBABILITIES, help="probability of signal, decoy and vacuum pulses")
+    run_parser.add_argument("--length-km", type=float, default=0.0, help="length of the fiber towards Bob")
+    run_parser.add_argument("--attenuation", type=float, default=0.2, help="attenuation of the fiber (dB/km)")
+    run_parser.add_argument("--depolarization", type=float, default=0.0, help="probability that a qubit is depolarized")
+    run_parser.add_argument("--bit-flip", type=float, default=0.0, help="probability that the value of a qubit is flipped")
+    run_parser.add_argument("--detector-efficiency", type=float, default=1.0, help="probability that Bob's detector clicks for a photon")
+    run_parser.add_argument("--dark-count", type=float, default=0.0, help="probability of a dark count for each pulse")
+    run_parser.add_argument("--rng", choices=KINDS, default='pcg64', help="random generator (crypto: operating system, no seed)")
+    run_parser.add_argument("--seed", type=int, default=None, help="seed of the run: every range of frames has its own streams (default: fresh entropy)")
+    run_parser.add_argument("--frame-size", type=int, default=FRAME_QUBITS, help="qubits in each frame")
+    run_parser.add_argument("--range-frames", type=int, default=RANGE_FRAMES, help="frames of each task")
+    run_parser.add_argument("--keys", default=None, help="write the sifted keys of Alice and Bob, in order, to path.a.bits and path.b.bits")
+
+    sweep_parser.add_argument("--n", type=int, nargs='+', default=PARAMETERS['n'], help="qubits sent by Alice")
+    sweep_parser.add_argument("--sample-bits", type=int, nargs='+', default=PARAMETERS['sample_bits'], help="bits of the key compared to detect Eve")
+    sweep_parser.add_argument("--strategy", choices=list(STRATEGIES), nargs='+', default=PARAMETERS['strategy'], help="attacks of Eve")
+    sweep_parser.add_argument("--intercept", type=float, nargs='+', default=PARAMETERS['intercept'], help="fraction of the qubits intercepted by Eve (0: no Eve)")
+    sweep_parser.add_argument("--noise", type=float, nargs='+', default=PARAMETERS['noise'], help="bit-flip probability of the channel")
+    sweep_parser.add_argument("--mean-photons", type=float, nargs='+', default=PARAMETERS['mean_photons'], help="photons per pulse of a weak coherent source (default: single photons)")
+    sweep_parser.add_argument("--repetitions", type=int, default=100, help="simulations for every point")
+    sweep_parser.add_argument("--seed", type=int, default=0, help="seed of the whole sweep")
+    sweep_parser.add_argument("--rng", choices=KINDS, default='pcg64', help="random generator (crypto: not reproducible)")
+    sweep_parser.add_argument("--json", default=None, help="also save the results in this JSON file")
+
+    for command in (run_parser, sweep_parser):
+        command.add_argument("--workers", type=int, default=None, help="local worker processes (default: all the CPU cores; 0: only remote workers)")
+        command.add_argument("--listen", default=COORDINATOR_HOST, help="address where the workers connect (0.0.0.0: any host)")
+        command.add_argument("--port", type=int, default=COORDINATOR_PORT, help="port where the workers connect")
+    worker_parser.add_argument("--host", default=COORDINATOR_HOST, help="address of the coordinator")
+    worker_parser.add_argument("--port", type=int, default=COORDINATOR_PORT, help="port of the coordinator")
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        print(f"{Worker(args.host, args.port).run()} tasks done")
+    elif args.command == "run":
+        channel = ChannelModel(args.length_km, args.attenuation, args.depolarization, args.bit_flip,
+                               args.detector_efficiency, args.dark_count)
+        decoy = DecoySource(args.intensities, args.decoy_probabilities) if args.decoy else None
+        totals = run_distributed(args.n, args.eve, args.frame_size, channel, STRATEGIES[args.strategy](args.intercept), decoy,
+                                 args.rng, args.seed, args.workers, args.range_frames, args.keys, args.listen, args.port)
+        print_in_table([[key, str(value)] for key, value in totals.items()])
+    else:
+        grid = {'n': args.n, 'sample_bits': args.sample_bits, 'strategy': args.strategy, 'intercept': args.intercept, 'noise': args.noise,
+                'mean_photons': args.mean_photons}
+        rows = sweep_distributed(grid, args.repetitions, args.seed, args.workers, args.rng, args.listen, args.port)
+        columns = list(rows[0])
+        print_in_table([columns] + [[row[column] if type(row[column]) is not float else f"{row[column]:.4f}" for column in columns] for row in rows])
+        if args.json is not None:
+            with open(args.json, 'w') as file:
+                json.dump(rows, file, indent=2)
@@ -2,10 +2,24 @@
 # by Manuel Maiuolo (manuelmaiuolo@gmail.com)
 # BB84_server.py - version 1.0
 
+import sys
 import socket
 import threading
+from time import perf_counter
+from concurrent.futures import Future, wait as wait_futures
 from CUlib import *
-from random import randint
+from BB84lib import sift, sample_positions, detection_probability, mark_no_clicks
+from BB84qber import SequentialTest, count_errors, reconciliation_qber
+from BB84cascade import binary_entropy
+from BB84privacy import secure_key_length, amplified_key_length, VERIFICATION_BITS
+from BB84finitekey import FiniteKeyEstimate
+from BB84codec import negotiate_codec, encode_frame, decode_frame
+from BB84channel import ChannelModel
+from BB84random import default_source, configure_from_environment
+from BB84metrics import default_metrics, serve_from_environment
+from BB84trace import start_from_environment as start_trace_from_environment
+from BB84script import script_from_arguments, start_headless, channel_from_script, write_results
+from BB84checkpoint import Checkpoint, checkpoint_path, parse_stream_start, parse_stream_resume
 
 from BB84_Alice import AliceActions as ACT_ALICE
 from BB84_Bob import BobActions as ACT_BOB
@@ -15,108 +29,418 @@ from BB84_Eve import EveActions as ACT_EVE
 class ServerActions:
     SEND_B = "make Alice and Bob announce the strings b and b' via public classical channel"
     DETECT_EAVESDROPPING = "try to detect the presence of Eve thanks to a possible inconsistency in the strings a and a'"
+    RECONCILE = "correct the errors in the string a' with Cascade (parities of blocks of a via public classical channel)"
+    AMPLIFY_PRIVACY = "compress a and a' to the secret key with privacy amplification (random Toeplitz matrix via public classical channel)"
+    SET_CHANNEL = "set the noise of the quantum channel towards Bob (fiber loss, depolarization, bit-flip, detector efficiency, dark counts)"
     CLEAR = "clear the CLI screen"
 
 
+class BB84Session:
+    # state of one key exchange: one group of Alice, Bob and (optionally) Eve
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.b = self.b1 = self.a = self.a1 = None
+        self.clicks = None  # 1 where Bob's detector clicked, announced with b'
+        self.key_length = None  # length of the common key after sifting (None: bases not exchanged yet)
+        self.stream_b1 = {}  # streaming mode: frame index -> (string b', clicks) announced by Bob, waiting for Alice's b
+        self.channel = ChannelModel()  # quantum channel towards Bob (perfect by default)
+        self.qber = None  # QBER estimated by the last eavesdropping detection
+        self.reconciled_qber = None  # QBER measured by the reconciliation (errors corrected / key length)
+        self.leaked_bits = 0  # bits of information about the common key disclosed on the public channel
+        self.cascade_round_trips = 0
+        self.cascade_leaked_bits = 0
+        self.cascade_corrected = 0
+        self.verification_hashes = {}  # client name -> hash of the reconciled key
+        self.keys_verified = None  # the hashes of the reconciled keys are equal (None: not compared)
+        self.toeplitz_seed = None  # seed of the privacy amplification, announced by Alice
+        self.qubits_sent = None  # qubits sent by Alice for the current key
+        self.sampled_bits = 0  # bits compared by the last eavesdropping detection
+        self.sampled_errors = 0  # different bits among them
+        self.eve_detected = None  # result of the last eavesdropping detection
+        self.secret_key_length = None  # length of the last secret key
+        self.is_simulation_running = False
+        self.delivered = threading.Event()  # Bob measured the last quantum state (or sifted the last stream)
+        # used to store connected clients: can reject multiple connections and know when Alice & Bob are ready
+        # client is stored as tuple: (connection, address as string)
+        self.clients = {'Alice': None, 'Bob': None, 'Eve': None}
+        # wire encoding chosen for each connected client (payloads are transcoded when relayed)
+        self.codecs = {}
+        # requests waiting for an answer from a client: (client name, opcode) -> Future
+        self.pending_requests = {}
+
+    @property
+    def tag(self):
+        # prefix of the messages printed by the server about this session
+        if self.session_id == DEFAULT_SESSION:
+            return "[Server]"
+        return f"[Server|{self.session_id}]"
+
+    def get_client_connection(self, client_name):
+        if self.clients[client_name] is None:
+            return None
+        else:
+            return self.clients[client_name][0]
+
+    def get_connected_clients(self):
+        # return names of the connected clients (in list)
+        return [client_type for client_type, client_info in self.clients.items() if client_info is not None]
+
+    def is_ready(self):
+        # Alice and Bob are both connected
+        return (self.clients['Alice'] is not None) and (self.clients['Bob'] is not None)
+
+
 class BB84Server:
-    def __init__(self):
+    MAX_SESSIONS_SHOWN = 10  # sessions listed in the head of the menu
+
+    def __init__(self, script = None):
+        # random numbers of the server (positions of the compared bits, seeds of Cascade)
+        configure_from_environment('server')
+        # numbers of the server on http://127.0.0.1:12085/metrics (BB84_METRICS_PORT)
+        self.metrics = default_metrics()
+        self.metrics_endpoint = serve_from_environment('server')
+        # messages of all the sessions, console lines and random seed of the server (BB84_TRACE), for BB84replay.py
+        self.trace = start_trace_from_environment('server')
 
-        self.b = self.b1 = self.a = self.a1 = None
         self.menu_structure = [
             ServerActions.SEND_B,
             ServerActions.DETECT_EAVESDROPPING,
+            ServerActions.RECONCILE,
+            ServerActions.AMPLIFY_PRIVACY,
+            ServerActions.SET_CHANNEL,
             ServerActions.CLEAR
             ]
-        self.is_simulation_running = False
         
         # prepare for socket programming
         self.host = 'localhost'
         self.port = SERVER_PORT
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # used to store connected clients: can reject multiple connections and know when Alice & Bob are ready
-        # client is stored as tuple: (socket, address as string)
-        self.clients = {'Alice': None, 'Bob': None, 'Eve': None}
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # allow quick restarts
+        # registry of the sessions with at least one connected client: session id -> BB84Session
+        self.sessions = {}
         # mutex for threading
-        self.lock = threading.Lock()
+        self.lock = threading.RLock()
+        self.clients_changed = threading.Condition(self.lock)  # a client connected or disconnected
         
-        # thread to manage input
-        self.tr_handle_input = threading.Thread(target = self.handle_input)
-        # event for waiting when trying to get info from clients
-        self.alice_info_event = threading.Event()
-        self.bob_info_event = threading.Event()
-
-        
-    def get_client_socket(self, client_name):
-        if self.clients[client_name] is None:
-            return None
+        # thread to manage input (scripted mode, see BB84script.py: thread that runs the script, no console)
+        self.script = script
+        self.stopped = False
+        if script is None:
+            self.tr_handle_input = threading.Thread(target = self.handle_input)
         else:
-            return self.clients[client_name][0]
+            start_headless()
+            self.tr_handle_input = threading.Thread(target = self.run_script)
+        self.pending_requests_lock = threading.Lock()
+
+        # dispatch table for requests from clients: (client name, opcode) -> function(session, request_info as bytes)
+        self.request_handlers = {
+            ('Alice', OP_SEND_QUBITS): self.alice_send_qubits,
+            ('Alice', ACT_ALICE.SEND_B): self.alice_send_b,
+            ('Alice', ACT_ALICE.SEND_SOME_A): self.alice_send_some_a,
+            ('Bob', ACT_BOB.SEND_B1): self.bob_send_b1,
+            ('Bob', ACT_BOB.SEND_SOME_A1): self.bob_send_some_a1,
+            ('Eve', ACT_EVE.SEND_QUBITS): self.eve_send_qubits,
+            # streaming mode
+            ('Alice', OP_STREAM_START): self.alice_stream_start,
+            ('Alice', OP_QUBIT_FRAME): self.alice_send_frame,
+            ('Eve', OP_QUBIT_FRAME): self.eve_send_frame,
+            ('Bob', OP_FRAME_B1): self.bob_send_frame_b1,
+            ('Alice', OP_FRAME_B): self.alice_send_frame_b,
+            ('Alice', OP_STREAM_END): self.alice_stream_end,
+            ('Bob', OP_STREAM_RESUME): self.bob_stream_resume,
+            # error reconciliation
+            ('Bob', OP_PARITY_QUERIES): self.bob_send_parity_queries,
+            ('Alice', OP_PARITIES): self.alice_send_parities,
+            ('Bob', OP_RECONCILE): self.bob_reconciled,
+            ('Alice', OP_VERIFY): self.alice_verified,
+            ('Bob', OP_VERIFY): self.bob_verified,
+            # privacy amplification
+            ('Alice', OP_AMPLIFY): self.alice_send_toeplitz_seed,
+            ('Bob', OP_AMPLIFY): self.bob_amplified
+            }
+
 
     ## region BB84: INTERESTING PART ABOUT BB84 PROTOCOL MANAGEMENT: quantum and classical channels
 
-    def alice_request(self, request_type, request_info):
-        bob_socket = self.get_client_socket('Bob')
-        eve_socket = self.get_client_socket('Eve')
+    def alice_send_qubits(self, session, request_info):
+        bob_connection = session.get_client_connection('Bob')
+        eve_connection = session.get_client_connection('Eve')
         
-        if request_type == ACT_ALICE.SEND_QUBITS:
-            print("[Server] Alice is sending qubits on the public quantum channel...", end="\n > ")
+        print(session.tag + " Alice is sending qubits on the public quantum channel...", end="\n > ")
 
-            # need to ServerActions.SEND_B before ServerActions.DETECT_EAVESDROPPING
-            self.b = self.b1 = self.a = self.a1 = None
-            
-            if eve_socket is not None:
-                print("[Server] Eve is eavesdropping!", end="\n > ")
-                send(eve_socket, ACT_EVE.RECEIVE_QUBITS + request_info)
-            else:
-                print("[Server] Bob is processing the received qubits.", end="\n > ")
-                send(bob_socket, ACT_BOB.RECEIVE_QUBITS + request_info)
-
-        elif request_type == ACT_ALICE.SEND_B:
-            if request_info == ',':
-                # Bob is not up to date with Alice
-                self.b = None
-            else:
-                self.b = request_info
-                print("[Server] Alice announced the string b via public classical channel: [", self.b, "]", sep='', end="\n > ")
-            # finally
-            self.alice_info_event.set()
-
-        elif request_type == ACT_ALICE.SEND_SOME_A:
-            if request_info == '':
-                self.a = None
-            else:
-                self.a = request_info
-                print("[Server] Alice announced the requested bits from string a: [", self.a, "]", sep='', end="\n > ")
-            # finally
-            self.alice_info_event.set()
-
-
-    def bob_request(self, request_type, request_info):
+        # need to ServerActions.SEND_B before ServerActions.DETECT_EAVESDROPPING
+        session.b = session.b1 = session.a = session.a1 = None
+        session.key_length = None
         
-        if request_type == ACT_BOB.SEND_B1:
-            self.b1 = request_info
-            print("[Server] Bob  announced the string b' via public classical channel: [", self.b1, "]", sep='', end="\n > ")
-            self.bob_info_event.set()
-
-        elif request_type == ACT_BOB.SEND_SOME_A1:
-            if request_info == '':
-                self.a1 = None
-            else:
-                self.a1 = request_info
-                print("[Server] Bob  announced the requested bits from string a': [", self.a1, "]", sep='', end="\n > ")
-            # finally
-            self.bob_info_event.set()
-
-
-    def eve_request(self, request_type, request_info):
-        bob_socket = self.get_client_socket('Bob')
+        if eve_connection is not None:
+            print(session.tag + " Eve is eavesdropping!", end="\n > ")
+            self.relay_qubits(session, 'Alice', eve_connection, 'Eve', ACT_EVE.RECEIVE_QUBITS, request_info)
+        else:
+            print(session.tag + " Bob is processing the received qubits.", end="\n > ")
+            self.relay_qubits(session, 'Alice', bob_connection, 'Bob', ACT_BOB.RECEIVE_QUBITS, request_info)
+
+
+    def alice_send_b(self, session, request_info):
+        b = session.codecs['Alice'].decode_bits(request_info)
+        if b is None:
+            # Bob is not up to date with Alice
+            session.b = None
+        else:
+            session.b = b
+            print(session.tag + " Alice announced the string b via public classical channel: [", session.b, "]", sep='', end="\n > ")
+        # finally
+        self.answer_received(session, 'Alice', ACT_ALICE.SEND_B)
+
+
+    def alice_send_some_a(self, session, request_info):
+        a = session.codecs['Alice'].decode_revealed_bits(request_info)
+        if a is None:
+            session.a = None
+        else:
+            session.a = a
+            print(session.tag + " Alice announced the requested bits from string a: [", session.a, "]", sep='', end="\n > ")
+        # finally
+        self.answer_received(session, 'Alice', ACT_ALICE.SEND_SOME_A)
+
+
+    def bob_send_b1(self, session, request_info):
+        session.b1, session.clicks = session.codecs['Bob'].decode_detections(request_info)
+        if session.b1 is not None:  # 'x' <-> no click
+            print(session.tag + " Bob  announced the string b' via public classical channel: [", mark_no_clicks(session.b1, session.clicks), "]", sep='', end="\n > ")
+        self.answer_received(session, 'Bob', ACT_BOB.SEND_B1)
+
+
+    def bob_send_some_a1(self, session, request_info):
+        a1 = session.codecs['Bob'].decode_revealed_bits(request_info)
+        if a1 is None:
+            session.a1 = None
+        else:
+            session.a1 = a1
+            print(session.tag + " Bob  announced the requested bits from string a': [", session.a1, "]", sep='', end="\n > ")
+        # finally
+        self.answer_received(session, 'Bob', ACT_BOB.SEND_SOME_A1)
+
+
+    def eve_send_qubits(self, session, request_info):
+        bob_connection = session.get_client_connection('Bob')
         
-        if request_type == ACT_EVE.SEND_QUBITS:
-            if bob_socket is not None:
-                print("[Server] Eve is sending qubits to Bob via public quantum channel...", end="\n > ")
-                send(bob_socket, ACT_BOB.RECEIVE_QUBITS + request_info)
-            else:
-                print("[Server] Eve tried to send qubits to Bob, but Bob is not connected!", end="\n > ")
+        if bob_connection is not None:
+            print(session.tag + " Eve is sending qubits to Bob via public quantum channel...", end="\n > ")
+            self.relay_qubits(session, 'Eve', bob_connection, 'Bob', ACT_BOB.RECEIVE_QUBITS, request_info)
+        else:
+            print(session.tag + " Eve tried to send qubits to Bob, but Bob is not connected!", end="\n > ")
+
+
+    ## streaming mode: Alice sends fixed-size frames, Eve and Bob measure them one by one,
+    ## and the bases of each measured frame are exchanged (and the frame sifted) while the next frames travel
+
+    def alice_stream_start(self, session, request_info):
+        n, stream_id, _ = parse_stream_start(request_info)
+        print(session.tag + f" Alice is streaming {n} qubits in frames of {FRAME_QUBITS}...", end="\n > ")
+        session.b = session.b1 = session.a = session.a1 = None
+        session.key_length = 0  # with checkpoints (stream_id): the bits sifted before the first frame, when Bob answers
+        session.qubits_sent = n
+        session.stream_b1 = {}
+        session.qber = session.reconciled_qber = session.keys_verified = None
+        session.leaked_bits = 0
+        for client_name in ['Eve', 'Bob']:
+            client_connection = session.get_client_connection(client_name)
+            if client_connection is not None:
+                self.send_to_client(client_connection, OP_STREAM_START, request_info)
+
+
+    def alice_send_frame(self, session, request_info):
+        # the quantum channel passes through Eve, if she is connected
+        receiver_name = 'Eve' if session.get_client_connection('Eve') is not None else 'Bob'
+        self.relay_qubit_frame(session, 'Alice', receiver_name, request_info)
+
+
+    def eve_send_frame(self, session, request_info):
+        if session.get_client_connection('Bob') is not None:
+            self.relay_qubit_frame(session, 'Eve', 'Bob', request_info)
+
+
+    def bob_send_frame_b1(self, session, request_info):
+        index, payload = decode_frame(request_info)
+        b1, clicks = session.codecs['Bob'].decode_detections(payload)
+        session.stream_b1[index] = (b1, clicks)
+        self.metrics.set('stream_frames_pending', len(session.stream_b1), session=session.session_id)
+        alice_connection = session.get_client_connection('Alice')
+        if alice_connection is not None:
+            self.send_to_client(alice_connection, OP_FRAME_B1, encode_frame(index, session.codecs['Alice'].encode_detections(b1, clicks)))
+
+
+    def alice_send_frame_b(self, session, request_info):
+        index, payload = decode_frame(request_info)
+        b = session.codecs['Alice'].decode_bits(payload)
+        b1, clicks = session.stream_b1.pop(index, (None, None))
+        if (b1 is not None) and (len(b) == len(b1)):
+            sifted_bits = int(sift(b, b, b1, clicks)[1].sum())
+            session.key_length += sifted_bits
+            self.metrics.throughput('sifted_key_bits', sifted_bits)
+        self.metrics.set('stream_frames_pending', len(session.stream_b1), session=session.session_id)
+        bob_connection = session.get_client_connection('Bob')
+        if bob_connection is not None:
+            self.send_to_client(bob_connection, OP_FRAME_B, encode_frame(index, session.codecs['Bob'].encode_bits(b)))
+
+
+    def bob_stream_resume(self, session, request_info):
+        # first frame of a stream with checkpoints, agreed by Bob: the frames before it are already sifted
+        first_frame, sifted_bits = parse_stream_resume(request_info)
+        session.key_length = sifted_bits
+        if first_frame > 0:
+            print(session.tag + f" Stream resumed from the checkpoints of Alice and Bob: {first_frame} frames",
+                  f"({sifted_bits} bits) already sifted.", end="\n > ")
+        for client_name in ['Alice', 'Eve']:
+            client_connection = session.get_client_connection(client_name)
+            if client_connection is not None:
+                self.send_to_client(client_connection, OP_STREAM_RESUME, request_info)
+
+
+    def alice_stream_end(self, session, request_info):
+        print(session.tag + f" Stream completed: {request_info.decode('utf-8')} frames sifted,",
+              f"the common key has {session.key_length} bits.", end="\n > ")
+        for client_name in ['Eve', 'Bob']:
+            client_connection = session.get_client_connection(client_name)
+            if client_connection is not None:
+                self.send_to_client(client_connection, OP_STREAM_END, request_info)
+
+
+    ## error reconciliation: Bob asks the parities of blocks of Alice's key, many blocks in each message
+
+    def bob_send_parity_queries(self, session, request_info):
+        alice_connection = session.get_client_connection('Alice')
+        if alice_connection is None:
+            return
+        if session.codecs['Bob'] is not session.codecs['Alice']:
+            request_info = session.codecs['Alice'].encode_parity_queries(session.codecs['Bob'].decode_parity_queries(request_info))
+        self.send_to_client(alice_connection, OP_PARITY_QUERIES, request_info)
+
+
+    def alice_send_parities(self, session, request_info):
+        parities = session.codecs['Alice'].decode_bits(request_info)
+        # every parity is public: one bit of information about the key
+        session.cascade_round_trips += 1
+        session.cascade_leaked_bits += len(parities)
+        bob_connection = session.get_client_connection('Bob')
+        if bob_connection is not None:
+            self.send_to_client(bob_connection, OP_PARITIES, session.codecs['Bob'].encode_bits(parities))
+
+
+    def bob_reconciled(self, session, request_info):
+        session.cascade_corrected = int(request_info.decode('utf-8'))
+        self.answer_received(session, 'Bob', OP_RECONCILE)
+
+
+    def alice_verified(self, session, request_info):
+        session.verification_hashes['Alice'] = session.codecs['Alice'].decode_bits(request_info)
+        self.answer_received(session, 'Alice', OP_VERIFY)
+
+
+    def bob_verified(self, session, request_info):
+        session.verification_hashes['Bob'] = session.codecs['Bob'].decode_bits(request_info)
+        self.answer_received(session, 'Bob', OP_VERIFY)
+
+
+    def alice_send_toeplitz_seed(self, session, request_info):
+        session.toeplitz_seed = session.codecs['Alice'].decode_bits(request_info)
+        self.answer_received(session, 'Alice', OP_AMPLIFY)
+
+
+    def bob_amplified(self, session, request_info):
+        self.answer_received(session, 'Bob', OP_AMPLIFY)
+
+
+    def relay_qubit_frame(self, session, sender_name, receiver_name, payload):
+        # same as relay_qubits, keeping the index of the frame
+        receiver_connection = session.get_client_connection(receiver_name)
+        if receiver_connection is None:  # disconnected during the stream
+            return
+        index, qubits = decode_frame(payload)
+        qubits = self.transcode_qubits(session, sender_name, receiver_name, qubits)
+        self.send_to_client(receiver_connection, OP_QUBIT_FRAME, encode_frame(index, qubits))
+
+
+    def send_to_client(self, client_connection, opcode, payload=b''):
+        # message to one client, e.g. relayed from another one: if it fails, that client is disconnecting and its
+        # own thread unregisters it (its receive fails), the requester and the other receivers go on
+        if client_connection is None:
+            return False
+        try:
+            send(client_connection, opcode, payload)
+            return True
+        except OSError:
+            return False
+
+
+    def relay_qubits(self, session, sender_name, receiver_connection, receiver_name, opcode, payload):
+        self.send_to_client(receiver_connection, opcode, self.transcode_qubits(session, sender_name, receiver_name, payload))
+
+
+    def transcode_qubits(self, session, sender_name, receiver_name, payload):
+        # forward the quantum state, transcoding it only if sender and receiver use different codecs;
+        # towards Bob the qubits pass through the channel model, and Bob receives also the clicks of his detector
+        sender_codec = session.codecs[sender_name]
+        receiver_codec = session.codecs[receiver_name]
+        if receiver_name == 'Bob':
+            with self.metrics.phase('transmit'):
+                qubits, clicks = session.channel.transmit(sender_codec.decode_qubits(payload))
+                return receiver_codec.encode_detected_qubits(qubits, clicks)
+        if sender_codec is not receiver_codec:
+            return receiver_codec.encode_qubits(sender_codec.decode_qubits(payload))
+        return payload
+
+
+    def request_from_client(self, session, client_name, opcode, payload=b''):
+        # send a request to a client: the returned future is completed when the answer arrives
+        future = Future()
+        with self.pending_requests_lock:
+            previous = session.pending_requests.get((client_name, opcode))
+            session.pending_requests[(client_name, opcode)] = future
+            self.metrics.set('pending_requests', len(session.pending_requests), session=session.session_id)
+        if previous is not None:
+            previous.cancel()
+        self.send_to_client(session.get_client_connection(client_name), opcode, payload)  # not sent: cancelled on unregister
+        return future
+
+
+    def answer_received(self, session, client_name, opcode):
+        with self.pending_requests_lock:
+            future = session.pending_requests.pop((client_name, opcode), None)
+            self.metrics.set('pending_requests', len(session.pending_requests), session=session.session_id)
+        if (future is not None) and (not future.done()):
+            future.set_result(True)
+
+
+    def cancel_requests(self, session, client_name):
+        # client disconnected: nobody will answer its pending requests
+        with self.pending_requests_lock:
+            keys = [key for key in session.pending_requests if key[0] == client_name]
+            futures = [session.pending_requests.pop(key) for key in keys]
+        for future in futures:
+            if not future.done():
+                future.set_exception(ConnectionResetError(f"{client_name} disconnected"))
+
+
+    def wait_answers(self, session, futures, progress = None):
+        # wait for the answers of the clients (at most REQUEST_TIMEOUT seconds without progress): True if all arrived
+        # progress: function returning a counter of the exchange (e.g. round trips): every time it changes,
+        # the clients get REQUEST_TIMEOUT seconds more (long exchanges made of many short rounds)
+        last = None if progress is None else progress()
+        while True:
+            done, not_done = wait_futures(futures, timeout=REQUEST_TIMEOUT)
+            if (not not_done) or (progress is None) or (progress() == last):
+                break
+            last = progress()
+        for future in not_done:
+            future.cancel()
+        if not_done:
+            print(session.tag + " A client did not answer in time!", end="\n > ")
+            return False
+        if any(future.exception() is not None for future in done):
+            print(session.tag + " A client disconnected before answering!", end="\n > ")
+            return False
+        return True
 
 
     ## end region BB84
@@ -124,270 +448,590 @@ class BB84Server:
     def start(self):
         # start server
         self.socket.bind((self.host, self.port))
-        self.socket.listen(1)
+        self.socket.listen(LISTEN_BACKLOG)
         self.show_menu()
         self.tr_handle_input.start()
         # listen to connection attempts
         while True:
             # wait until connection attempt from a client
-            client_socket, client_address = self.socket.accept()
+            try:
+                client_socket, client_address = self.socket.accept()
+            except OSError:
+                if self.stopped:
+                    break
+                raise
+            client_connection = Connection(client_socket)
             # get client name: can be Alice, Bob or Eve
-            client_name = receive(client_socket)
+            try:
+                opcode, client_name = receive(client_connection)
+            except ConnectionResetError:
+                client_connection.close()
+                continue
+            if opcode != OP_HELLO:
+                client_connection.close()
+                continue
+            client_name, offered_codecs, session_id = parse_hello(client_name)
+            client_connection.peer = client_peer(client_name, session_id)
             # prepare and start thread to handle new client
-            th_handle_client = threading.Thread(target = self.handle_client, args = (client_name, (client_socket, f'{client_address}'),))
+            th_handle_client = threading.Thread(target = self.handle_client, args = (session_id, client_name, (client_connection, f'{client_address}'), offered_codecs,))
+            th_handle_client.daemon = self.script is not None  # scripted mode: the server exits with the script
             th_handle_client.start()
 
 
-    def __send_b(self):
-        # prepare sockets
-        alice_socket = self.get_client_socket('Alice')
-        bob_socket = self.get_client_socket('Bob')
+    def __send_b(self, session):
+        # prepare connections
+        alice_connection = session.get_client_connection('Alice')
+        bob_connection = session.get_client_connection('Bob')
             
-        if (alice_socket is None) or (bob_socket is None):  # Alice or Bob are not connected -> invalid choice
-            print("[Server] Alice and Bob are not both connected!", end="\n > ")
+        if (alice_connection is None) or (bob_connection is None):  # Alice or Bob are not connected -> invalid choice
+            print(session.tag + " Alice and Bob are not both connected!", end="\n > ")
             return
         # else: Alice and Bob are connected
+        session.key_length = None
         
-        # prepare (clear) events
-        self.alice_info_event.clear()
-        self.bob_info_event.clear()
-
         # ask to send strings b and b'
-        send(alice_socket, ACT_ALICE.SEND_B)
-        send(bob_socket, ACT_BOB.SEND_B1)
+        requests = [
+            self.request_from_client(session, 'Alice', ACT_ALICE.SEND_B),
+            self.request_from_client(session, 'Bob', ACT_BOB.SEND_B1)
+            ]
 
         # wait until both strings b and b' are arrived
-        self.alice_info_event.wait()
-        self.bob_info_event.wait()
+        if not self.wait_answers(session, requests):
+            session.b = session.b1 = None
+            return
 
-        if self.b is None:  # Bob is not up to date with Alice
-            print("[Server] Alice has made some changes and has not yet sent the new quantum state to Bob!",
+        if session.b is None:  # Bob is not up to date with Alice
+            print(session.tag + " Alice has made some changes and has not yet sent the new quantum state to Bob!",
                   "Make sure to follow all the desired steps in the correct order.", end="\n > ")
             return
 
-        length_b = len(self.b)
-        length_b1 = len(self.b1)
+        length_b = len(session.b)
+        length_b1 = len(session.b1)
         if length_b == 0 or length_b1 == 0:
-            print("[Server] The two strings must have at least one bit!",
+            print(session.tag + " The two strings must have at least one bit!",
                   "Make sure to follow all the desired steps in the correct order.", end="\n > ")
             return
         if (length_b != length_b1):
-            print("[Server] The two strings do not have the same length!",
+            print(session.tag + " The two strings do not have the same length!",
                   "Make sure to follow all the desired steps in the correct order.", end="\n > ")
             return
         
-        # if here: b and b' can be compared -> send b' to Alice and b to Bob
-        send(alice_socket, ACT_ALICE.RECEIVE_B1 + self.b1)
-        send(bob_socket, ACT_BOB.RECEIVE_B + self.b)
-        print("[Server] String b' sent to Alice. String b sent to Bob.", end="\n > ")
+        # if here: b and b' can be compared -> send b' (and the clicks of Bob's detector) to Alice and b to Bob
+        session.key_length = int(sift(session.b, session.b, session.b1, session.clicks)[1].sum())
+        session.qubits_sent = length_b
+        self.metrics.throughput('sifted_key_bits', session.key_length)
+        session.qber = session.reconciled_qber = session.keys_verified = None
+        session.leaked_bits = 0
+        self.send_to_client(alice_connection, ACT_ALICE.RECEIVE_B1, session.codecs['Alice'].encode_detections(session.b1, session.clicks))
+        self.send_to_client(bob_connection, ACT_BOB.RECEIVE_B, session.codecs['Bob'].encode_bits(session.b))
+        print(session.tag + " String b' sent to Alice. String b sent to Bob.", end="\n > ")
 
 
-    def __detect_eavesdropping(self):
-        # prepare sockets
-        alice_socket = self.get_client_socket('Alice')
-        bob_socket = self.get_client_socket('Bob')
+    def __detect_eavesdropping(self, session, bits_count = None):
+        # prepare connections
+        alice_connection = session.get_client_connection('Alice')
+        bob_connection = session.get_client_connection('Bob')
             
-        if (alice_socket is None) or (bob_socket is None):  # Alice or Bob are not connected -> invalid choice
-            print("[Server] Alice and Bob are not both connected!", end="\n > ")
+        if (alice_connection is None) or (bob_connection is None):  # Alice or Bob are not connected -> invalid choice
+            print(session.tag + " Alice and Bob are not both connected!", end="\n > ")
             return
         # else: Alice and Bob are connected
         
         error_sentence = "Before trying to detect Eve: " + ServerActions.SEND_B + ". Also make sure to have followed all the desired steps in the correct order."
-        if (self.b is None) or (self.b1 is None):
-            print("[Server]", error_sentence, end="\n > ")
+        if session.key_length is None:
+            print(session.tag, error_sentence, end="\n > ")
             return
-        len_b = len(self.b)
-        len_b1 = len(self.b1)
-        if (len_b == 0) or (len_b1 == 0):
-            print("[Server] Strings b and b' must have at least one bit!", error_sentence, end="\n > ")
-            return
-        if len_b != len_b1:
-            print("[Server] Strings b and b' do not have the same length!", error_sentence, end="\n > ")
-            return
-        # if here: b and b' are valid
+        # if here: b and b' are valid (exchanged all at once or frame by frame)
         
-        # count how many bits there will be in common key -> if 0: Eve detection will be impossible
-        len_a = 0
-        for i in range(len_b):
-            if (self.b[i] == self.b1[i]):
-                len_a += 1
+        # how many bits there are in common key -> if 0: Eve detection will be impossible
+        len_a = session.key_length
 
         if len_a == 0:
-            print("[Server] Strings b and b' are different bit by bit, for every bit, so the key is empty.",
+            print(session.tag + " Strings b and b' are different bit by bit, for every bit, so the key is empty.",
                   "Try again the whole process.", end="\n > ")
             return
         # if here: the common key will have length == len_a
         
-        print("[Server] Trying to detect Eve... Alice and Bob shared strings b and b' respectively:")
-        print_in_table([
-            ["string b", self.b],
-            ["string b'", self.b1]
-            ])
+        if session.b is not None:
+            print(session.tag + " Trying to detect Eve... Alice and Bob shared strings b and b' respectively:")
+            print_in_table([
+                ["string b", session.b],
+                ["string b'", mark_no_clicks(session.b1, session.clicks)]
+                ])
+        else:  # streaming mode: the strings were exchanged frame by frame
+            print(session.tag + " Trying to detect Eve... Alice and Bob shared strings b and b' frame by frame.")
         print("Alice and Bob have created locally the key from strings a and a',",
               "discarding bits relating to qubits where Bob measured in different basis than Alice prepared.")
-        print(f"Enter the number of bits to share (from the common key), from 1 to {len_a}", end="\n > ")
-        bits_count = input_int(1, len_a, f"Error: enter a valid number! (integer between 1 and {len_a})\n > ")
+        if bits_count is None:
+            print(f"Enter the maximum number of bits to share (from the common key), from 1 to {len_a}", end="\n > ")
+            bits_count = input_int(1, len_a, f"Error: enter a valid number! (integer between 1 and {len_a})\n > ")
+        bits_count = min(bits_count, len_a)
         
-        # calculate and show percentage of success in detection of eavesdropping 
-        p_detect = 1 - (0.75) ** bits_count
+        # calculate and show percentage of success in detection of eavesdropping (if all the bits are shared)
+        p_detect = detection_probability(bits_count)
         p_detect_percent = int(10000 * p_detect) / 100  # precision: xx.xx%
         print(f" > The percentage of success in detection of eavesdropping is {p_detect_percent}%", end="\n > ") 
 
-        # select random positions
-        # at the same time -> create string <key-request>: '?' in desired positions, 'x' in other positions
-        possible_positions = [i for i in range(len_a)]
-        key_request = 'x' * len_a
-        for _ in range(bits_count):
-            i = randint(0, len(possible_positions) - 1)
-            pos = possible_positions.pop(i)
-            key_request = key_request[:pos] + '?' + key_request[pos+1:]
-
-        ## send key-request to Alice and Bob        
-        # prepare (clear) events
-        self.alice_info_event.clear()
-        self.bob_info_event.clear()
-
-        # ask to send key a and a' filled with info
-        send(alice_socket, ACT_ALICE.SEND_SOME_A + key_request)
-        send(bob_socket, ACT_BOB.SEND_SOME_A1 + key_request)
-
-        # wait until both strings a and a' are arrived
-        self.alice_info_event.wait()
-        self.bob_info_event.wait()
-
-        if (self.a is None) or (self.a1 is None):
-            print("[Server] Strings a and/or a' changed!", ServerActions.SEND_B, end="\n > ")
-            return
+        # select random positions (in random order): they are revealed a round at a time,
+        # until the sequential test can accept or abort the key (or all of them are revealed)
+        positions = sample_positions(len_a, bits_count)
+        test = SequentialTest()
+        round_bits = test.min_samples_to_accept()
+        compared = 0
+        with self.metrics.phase('sample') as phase:
+            while (compared < bits_count) and (test.decision is None):
+                chunk = positions[compared:compared + round_bits]
+                compared += len(chunk)
 
-        # check received strings and print conclusion
-        if self.a == self.a1:
-            print("[Server] The checked bits in the strings a and a' are the same (as they should be).",
-                  "Therefore, no eavesdropping by Eve is detected...", sep='\n', end="\n > ")
+                ## send key-request to Alice and Bob (encoded for each client with its codec)
+                # ask to send key a and a' filled with info
+                requests = [
+                    self.request_from_client(session, 'Alice', ACT_ALICE.SEND_SOME_A, session.codecs['Alice'].encode_key_request(len_a, chunk)),
+                    self.request_from_client(session, 'Bob', ACT_BOB.SEND_SOME_A1, session.codecs['Bob'].encode_key_request(len_a, chunk))
+                    ]
+
+                # wait until both strings a and a' are arrived
+                if not self.wait_answers(session, requests):
+                    phase.abort()
+                    return
+
+                if (session.a is None) or (session.a1 is None):
+                    print(session.tag + " Strings a and/or a' changed!", ServerActions.SEND_B, end="\n > ")
+                    phase.abort()
+                    return
+                test.update(count_errors(session.a, session.a1), len(chunk))
+
+        # print estimate and conclusion (the compared bits are public now)
+        session.leaked_bits += compared
+        session.sampled_bits = compared
+        session.sampled_errors = test.errors
+        session.qber = test.estimate().qber
+        self.metrics.set('qber', session.qber, session=session.session_id, estimate='sample')
+        print(session.tag + f" {test.estimate()}")
+        if test.decision is None:
+            print("Not enough shared bits for a decision of the sequential test.", end="\n > ")
+            eve_detected = test.errors > 0
         else:
-            print("[Server] The checked bits in the strings a and a' are NOT the same!",
+            print(f"Sequential test: {test.decision} the key after {compared} shared bits (out of at most {bits_count}).", end="\n > ")
+            eve_detected = test.decision == SequentialTest.ABORT
+        session.eve_detected = bool(eve_detected)
+        if eve_detected:
+            print(session.tag + " The checked bits in the strings a and a' are NOT the same!",
                   "Therefore, eavesdropping by Eve is detected!", sep='\n', end="\n > ")
+        elif test.errors == 0:
+            print(session.tag + " The checked bits in the strings a and a' are the same (as they should be).",
+                  "Therefore, no eavesdropping by Eve is detected...", sep='\n', end="\n > ")
+        else:
+            print(session.tag + " The few different bits in the strings a and a' are compatible with the noise of the channel.",
+                  "Therefore, no eavesdropping by Eve is detected...", sep='\n', end="\n > ")
+        # secret bits that the key can still give, with the parities that the reconciliation should disclose
+        print(session.tag + f" {self.finite_key(session)}", end="\n > ")
+
+
+    def __reconcile(self, session):
+        # prepare connections
+        alice_connection = session.get_client_connection('Alice')
+        bob_connection = session.get_client_connection('Bob')
+            
+        if (alice_connection is None) or (bob_connection is None):  # Alice or Bob are not connected -> invalid choice
+            print(session.tag + " Alice and Bob are not both connected!", end="\n > ")
+            return
+        if not session.key_length:
+            print(session.tag + " There is no common key to correct! Before: " + ServerActions.SEND_B + ".", end="\n > ")
+            return
+
+        # block sizes from the upper bound of the estimated QBER (the tolerated one if Eve detection was not tried)
+        qber = reconciliation_qber(session.sampled_errors, session.sampled_bits)
+        print(session.tag + f" Cascade reconciliation of {session.key_length} bits (block sizes for a QBER of {100 * qber:.2f}%)...", end="\n > ")
+        session.keys_verified = None
+        session.cascade_round_trips = 0
+        session.cascade_leaked_bits = 0
+        session.cascade_corrected = 0
+        # same public seed for Alice and Bob: same permutations of the key in every pass
+        payload = f"{default_source().integers(2**32)}\n{qber}"
+        with self.metrics.phase('reconcile') as phase:
+            self.send_to_client(alice_connection, OP_RECONCILE, payload)
+            request = self.request_from_client(session, 'Bob', OP_RECONCILE, payload)
+            # each round of parities has its own timeout
+            if not self.wait_answers(session, [request], lambda: session.cascade_round_trips):
+                phase.abort()
+                return
+            # both keys hashed with the same public random matrix: different hashes <-> the keys still differ
+            session.verification_hashes = {}
+            seed = str(default_source().integers(2**32))
+            requests = [self.request_from_client(session, name, OP_VERIFY, seed) for name in ('Alice', 'Bob')]
+            if not self.wait_answers(session, requests):
+                phase.abort()
+                return
+
+        session.leaked_bits += session.cascade_leaked_bits + VERIFICATION_BITS
+        alice_hash, bob_hash = session.verification_hashes['Alice'], session.verification_hashes['Bob']
+        session.keys_verified = (len(alice_hash) == len(bob_hash)) and (count_errors(alice_hash, bob_hash) == 0)
+        session.reconciled_qber = session.cascade_corrected / session.key_length  # measured, no more estimated
+        self.metrics.set('qber', session.reconciled_qber, session=session.session_id, estimate='reconciled')
+        self.metrics.inc('parities_disclosed_total', session.cascade_leaked_bits)
+        shannon_limit = session.key_length * binary_entropy(session.cascade_corrected / session.key_length)
+        print(session.tag + f" Cascade completed: {session.cascade_corrected} bits of the string a' corrected,",
+              f"{session.cascade_leaked_bits} parities disclosed in {session.cascade_round_trips} round trips", end="")
+        if shannon_limit > 0:
+            print(f" ({session.cascade_leaked_bits / shannon_limit:.2f} times the Shannon limit).", end="\n > ")
+        else:
+            print(".", end="\n > ")
+        if not session.keys_verified:
+            print(session.tag + " The hashes of the keys a and a' are different: the reconciliation failed, the key is discarded.", end="\n > ")
+
+
+    def __amplify_privacy(self, session):
+        # prepare connections
+        alice_connection = session.get_client_connection('Alice')
+        bob_connection = session.get_client_connection('Bob')
+            
+        if (alice_connection is None) or (bob_connection is None):  # Alice or Bob are not connected -> invalid choice
+            print(session.tag + " Alice and Bob are not both connected!", end="\n > ")
+            return
+        if not session.key_length:
+            print(session.tag + " There is no common key to compress! Before: " + ServerActions.SEND_B + ".", end="\n > ")
+            return
+        if session.keys_verified is False:
+            print(session.tag + " The keys a and a' are still different after the reconciliation: the key is discarded!", end="\n > ")
+            return
+        # QBER of the channel: measured by the reconciliation or estimated by the detection
+        qber = session.reconciled_qber if session.reconciled_qber is not None else session.qber
+        if qber is None:
+            print(session.tag + " The QBER is unknown! Before: " + ServerActions.DETECT_EAVESDROPPING + ".", end="\n > ")
+            return
+
+        # what Eve may know: from the QBER and from every bit disclosed on the public channel, and at most the
+        # finite-key length (the QBER of the sample is not exact)
+        asymptotic_length = secure_key_length(session.key_length, qber, session.leaked_bits)
+        finite_key_bits = self.finite_key(session).key_bits if session.sampled_bits > 0 else None
+        length = amplified_key_length(session.key_length, qber, session.leaked_bits, finite_key_bits)
+        if length == 0:
+            print(session.tag + f" No secret key can be extracted from {session.key_length} bits",
+                  f"(QBER: {100 * qber:.2f}%, {session.leaked_bits} bits disclosed): Eve may know too much!", end="\n > ")
+            if session.sampled_bits > 0:
+                print(session.tag + f" {self.finite_key(session)}", end="\n > ")
+            return
+
+        # Alice chooses the random Toeplitz matrix, then Bob uses the same one
+        with self.metrics.phase('amplify') as phase:
+            request = self.request_from_client(session, 'Alice', OP_AMPLIFY, str(length))
+            if not self.wait_answers(session, [request]):
+                phase.abort()
+                return
+            if session.toeplitz_seed is None:
+                print(session.tag + " Alice has made some changes and has not yet sent the new quantum state to Bob!", end="\n > ")
+                phase.abort()
+                return
+            request = self.request_from_client(session, 'Bob', OP_AMPLIFY, session.codecs['Bob'].encode_bits(session.toeplitz_seed))
+            if not self.wait_answers(session, [request]):
+                phase.abort()
+                return
+        self.metrics.throughput('secret_key_bits', length)
+        session.secret_key_length = length
+        print(session.tag + f" Privacy amplification: {session.key_length} bits compressed to a secret key of {length} bits",
+              f"(asymptotic length {asymptotic_length} bits with the QBER {100 * qber:.2f}% taken as exact;",
+              f"{session.leaked_bits} bits disclosed, seed of {len(session.toeplitz_seed)} bits).", end="\n > ")
+        if session.sampled_bits > 0:
+            print(session.tag + f" {self.finite_key(session)}", end="\n > ")
+        session.toeplitz_seed = None
+
+
+    def finite_key(self, session):
+        # composable finite-key bound of the session: the compared bits are discarded, the parities of the
+        # reconciliation are counted once it is done (before, the expected ones)
+        leak = session.cascade_leaked_bits if session.reconciled_qber is not None else None
+        return FiniteKeyEstimate(session.key_length, session.sampled_bits, session.sampled_errors, leak, session.qubits_sent)
+
+
+    def __set_channel(self, session):
+        # parameters of the channel model applied to every qubit relayed to Bob
+        channel = session.channel
+        print(f"Current channel: {channel}")
+        print("Enter the length of the fiber in km (from 0 to 1000)", end="\n > ")
+        length_km = input_float(0, 1000, "Error: enter a valid number! (from 0 to 1000)\n > ")
+        print("Enter the attenuation of the fiber in dB/km (from 0 to 10, standard fiber: 0.2)", end="\n > ")
+        attenuation = input_float(0, 10, "Error: enter a valid number! (from 0 to 10)\n > ")
+        probabilities = []
+        for name in ["depolarization probability", "bit-flip probability", "detector efficiency", "dark count probability"]:
+            print(f"Enter the {name} (from 0 to 1)", end="\n > ")
+            probabilities.append(input_float(0, 1, "Error: enter a valid number! (from 0 to 1)\n > "))
+        session.channel = ChannelModel(length_km, attenuation, *probabilities)
+        self.metrics.set('qber', session.channel.expected_qber(), session=session.session_id, estimate='channel')
+        print(session.tag + f" Channel towards Bob: {session.channel}",
+              f"(expected clicks: {100 * session.channel.expected_click_rate():.4g}%,",
+              f"expected QBER: {100 * session.channel.expected_qber():.2f}%).", end="\n > ")
 
 
     def handle_input(self):
         while True:
             # input global action from server cli
-            while True:
-                choice = input_int(1, len(self.menu_structure), " > ") - 1
-                if self.is_simulation_running:
-                    print("[Simulation in progress]", end="\n > ")
-                else:
-                    break
+            choice = input_int(1, len(self.menu_structure), " > ") - 1
+
+            if choice == self.menu_structure.index(ServerActions.CLEAR):
+                self.show_menu()
+                continue
+
+            # other actions are performed on one session
+            session = self.__choose_session()
+            if session is None:
+                continue
+            if session.is_simulation_running:
+                print("[Simulation in progress]", end="\n > ")
+                continue
 
             # make Alice and Bob announce the strings b and b' via public classical channel
             if choice == self.menu_structure.index(ServerActions.SEND_B):
                 print(end=" > ")
-                self.__send_b()
+                self.__send_b(session)
                 
             elif choice == self.menu_structure.index(ServerActions.DETECT_EAVESDROPPING):
                 print(end=" > ")
-                self.__detect_eavesdropping()
-                
-            elif choice == self.menu_structure.index(ServerActions.CLEAR):
-                self.show_menu()
+                self.__detect_eavesdropping(session)
+
+            elif choice == self.menu_structure.index(ServerActions.RECONCILE):
+                print(end=" > ")
+                self.__reconcile(session)
+
+            elif choice == self.menu_structure.index(ServerActions.AMPLIFY_PRIVACY):
+                print(end=" > ")
+                self.__amplify_privacy(session)
+
+            elif choice == self.menu_structure.index(ServerActions.SET_CHANNEL):
+                self.__set_channel(session)
+
+
+    def run_script(self):
+        # scripted mode: the rounds of the script on its session, then the results (server_<session>.json)
+        script = self.script
+        results = {'party': 'server', 'session': script['session'], 'script': script, 'rounds': []}
+        clients = ['Alice', 'Bob'] + (['Eve'] if script['eve'] else [])
+        with self.clients_changed:
+            connected = self.clients_changed.wait_for(lambda: (script['session'] in self.sessions) and
+                                                      all(self.sessions[script['session']].clients[client_name] is not None
+                                                          for client_name in clients), script['timeout'])
+            session = self.sessions.get(script['session'])
+        if not connected:
+            results['error'] = f"{', '.join(clients)} did not connect in {script['timeout']} seconds"
+        else:
+            session.channel = channel_from_script(script)
+            # with checkpoints (BB84_CHECKPOINT): the rounds completed by an interrupted run of the script are not run again
+            path = checkpoint_path('server', script['session'])
+            checkpoint = None if path is None else Checkpoint(path)
+            identity = {key: value for key, value in script.items() if key != 'results'}
+            if checkpoint is not None:
+                state = checkpoint.load()
+                if (state is not None) and (state['script'] == identity):
+                    results['rounds'] = state['rounds']
+                    print(session.tag + f" {len(results['rounds'])} rounds already completed (checkpoint).", end="\n > ")
+            for index in range(len(results['rounds']), script['rounds']):
+                round_results = self.__run_script_round(session, index)
+                results['rounds'].append(round_results)
+                if 'error' in round_results:
+                    results['error'] = round_results['error']
+                    break
+                if checkpoint is not None:
+                    checkpoint.commit({'script': identity, 'rounds': results['rounds']})
+            if (checkpoint is not None) and ('error' not in results):
+                checkpoint.remove()
+            # the clients write their results and disconnect
+            self.broadcast(session, OP_SCRIPT_END)
+            with self.clients_changed:
+                self.clients_changed.wait_for(lambda: script['session'] not in self.sessions, REQUEST_TIMEOUT)
+        write_results(script, 'server', results)
+        self.stop()
+
+
+    def __run_script_round(self, session, index):
+        script = self.script
+        start = perf_counter()
+        session.delivered.clear()
+        session.sampled_bits = session.sampled_errors = 0
+        session.eve_detected = session.secret_key_length = None
+        # Alice prepares and sends (or streams) the qubits: the round goes on when Bob has measured them
+        send(session.get_client_connection('Alice'), OP_SCRIPT_ROUND, f"{'stream' if script['stream'] else 'classic'}\n{script['n']}")
+        if not session.delivered.wait(script['timeout']):
+            return {'round': index, 'error': f"the qubits did not reach Bob in {script['timeout']} seconds"}
+        if not script['stream']:
+            self.__send_b(session)
+        if script['sample_bits'] > 0:
+            self.__detect_eavesdropping(session, script['sample_bits'])
+        # Eve detected: the key is discarded, no reconciliation and no amplification
+        aborted = bool(session.eve_detected)
+        if aborted:
+            print(session.tag + " Round aborted: Eve was detected, the key is discarded.", end="\n > ")
+        reconcile = script['reconcile'] and not aborted
+        if reconcile:
+            self.__reconcile(session)
+            # keys still different after the reconciliation: discarded too
+            aborted = session.keys_verified is False
+        if script['amplify'] and not aborted:
+            self.__amplify_privacy(session)
+        return {
+            'round': index,
+            'sifted_key_bits': session.key_length,
+            'sampled_bits': session.sampled_bits,
+            'qber': session.qber,
+            'eve_detected': session.eve_detected,
+            'aborted': aborted,
+            'reconciled_qber': session.reconciled_qber if reconcile else None,
+            'corrected_bits': session.cascade_corrected if reconcile else None,
+            'parities_disclosed': session.cascade_leaked_bits if reconcile else None,
+            'round_trips': session.cascade_round_trips if reconcile else None,
+            'keys_verified': session.keys_verified if reconcile else None,
+            'disclosed_bits': session.leaked_bits,
+            'secret_key_bits': session.secret_key_length,
+            'finite_key_bits': self.finite_key(session).key_bits if session.sampled_bits > 0 else None,
+            'seconds': perf_counter() - start
+            }
+
+
+    def stop(self):
+        # no more connections: start() returns
+        self.stopped = True
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)  # wakes up accept()
+        except OSError:
+            pass
+        self.socket.close()
+
+
+    def __choose_session(self):
+        # session on which the global action is performed: asked only if more than one is active
+        sessions = self.get_sessions()
+        if len(sessions) == 0:
+            print("[Server] Alice and Bob are not both connected!", end="\n > ")
+            return None
+        if len(sessions) == 1:
+            return sessions[0]
+        print("Select the session:")
+        print_menu_options([session.session_id for session in sessions])
+        print("----", end="\n > ")
+        return sessions[input_int(1, len(sessions), " > ") - 1]
             
 
-    def handle_client(self, client_name, client_info):
+    def handle_client(self, session_id, client_name, client_info, offered_codecs):
+        client_connection = client_info[0]
+        session = self.register_client(session_id, client_name, client_info, offered_codecs)
+        if session is None:
+            return
+
+        # now handle client
+        while True:
+            try:
+                request_type, request_info = receive(client_connection)
+            except OSError:
+                # client disconnected (also ConnectionResetError and BrokenPipeError)
+                self.unregister_client(session, client_name)
+                break
+            # messages to the other clients: send_to_client, a receiver that disconnected does not stop this client
+            self.dispatch_request(session, client_name, request_type, request_info)
+
+
+    def register_client(self, session_id, client_name, client_info, offered_codecs):
+        # returns the session of the client, None if the connection is rejected
         # use mutex: prevents concurrent access and helps maintain the integrity of the data structures for class variables
         with self.lock:
-            client_socket, client_address = client_info
+            client_connection, client_address = client_info
+            session = self.sessions.get(session_id, BB84Session(session_id))
             # reject connection if client of the same type is already connected
             try:
-                if self.clients[client_name] is not None:
-                    send(client_socket, f"{client_name} is already connected!")
-                    client_socket.close()
-                    return
+                if session.clients[client_name] is not None:
+                    send(client_connection, OP_REJECTED, f"{client_name} is already connected!")
+                    client_connection.close()
+                    return None
             except KeyError:
                 print(f"[Server] {client_name} is not a valid client!", end='\n > ')
-                return
-            # else store new client and tell client it's connected
-            send(client_socket, TXT_CLIENT_CONNECTED)
-            self.clients[client_name] = client_info
+                send(client_connection, OP_REJECTED, f"{client_name} is not a valid client!")
+                client_connection.close()
+                return None
+            # else store new client (and new session) and tell client it's connected
+            codec = negotiate_codec(offered_codecs)
+            send(client_connection, OP_CLIENT_CONNECTED, codec.name)
+            session.codecs[client_name] = codec
+            session.clients[client_name] = client_info
+            self.sessions[session_id] = session
             # if Alice and Bob are connected: send "ready" message to all connected clients
-            if (self.clients['Alice'] is not None) and (self.clients['Bob'] is not None):
-                self.broadcast(TXT_READY)
+            if session.is_ready():
+                self.broadcast(session, OP_READY)
+            self.clients_changed.notify_all()
             # show server menu
             self.show_menu()
+        return session
 
-        # now handle client
-        
-        # client that asks to wait is the one that must ask to continue; it is called "client-in-simulation"
-        client_in_simulation = False
-                        
-        while True:
-            try:
-                request_type = receive(client_socket)
-                if not request_type:  # handle disconnection
-                    raise ConnectionResetError
-                else:
-                    # manage direct messages
-                    if request_type == TXT_WAIT:
-                        self.broadcast(TXT_WAIT)
-                        client_in_simulation = True
-                        self.is_simulation_running = True
-                    elif request_type == TXT_CONTINUE:
-                        self.broadcast(TXT_CONTINUE)
-                        client_in_simulation = False
-                        self.is_simulation_running = False
-
-                    else:
-                        # get info parameters about request as string
-                        request_info = receive(client_socket)
-                        if not request_info:  # handle disconnection
-                            raise ConnectionResetError
-                        if request_info == '.':
-                            request_info = ''
-                        # handle request
-                        if client_name == 'Alice':
-                            self.alice_request(request_type, request_info)
-                        elif client_name == 'Bob':
-                            self.bob_request(request_type, request_info)
-                        else:  # client_name == 'Eve'
-                            self.eve_request(request_type, request_info)
-                    
-            except ConnectionResetError:
-                # client disconnected
-                with self.lock:
-                    self.clients[client_name] = None
-                client_socket.close()
-                # if was client-in-simulation: make all continue again
-                self.broadcast(TXT_CONTINUE)
-                # if this disconnection was Alice or Bob: not all necessary clients are connected -> send "not ready" message to all
-                if (client_name == 'Alice') or (client_name == 'Bob'):
-                    self.broadcast(TXT_NOT_READY)
-                # show server menu
-                self.show_menu()
 
-                break
+    def dispatch_request(self, session, client_name, request_type, request_info):
+        # manage direct messages
+        # (client that asks to wait is the one that must ask to continue; it is called "client-in-simulation")
+        if request_type == OP_WAIT:
+            self.broadcast(session, OP_WAIT)
+            session.is_simulation_running = True
+        elif request_type == OP_CONTINUE:
+            self.broadcast(session, OP_CONTINUE)
+            session.is_simulation_running = False
+            if client_name == 'Bob':  # Bob continues when he has measured the qubits (or sifted the stream)
+                session.delivered.set()
+
+        else:
+            # handle request
+            handler = self.request_handlers.get((client_name, request_type))
+            if handler is not None:
+                handler(session, request_info)
 
 
-    def broadcast(self, message):
-        # send message to all connected clients
-        connected_clients = self.get_connected_clients()
+    def unregister_client(self, session, client_name):
+        if self.trace is not None:
+            self.trace.closed(client_peer(client_name, session.session_id))
+        with self.lock:
+            client_connection = session.clients[client_name][0]
+            session.clients[client_name] = None
+            # session without clients: removed from the registry
+            if len(session.get_connected_clients()) == 0:
+                self.sessions.pop(session.session_id, None)
+            self.clients_changed.notify_all()
+        client_connection.close()
+        self.cancel_requests(session, client_name)
+        # if was client-in-simulation: make all continue again
+        session.is_simulation_running = False
+        self.broadcast(session, OP_CONTINUE)
+        # if this disconnection was Alice or Bob: not all necessary clients are connected -> send "not ready" message to all
+        if (client_name == 'Alice') or (client_name == 'Bob'):
+            self.broadcast(session, OP_NOT_READY)
+        # show server menu
+        self.show_menu()
+
+
+    def broadcast(self, session, opcode, payload=b''):
+        # send message to all connected clients of the session
+        connected_clients = session.get_connected_clients()
         for connected_client in connected_clients:
-            send(self.clients[connected_client][0], message)
+            self.send_to_client(session.clients[connected_client][0], opcode, payload)
 
 
-    def get_connected_clients(self):
-        # return names of the connected clients (in list)
-        return [client_type for client_type, client_info in self.clients.items() if client_info is not None]
+    def get_sessions(self):
+        # active sessions, sorted by id
+        with self.lock:
+            return sorted(self.sessions.values(), key=lambda session: session.session_id)
     
 
     def show_menu_head(self):
         # show the head of the menu in the console
         clear()
         print(f"[Server active on {self.host}:{self.port}]")
+        sessions = self.get_sessions()
+        if len(sessions) == 0:  # nobody is connected: show the (empty) default session
+            sessions = [BB84Session(DEFAULT_SESSION)]
         # show clients' status in a nice box
         lines = []
-        for client_name, client_info in self.clients.items():
-            if client_info is None:
-                lines.append(f"{client_name} is NOT connected")
-            else:
-                lines.append(f"{client_name} is connected: {client_info[1]}")
+        for session in sessions[:self.MAX_SESSIONS_SHOWN]:
+            prefix = '' if session.session_id == DEFAULT_SESSION else f"[{session.session_id}] "
+            for client_name, client_info in session.clients.items():
+                if client_info is None:
+                    lines.append(f"{prefix}{client_name} is NOT connected")
+                else:
+                    lines.append(f"{prefix}{client_name} is connected: {client_info[1]}")
+        if len(sessions) > self.MAX_SESSIONS_SHOWN:
+            lines.append(f"... and other {len(sessions) - self.MAX_SESSIONS_SHOWN} sessions")
         print_in_box(lines)
 
 
@@ -398,10 +1042,25 @@ class BB84Server:
         print("----", end='\n > ')
 
 
+def parse_hello(hello):
+    # hello message: client name, then (one per line) the codecs offered by the client and the session id
+    lines = hello.decode('utf-8').split('\n')
+    client_name = lines[0]
+    offered_codecs = lines[1].split(',') if len(lines) > 1 and lines[1] else []
+    session_id = lines[2] if len(lines) > 2 and lines[2] else DEFAULT_SESSION
+    return client_name, offered_codecs, session_id
+
+def client_peer(client_name, session_id):
+    # name of a client connection in the trace: e.g. Alice@default
+    return f"{client_name}@{session_id}"
+
+
 if __name__ == "__main__":
     
+    # optional argument --script file: scripted mode (see BB84script.py)
+    script, _ = script_from_arguments(sys.argv[1:])
     set_title("Server")
-    server = BB84Server()
+    server = BB84Server(script)
     server.start()
 
 
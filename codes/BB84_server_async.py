@@ -0,0 +1,175 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84_server_async.py - version 1.0
+
+# Same server as BB84_server.py (same menu, same protocol, same clients), but all the clients are served
+# by one asyncio event loop instead of one thread each: reads and writes never block the other clients,
+# and a client that stops reading is disconnected instead of stalling the server.
+# Only the console (input()) keeps its own thread.
+
+import sys
+import asyncio
+import threading
+from CUlib import *
+from BB84_server import BB84Server, parse_hello, client_peer
+from BB84metrics import default_metrics
+from BB84script import script_from_arguments
+
+
+"""framed messages over asyncio streams: same frames and same send() interface of CUlib.Connection"""
+class AsyncConnection:
+    def __init__(self, reader, writer, loop, loop_thread_id):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread_id = loop_thread_id
+        self.peer = None  # name of the client (and its session), in the trace
+        self.pending = False  # frames written since the last flush
+        self.on_queued = None  # function(): frames written from another thread, to be flushed by the event loop
+
+    async def receive(self):
+        try:
+            header = await self.reader.readexactly(FRAME_HEADER.size)
+            length, opcode = FRAME_HEADER.unpack(header)
+            payload = await self.reader.readexactly(length)
+        except asyncio.IncompleteReadError:  # connection closed by the other side
+            raise ConnectionResetError
+        count_message('received', opcode, payload, self.peer)
+        return opcode, payload
+
+    def send(self, opcode, payload=b''):
+        # non-blocking: the frame is queued in the stream buffer, flushed by the event loop
+        if type(payload) is str:
+            payload = payload.encode('utf-8')
+        count_message('sent', opcode, payload, self.peer)
+        frame = FRAME_HEADER.pack(len(payload), opcode) + payload
+        if self.__in_loop_thread():  # flushed after the request being dispatched
+            self.writer.write(frame)
+            self.pending = True
+        else:  # e.g. console thread: hand the frame to the event loop
+            self.loop.call_soon_threadsafe(self.__write_queued, frame)
+
+    def queued_bytes(self):
+        # bytes written but not sent yet
+        return self.writer.transport.get_write_buffer_size()
+
+    async def drain(self):
+        self.pending = False
+        await self.writer.drain()
+
+    def close(self):
+        if self.__in_loop_thread():
+            self.writer.close()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+    def __write_queued(self, frame):
+        self.writer.write(frame)
+        self.pending = True
+        if self.on_queued is not None:
+            self.on_queued()
+
+    def __in_loop_thread(self):
+        return threading.get_ident() == self.loop_thread_id
+
+
+class BB84AsyncServer(BB84Server):
+    def __init__(self, script = None):
+        super().__init__(script)
+        self.loop = None
+        self.loop_thread_id = None
+        self.stop_event = None  # set when the script is completed (scripted mode)
+
+    def start(self):
+        asyncio.run(self.serve())
+
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.stop_event = asyncio.Event()
+        server = await asyncio.start_server(self.accept_client, self.host, self.port, backlog=LISTEN_BACKLOG)
+        self.show_menu()
+        # console stays blocking (input()), in its own daemon thread
+        self.tr_handle_input.daemon = True
+        self.tr_handle_input.start()
+        async with server:
+            await server.start_serving()
+            await self.stop_event.wait()
+
+
+    def stop(self):
+        # scripted mode completed: the event loop ends
+        self.stopped = True
+        self.loop.call_soon_threadsafe(self.stop_event.set)
+
+
+    async def accept_client(self, reader, writer):
+        client_connection = AsyncConnection(reader, writer, self.loop, self.loop_thread_id)
+        client_address = f"{writer.get_extra_info('peername')}"
+        # get client name (can be Alice, Bob or Eve) and offered codecs
+        try:
+            opcode, hello = await asyncio.wait_for(client_connection.receive(), REQUEST_TIMEOUT)
+        except (ConnectionResetError, asyncio.TimeoutError):
+            writer.close()
+            return
+        if opcode != OP_HELLO:
+            writer.close()
+            return
+        client_name, offered_codecs, session_id = parse_hello(hello)
+        client_connection.peer = client_peer(client_name, session_id)
+
+        session = self.register_client(session_id, client_name, (client_connection, client_address), offered_codecs)
+        if session is None:
+            return
+        client_connection.on_queued = lambda: self.loop.create_task(self.flush(session, client_name))
+
+        # now handle client
+        while True:
+            try:
+                request_type, request_info = await client_connection.receive()
+            except (ConnectionResetError, ConnectionError):
+                # client disconnected
+                self.unregister_client(session, client_name)
+                break
+            self.dispatch_request(session, client_name, request_type, request_info)
+            # every client that received frames (e.g. qubits relayed to Eve or Bob), not only the requester
+            # (a client that does not read is disconnected by flush, not this one)
+            await self.flush_all(session, [name for name in session.get_connected_clients() if session.clients[name][0].pending])
+
+
+    async def flush(self, session, client_name):
+        # wait until the frames queued for a client are written: a client that does not read is disconnected
+        client_info = session.clients.get(client_name)
+        if client_info is None:
+            return
+        default_metrics().set('send_queue_bytes', client_info[0].queued_bytes(), session=session.session_id, client=client_name)
+        try:
+            await asyncio.wait_for(client_info[0].drain(), REQUEST_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError):
+            print(f"{session.tag} {client_name} is not reading its messages: disconnected.", end="\n > ")
+            client_info[0].close()
+
+
+    async def flush_all(self, session, client_names):
+        await asyncio.gather(*(self.flush(session, client_name) for client_name in client_names))
+
+
+    def broadcast(self, session, opcode, payload=b''):
+        # queue the message for all connected clients of the session at once, then flush them concurrently
+        connected_clients = session.get_connected_clients()
+        for connected_client in connected_clients:
+            self.send_to_client(session.clients[connected_client][0], opcode, payload)
+        if threading.get_ident() == self.loop_thread_id:
+            self.loop.create_task(self.flush_all(session, connected_clients))
+        else:
+            asyncio.run_coroutine_threadsafe(self.flush_all(session, connected_clients), self.loop)
+
+
+if __name__ == "__main__":
+
+    # optional argument --script file: scripted mode (see BB84script.py)
+    script, _ = script_from_arguments(sys.argv[1:])
+    set_title("Server")
+    server = BB84AsyncServer(script)
+    server.start()
@@ -0,0 +1,437 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84_simulation.py - version 1.0
+
+# Headless simulation: the whole protocol in a single process, without sockets and without input()
+# usage as library:  from BB84_simulation import simulate;  result = simulate(10**6, eve=True, sample_bits=100)
+# usage as script:   python BB84_simulation.py n [--eve] [--sample-bits k [--sequential]] [--reconcile] [--amplify] [--stream [--frame-size f]]
+#                    [--length-km l] [--attenuation dB] [--depolarization p] [--bit-flip p] [--detector-efficiency e] [--dark-count p]
+#                    [--strategy {intercept-resend,fixed-basis,breidbart,pns}] [--intercept p] [--mean-photons mu]
+#                    [--rng {pcg64,philox,crypto}] [--seed s] [--decoy [--intensities mu nu 0] [--decoy-probabilities ps pd pv]]
+#                    [--distances km km ...]  (decoy-state key rate at each length of the fiber, streamed)
+#                    [--key-pool directory]  (with --amplify: secret keys appended to the pools Alice_headless, Bob_headless)
+#                    [--checkpoint path [--checkpoint-frames k]]  (with --stream: an interrupted run goes on from its last checkpoint)
+# streaming:         for key_alice, key_bob in stream_frames(10**9): ...  (one frame in memory at a time)
+
+import argparse
+import numpy as np
+from time import perf_counter
+from BB84lib import *
+from BB84qber import QBEREstimate, sequential_comparison, count_errors, reconciliation_qber, QBER_ACCEPT
+from BB84cascade import reconcile
+from BB84privacy import amplified_key_length, toeplitz_seed, toeplitz_hash, verification_hash, VERIFICATION_BITS
+from BB84finitekey import FiniteKeyEstimate
+from BB84channel import ChannelModel
+from BB84attacks import InterceptResendAttack, STRATEGIES
+from BB84random import KINDS, PARTIES, party_sources, default_source
+from BB84decoy import DecoySource, DecoyStatistics, SIGNAL, INTENSITIES, PROBABILITIES
+from BB84keypool import KeyPool, client_pool_path
+from BB84metrics import default_metrics
+from BB84checkpoint import Checkpoint, CHECKPOINT_FRAMES
+from CUlib import print_in_table, FRAME_QUBITS
+
+
+class SimulationResult:
+    def __init__(self, n, eve, intercept = 1.0, noise = 0.0, channel = None, strategy = None, mean_photons = None):
+        self.n = n                      # number of qubits sent by Alice
+        self.eve = eve                  # True if Eve eavesdropped
+        self.intercept = intercept      # fraction of the qubits intercepted by Eve
+        self.strategy = strategy        # attack of Eve (None: no Eve)
+        self.mean_photons = mean_photons  # mean photons per pulse of a weak coherent source (None: single photons)
+        self.decoy = None               # decoy-state estimates: yields, error rates, key rate (None: no decoy states)
+        self.noise = noise              # probability that the channel flips a bit measured by Bob
+        self.channel = channel          # ChannelModel towards Bob (None: perfect channel)
+        self.clicks = n                 # qubits detected by Bob
+        self.key_alice = ""             # string a after sifting
+        self.key_bob = ""               # string a' after sifting
+        self.key_errors = 0             # different bits in the whole sifted keys (known only in a simulation)
+        self.eve_agreement = None       # fraction of the sifted key guessed right by Eve (None: no Eve)
+        self.eve_known_bits = 0         # bits of the sifted key known exactly by Eve (photon-number splitting)
+        self.sample_positions = []      # positions of the key compared to detect Eve
+        self.sample_errors = 0          # how many compared bits are different
+        self.qber = None                # error rate on the compared bits (None if nothing compared)
+        self.qber_interval = (0.0, 1.0) # confidence interval of the QBER (95%)
+        self.decision = None            # sequential test: 'accept', 'abort' or None (not used or undecided)
+        self.p_detect = 0.0             # ideal-case probability of detecting Eve with this sample
+        self.eve_detected = False
+        self.reconciliation = None      # Cascade report: corrected bits, leaked bits, round trips (None if not run)
+        self.finite_key = None          # FiniteKeyEstimate of the compared bits (None if nothing compared)
+        self.secret_key_alice = None    # keys after privacy amplification (None if not run)
+        self.secret_key_bob = None
+        self.timings = {}               # seconds spent in each phase
+
+    @property
+    def sifted_length(self):
+        return len(self.key_alice)
+
+    @property
+    def keys_match(self):
+        return self.key_alice == self.key_bob
+
+    def as_dict(self):
+        return {
+            'n': self.n,
+            'eve': self.eve,
+            'intercept': self.intercept,
+            'strategy': None if self.strategy is None else str(self.strategy),
+            'mean_photons': self.mean_photons,
+            'noise': self.noise,
+            'channel': None if self.channel is None else self.channel.as_dict(),
+            'clicks': self.clicks,
+            'sifted_length': self.sifted_length,
+            'key_errors': self.key_errors,
+            'eve_agreement': self.eve_agreement,
+            'eve_known_bits': self.eve_known_bits,
+            'sample_bits': len(self.sample_positions),
+            'sample_errors': self.sample_errors,
+            'qber': self.qber,
+            'qber_interval': self.qber_interval,
+            'decision': self.decision,
+            'p_detect': self.p_detect,
+            'eve_detected': self.eve_detected,
+            'keys_match': self.keys_match,
+            'decoy': self.decoy,
+            'reconciliation': self.reconciliation,
+            'finite_key_length': None if self.finite_key is None else self.finite_key.key_bits,
+            'secret_length': None if self.secret_key_alice is None else len(self.secret_key_alice),
+            'secret_keys_match': None if self.secret_key_alice is None else self.secret_key_alice == self.secret_key_bob,
+            'timings': dict(self.timings)
+            }
+
+
+def simulate(n, eve=False, sample_bits=None, sequential=False, reconcile_keys=False, amplify=False,
+             intercept=1.0, noise=0.0, channel=None, strategy=None, mean_photons=None, decoy=None, rng=None):
+    # intercept: fraction of the qubits intercepted by Eve (if eve); noise: bit-flip probability of the channel
+    # channel: ChannelModel between Eve and Bob (loss, depolarization, detector); noise is added to its bit-flip
+    # strategy: attack of Eve (if eve), from BB84attacks (None: intercept-resend of the intercept fraction)
+    # mean_photons: photons per pulse of Alice's weak coherent source, on average (None: single-photon source)
+    # decoy: DecoySource (signal, decoy and vacuum intensities): the key comes from the signal pulses only
+    # rng: RandomSource (or numpy Generator) used for every random choice (None: default source),
+    # or one source for each party, from BB84random.party_sources(); seeded <-> reproducible result
+    # sample_bits: how many bits of the common key are compared to detect Eve
+    # (None: no comparison; more than the key length: the whole key is compared)
+    # sequential: compare them a round at a time and stop as soon as the sequential test decides
+    # reconcile_keys: correct Bob's key with Cascade (block sizes from the upper bound of the estimated QBER), then
+    # compare a hash of both keys: if they still differ, the key is discarded (no amplification)
+    # amplify: compress both keys with a random Toeplitz matrix, to the length allowed by QBER and disclosed bits
+    # (at most the finite-key length, when bits were compared)
+    if eve and strategy is None:
+        strategy = InterceptResendAttack(intercept)
+    result = SimulationResult(n, eve, intercept, noise, channel, strategy if eve else None, mean_photons)
+    channel = noisy_channel(channel, noise)
+    timings = result.timings
+    streams = party_streams(rng)
+
+    # Alice: generate two random strings of n-bits: a, b
+    start = perf_counter()
+    a = random_bits(n, streams['Alice'])
+    b = random_bits(n, streams['Alice'])
+    timings['generate'] = perf_counter() - start
+
+    # Alice: prepare n qubits accordingly to a and b
+    start = perf_counter()
+    qubits = QubitBatch()
+    qubits.set_from_a_and_basis(a, BasisBatch.from_b(b))
+    photons = None if mean_photons is None else random_photons(n, mean_photons, streams['Alice'])
+    if decoy is not None:
+        classes, photons = decoy.emit(n, streams['Alice'])
+    timings['prepare'] = perf_counter() - start
+
+    # quantum channel: Eve (if present) attacks the pulses with her strategy
+    start = perf_counter()
+    interception = None
+    if eve:
+        interception = strategy.attack(qubits, photons, streams['Eve'])
+        qubits = interception.qubits
+        photons = interception.photons
+    timings['transmit'] = perf_counter() - start
+
+    # Bob: measure every qubit that reaches him in a random basis (positions without click are announced)
+    start = perf_counter()
+    qubits, clicks = channel.transmit(qubits, streams['channel'], photons)
+    b1 = random_bits(n, streams['Bob'])
+    a1 = qubits.measure(BasisBatch.from_b(b1), random_bits(n, streams['Bob']))
+    result.clicks = int(clicks.sum())
+    timings['measure'] = perf_counter() - start
+
+    # Alice and Bob announce b and b', then discard qubits measured in different basis (or not detected)
+    start = perf_counter()
+    key_alice, same_basis = sift(a, b, b1, clicks)
+    key_bob, _ = sift(a1, b1, b, clicks)
+    if decoy is not None:
+        # Alice announces the intensity of every pulse: statistics of each class, key from the signals
+        statistics = DecoyStatistics(decoy)
+        statistics.update(classes, clicks, same_basis, key_alice != key_bob)
+        result.decoy = statistics.estimate()
+        signal = classes[same_basis] == SIGNAL
+        key_alice, key_bob = key_alice[signal], key_bob[signal]
+        same_basis &= classes == SIGNAL
+    result.key_errors = count_errors(key_alice, key_bob)
+    if interception is not None and len(key_alice) > 0:
+        result.eve_agreement = 1 - count_errors(key_alice, interception.guesses[same_basis]) / len(key_alice)
+        result.eve_known_bits = int(interception.known[same_basis].sum())
+    timings['sift'] = perf_counter() - start
+
+    # compare some random bits of the common key to detect Eve
+    start = perf_counter()
+    if sample_bits is not None and len(key_alice) > 0:
+        bits_count = min(sample_bits, len(key_alice))
+        positions = sample_positions(len(key_alice), bits_count, streams['server'])
+        if sequential:
+            test, positions = sequential_comparison(key_alice, key_bob, positions)
+            result.decision = test.decision
+        estimate = QBEREstimate(count_errors(key_alice[positions], key_bob[positions]), len(positions))
+        result.sample_positions = positions
+        result.sample_errors = estimate.errors
+        result.qber = estimate.qber
+        result.qber_interval = (estimate.low, estimate.high)
+        result.p_detect = detection_probability(len(positions))
+        result.eve_detected = (result.decision == 'abort') if result.decision is not None else result.sample_errors > 0
+    timings['detect'] = perf_counter() - start
+
+    # Bob corrects his key with the parities of blocks of Alice's key, then both compare a hash of their keys
+    if reconcile_keys:
+        start = perf_counter()
+        qber = reconciliation_qber(result.sample_errors, len(result.sample_positions))
+        cascade = reconcile(key_alice, key_bob, qber, int(streams['server'].integers(2**32)))
+        key_bob = cascade.key
+        seed = int(streams['server'].integers(2**32))
+        result.reconciliation = {
+            'corrected': cascade.corrected,
+            'leaked_bits': cascade.leaked_bits,
+            'round_trips': cascade.round_trips,
+            'efficiency': cascade.efficiency,
+            'verified': bool(np.array_equal(verification_hash(key_alice, seed), verification_hash(key_bob, seed)))
+            }
+        timings['reconcile'] = perf_counter() - start
+
+    # composable finite-key bound: the compared bits are discarded, the parities of Cascade are counted (or expected)
+    if len(result.sample_positions) > 0:
+        leak = None if result.reconciliation is None else result.reconciliation['leaked_bits']
+        result.finite_key = FiniteKeyEstimate(len(key_alice), len(result.sample_positions), result.sample_errors, leak, n)
+
+    # privacy amplification: what Eve may know comes from the QBER and from every disclosed bit
+    # (keys still different after the reconciliation are discarded)
+    if amplify and (result.reconciliation is None or result.reconciliation['verified']):
+        start = perf_counter()
+        leaked_bits = len(result.sample_positions)
+        if result.reconciliation is not None:
+            leaked_bits += result.reconciliation['leaked_bits'] + VERIFICATION_BITS
+            qber = result.reconciliation['corrected'] / len(key_alice) if len(key_alice) > 0 else 0.0
+        else:
+            qber = QBER_ACCEPT if result.qber is None else result.qber
+        # the statistical fluctuations of the sample count too: at most the finite-key length
+        finite_key_bits = None if result.finite_key is None else result.finite_key.key_bits
+        seed = toeplitz_seed(len(key_alice), amplified_key_length(len(key_alice), qber, leaked_bits, finite_key_bits), streams['Alice'])
+        result.secret_key_alice = bits_to_string(toeplitz_hash(key_alice, seed))
+        result.secret_key_bob = bits_to_string(toeplitz_hash(key_bob, seed))
+        timings['amplify'] = perf_counter() - start
+
+    result.key_alice = bits_to_string(key_alice)
+    result.key_bob = bits_to_string(key_bob)
+    record_metrics(result)
+    return result
+
+
+def record_metrics(result):
+    # phases, key bits and QBER of a run in the metrics of this process (phase 'detect' <-> 'sample')
+    metrics = default_metrics()
+    for phase, seconds in result.timings.items():
+        metrics.observe('phase_seconds', seconds, phase='sample' if phase == 'detect' else phase)
+    metrics.throughput('sifted_key_bits', result.sifted_length)
+    if result.qber is not None:
+        metrics.set('qber', result.qber, estimate='sample')
+    if result.secret_key_alice is not None:
+        metrics.throughput('secret_key_bits', len(result.secret_key_alice))
+
+
+def party_streams(rng):
+    # random source of each party: rng can be one source for all of them, or one for each party
+    if isinstance(rng, dict):
+        return rng
+    return dict.fromkeys(PARTIES, default_source() if rng is None else rng)
+
+
+def noisy_channel(channel, noise):
+    # channel model of a simulation: the given one (perfect if None), plus noise as bit-flip probability
+    if channel is None:
+        channel = ChannelModel()
+    if noise > 0:
+        channel = ChannelModel(**dict(channel.as_dict(), bit_flip=1 - (1 - channel.bit_flip) * (1 - noise)))
+    return channel
+
+
+def stream_frames(n, eve=False, frame_size=FRAME_QUBITS, channel=None, rng=None, strategy=None, decoy=None, first_frame=0,
+                  statistics=None):
+    # same protocol of simulate(), frame by frame: yields the sifted keys (key_alice, key_bob) of each frame
+    # decoy: DecoySource (None: single photons); statistics: DecoyStatistics of the source, updated with every frame
+    # first_frame: frames already done (resumed run: the random sources are in their state after them)
+    channel = noisy_channel(channel, 0.0)
+    if eve and strategy is None:
+        strategy = InterceptResendAttack()
+    streams = party_streams(rng)
+    for start in range(first_frame * frame_size, n, frame_size):
+        size = min(frame_size, n - start)
+        a = random_bits(size, streams['Alice'])
+        b = random_bits(size, streams['Alice'])
+        qubits = QubitBatch()
+        qubits.set_from_a_and_basis(a, BasisBatch.from_b(b))
+        photons = None
+        if decoy is not None:
+            classes, photons = decoy.emit(size, streams['Alice'])
+        if eve:
+            interception = strategy.attack(qubits, photons, streams['Eve'])
+            qubits, photons = interception.qubits, interception.photons
+        qubits, clicks = channel.transmit(qubits, streams['channel'], photons)
+        b1 = random_bits(size, streams['Bob'])
+        a1 = qubits.measure(BasisBatch.from_b(b1), random_bits(size, streams['Bob']))
+        key_alice, same_basis = sift(a, b, b1, clicks)
+        key_bob, _ = sift(a1, b1, b, clicks)
+        if decoy is not None:
+            if statistics is not None:
+                statistics.update(classes, clicks, same_basis, key_alice != key_bob)
+            signal = classes[same_basis] == SIGNAL
+            key_alice, key_bob = key_alice[signal], key_bob[signal]
+        yield key_alice, key_bob
+
+
+def run_stream(n, eve=False, frame_size=FRAME_QUBITS, channel=None, rng=None, strategy=None, decoy=None,
+               checkpoint=None, checkpoint_frames=CHECKPOINT_FRAMES):
+    # totals of a streamed simulation: the keys are counted and compared, not stored
+    # decoy: DecoySource (None: single photons)
+    # checkpoint: path of a checkpoint (BB84checkpoint.py): totals and random sources are saved every checkpoint_frames
+    # frames, and a run with the same arguments goes on from the last checkpoint (removed when the run is completed)
+    start = perf_counter()
+    statistics = None if decoy is None else DecoyStatistics(decoy)
+    streams = party_streams(rng)
+    totals = {'frame': 0, 'sifted_length': 0, 'errors': 0, 'first_key_bits': None, 'seconds': 0.0}
+    if checkpoint is not None:
+        checkpoint = Checkpoint(checkpoint)
+        parameters = stream_parameters(n, eve, frame_size, channel, strategy, decoy)
+        state = checkpoint.load()
+        if state is not None:
+            if state['parameters'] != parameters:
+                raise ValueError(f"the checkpoint '{checkpoint.path}' belongs to a run with other arguments")
+            totals = state['totals']
+            for party, source_state in state['random'].items():
+                streams[party].set_state(source_state)
+            if statistics is not None:
+                statistics.set_state(state['decoy'])
+    resumed_seconds = totals['seconds']
+
+    for key_alice, key_bob in stream_frames(n, eve, frame_size, channel, streams, strategy, decoy, totals['frame'], statistics):
+        if totals['first_key_bits'] is None:
+            totals['first_key_bits'] = perf_counter() - start
+        totals['sifted_length'] += len(key_alice)
+        totals['errors'] += int((key_alice != key_bob).sum())
+        totals['frame'] += 1
+        if (checkpoint is not None) and (totals['frame'] % checkpoint_frames == 0):
+            totals['seconds'] = resumed_seconds + perf_counter() - start
+            # one state for each source (the parties may share one)
+            sources = {id(source): party for party, source in reversed(list(streams.items()))}
+            checkpoint.commit({
+                'parameters': parameters,
+                'totals': totals,
+                'random': {party: streams[party].get_state() for party in sources.values()},
+                'decoy': None if statistics is None else statistics.get_state()
+                })
+    if checkpoint is not None:
+        checkpoint.remove()
+    sifted_length, errors = totals['sifted_length'], totals['errors']
+    return {
+        'n': n,
+        'eve': eve,
+        'frame_size': frame_size,
+        'sifted_length': sifted_length,
+        'errors': errors,
+        'qber': errors / sifted_length if sifted_length > 0 else None,
+        'decoy': None if statistics is None else statistics.estimate(),
+        'time to first key bits (s)': totals['first_key_bits'],
+        'total time (s)': resumed_seconds + perf_counter() - start
+        }
+
+
+def stream_parameters(n, eve, frame_size, channel, strategy, decoy):
+    # arguments of a streamed run that must be the same to resume it from a checkpoint (JSON)
+    return {
+        'n': n,
+        'eve': eve,
+        'frame_size': frame_size,
+        'channel': noisy_channel(channel, 0.0).as_dict(),
+        'strategy': None if not eve else str(strategy or InterceptResendAttack()),
+        'decoy': None if decoy is None else str(decoy)
+        }
+
+
+def decoy_key_rates(distances, n, channel=None, decoy=None, frame_size=FRAME_QUBITS, rng=None, eve=False, strategy=None):
+    # decoy-state estimates and key rate for each length of the fiber (same channel otherwise)
+    channel = noisy_channel(channel, 0.0)
+    decoy = decoy or DecoySource()
+    rows = []
+    for length_km in distances:
+        channel_at_length = ChannelModel(**dict(channel.as_dict(), length_km=length_km))
+        estimate = run_stream(n, eve, frame_size, channel_at_length, rng, strategy, decoy)['decoy']
+        rows.append({
+            'length_km': length_km,
+            'signal_gain': estimate['gains'][SIGNAL],
+            'signal_qber': estimate['qbers'][SIGNAL],
+            'y1_lower': estimate['y1_lower'],
+            'e1_upper': estimate['e1_upper'],
+            'key_rate': estimate['key_rate']
+            })
+    return rows
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Run the BB84 protocol headless (no server, no clients).")
+    parser.add_argument("n", type=int, help="number of qubits sent by Alice")
+    parser.add_argument("--eve", action="store_true", help="Eve attacks the qubits (default: intercept-resend of every qubit)")
+    parser.add_argument("--strategy", choices=list(STRATEGIES), default=InterceptResendAttack.name, help="attack of Eve")
+    parser.add_argument("--intercept", type=float, default=1.0, help="fraction of the qubits attacked by Eve")
+    parser.add_argument("--mean-photons", type=float, default=None, help="photons per pulse of a weak coherent source (default: single photons)")
+    parser.add_argument("--decoy", action="store_true", help="decoy-state source: signal, decoy and vacuum pulses")
+    parser.add_argument("--intensities", type=float, nargs=3, default=INTENSITIES, help="mean photons of signal, decoy and vacuum pulses")
+    parser.add_argument("--decoy-probabilities", type=float, nargs=3, default=PROBABILITIES, help="probability of signal, decoy and vacuum pulses")
+    parser.add_argument("--distances", type=float, nargs='+', default=None, help="decoy-state key rate at each of these lengths of the fiber (km)")
+    parser.add_argument("--rng", choices=KINDS, default='pcg64', help="random generator (crypto: operating system, no seed)")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the run: every party has its own stream (default: fresh entropy)")
+    parser.add_argument("--sample-bits", type=int, default=None, help="bits of the key compared to detect Eve")
+    parser.add_argument("--sequential", action="store_true", help="stop comparing bits as soon as the sequential test decides")
+    parser.add_argument("--reconcile", action="store_true", help="correct Bob's key with Cascade")
+    parser.add_argument("--amplify", action="store_true", help="compress the keys with privacy amplification")
+    parser.add_argument("--key-pool", default=None, help="directory of the key pools where the secret keys are appended")
+    parser.add_argument("--stream", action="store_true", help="process the qubits frame by frame (constant memory)")
+    parser.add_argument("--frame-size", type=int, default=FRAME_QUBITS, help="qubits in each frame of --stream")
+    parser.add_argument("--checkpoint", default=None, help="with --stream: checkpoint of the run (an interrupted run goes on from it)")
+    parser.add_argument("--checkpoint-frames", type=int, default=CHECKPOINT_FRAMES, help="frames between two checkpoints")
+    parser.add_argument("--length-km", type=float, default=0.0, help="length of the fiber towards Bob")
+    parser.add_argument("--attenuation", type=float, default=0.2, help="attenuation of the fiber (dB/km)")
+    parser.add_argument("--depolarization", type=float, default=0.0, help="probability that a qubit is depolarized")
+    parser.add_argument("--bit-flip", type=float, default=0.0, help="probability that the value of a qubit is flipped")
+    parser.add_argument("--detector-efficiency", type=float, default=1.0, help="probability that Bob's detector clicks for a photon")
+    parser.add_argument("--dark-count", type=float, default=0.0, help="probability of a dark count for each pulse")
+    args = parser.parse_args()
+
+    channel = ChannelModel(args.length_km, args.attenuation, args.depolarization, args.bit_flip,
+                           args.detector_efficiency, args.dark_count)
+    strategy = STRATEGIES[args.strategy](args.intercept)
+    streams = party_sources(args.rng, args.seed)
+    decoy = DecoySource(args.intensities, args.decoy_probabilities) if args.decoy else None
+    if args.distances is not None:
+        rows = decoy_key_rates(args.distances, args.n, channel, decoy, args.frame_size, streams, args.eve, strategy)
+        print_in_table([list(rows[0])] + [[f"{value:.4g}" for value in row.values()] for row in rows])
+    elif args.stream:
+        print_in_table([[key, str(value)] for key, value in run_stream(args.n, args.eve, args.frame_size, channel, streams, strategy, decoy,
+                                                                       args.checkpoint, args.checkpoint_frames).items()])
+    else:
+        result = simulate(args.n, eve=args.eve, sample_bits=args.sample_bits, sequential=args.sequential, reconcile_keys=args.reconcile, amplify=args.amplify,
+                          channel=channel, strategy=strategy, mean_photons=args.mean_photons, decoy=decoy, rng=streams)
+        rows = [[key, str(value)] for key, value in result.as_dict().items() if key != 'timings']
+        rows += [[f"time: {phase} (s)", f"{seconds:.6f}"] for phase, seconds in result.timings.items()]
+        if (args.key_pool is not None) and result.secret_key_alice:
+            for party, key in (('Alice', result.secret_key_alice), ('Bob', result.secret_key_bob)):
+                with KeyPool(client_pool_path(party, 'headless', args.key_pool)) as pool:
+                    pool.append(key)
+                    rows.append([f"key pool: {party} (bytes available)", str(pool.available())])
+        print_in_table(rows)
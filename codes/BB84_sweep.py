@@ -0,0 +1,116 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84_sweep.py - version 1.0
+
+# Monte Carlo parameter sweep: the headless simulation repeated on every point of a grid of parameters
+# (n, compared bits, attack of Eve and fraction of qubits attacked, channel noise), spread over all the CPU cores.
+# Every point has its own random stream, derived from the seed of the sweep and from the index of the point:
+# the numbers do not depend on the number of workers nor on the order in which the points are computed.
+# usage as library:  rows = sweep({'n': [1000, 10000], 'intercept': [0, 0.5, 1]}, repetitions=200, seed=1)
+# usage as script:   python BB84_sweep.py --n 1000 10000 --intercept 0 0.5 1 --repetitions 200 [--strategy s ...] [--workers w] [--json file]
+
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from os import cpu_count
+import numpy as np
+from BB84_simulation import simulate
+from BB84random import RandomSource, KINDS
+from BB84attacks import InterceptResendAttack, STRATEGIES
+from CUlib import print_in_table
+
+# parameters of a point, with their default values
+PARAMETERS = {
+    'n': [1000],
+    'sample_bits': [20],
+    'strategy': [InterceptResendAttack.name],
+    'intercept': [1.0],
+    'noise': [0.0],
+    'mean_photons': [None]
+    }
+
+
+def grid_points(grid):
+    # every combination of the values in the grid (missing parameters: default values)
+    values = [grid.get(name, default) for name, default in PARAMETERS.items()]
+    return [dict(zip(PARAMETERS, point)) for point in product(*values)]
+
+
+def run_point(task):
+    # executed in a worker: all the repetitions of one point, with the random stream of the point
+    point, repetitions, seed_sequence, kind = task
+    rng = RandomSource(kind, seed_sequence)
+    eve = point['intercept'] > 0
+    strategy = STRATEGIES[point['strategy']](point['intercept'])
+    sifted_lengths = []
+    qbers = []
+    key_qbers = []
+    agreements = []
+    detections = 0
+    for _ in range(repetitions):
+        result = simulate(point['n'], eve=eve, sample_bits=point['sample_bits'],
+                          intercept=point['intercept'], noise=point['noise'], strategy=strategy,
+                          mean_photons=point['mean_photons'], rng=rng)
+        sifted_lengths.append(result.sifted_length)
+        if result.qber is not None:
+            qbers.append(result.qber)
+        if result.sifted_length > 0:
+            key_qbers.append(result.key_errors / result.sifted_length)
+        if result.eve_agreement is not None:
+            agreements.append(result.eve_agreement)
+        detections += result.eve_detected
+    # ideal detection probability: each compared bit shows an error caused by Eve (or by the noise)
+    eve_error = strategy.expected_qber() if eve else 0.0
+    p_error = eve_error * (1 - point['noise']) + (1 - eve_error) * point['noise']
+    row = dict(point)
+    row.update({
+        'repetitions': repetitions,
+        'sifted_length': float(np.mean(sifted_lengths)),
+        'qber': float(np.mean(qbers)) if qbers else None,
+        'qber_std': float(np.std(qbers)) if qbers else None,
+        'key_qber': float(np.mean(key_qbers)) if key_qbers else None,
+        'eve_agreement': float(np.mean(agreements)) if agreements else None,
+        'detection_rate': detections / repetitions,
+        'p_detect': 1 - (1 - p_error) ** point['sample_bits']
+        })
+    return row
+
+
+def sweep(grid, repetitions = 100, seed = 0, workers = None, kind = 'pcg64'):
+    # one row of results for every point of the grid, in the order of grid_points(grid)
+    # kind: random generator of BB84random (crypto: not reproducible)
+    points = grid_points(grid)
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(points))  # independent stream for every point
+    tasks = [(point, repetitions, seed_sequence, kind) for point, seed_sequence in zip(points, seed_sequences)]
+    workers = workers or cpu_count() or 1
+    if workers == 1:
+        return [run_point(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run_point, tasks, chunksize=max(1, len(tasks) // (4 * workers))))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Monte Carlo sweep of the headless BB84 simulation over a grid of parameters.")
+    parser.add_argument("--n", type=int, nargs='+', default=PARAMETERS['n'], help="qubits sent by Alice")
+    parser.add_argument("--sample-bits", type=int, nargs='+', default=PARAMETERS['sample_bits'], help="bits of the key compared to detect Eve")
+    parser.add_argument("--strategy", choices=list(STRATEGIES), nargs='+', default=PARAMETERS['strategy'], help="attacks of Eve")
+    parser.add_argument("--intercept", type=float, nargs='+', default=PARAMETERS['intercept'], help="fraction of the qubits intercepted by Eve (0: no Eve)")
+    parser.add_argument("--noise", type=float, nargs='+', default=PARAMETERS['noise'], help="bit-flip probability of the channel")
+    parser.add_argument("--mean-photons", type=float, nargs='+', default=PARAMETERS['mean_photons'], help="photons per pulse of a weak coherent source (default: single photons)")
+    parser.add_argument("--repetitions", type=int, default=100, help="simulations for every point")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the whole sweep")
+    parser.add_argument("--rng", choices=KINDS, default='pcg64', help="random generator (crypto: not reproducible)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all the CPU cores)")
+    parser.add_argument("--json", default=None, help="also save the results in this JSON file")
+    args = parser.parse_args()
+
+    grid = {'n': args.n, 'sample_bits': args.sample_bits, 'strategy': args.strategy, 'intercept': args.intercept, 'noise': args.noise,
+            'mean_photons': args.mean_photons}
+    rows = sweep(grid, args.repetitions, args.seed, args.workers, args.rng)
+    columns = list(rows[0])
+    print_in_table([columns] + [[row[column] if type(row[column]) is not float else f"{row[column]:.4f}" for column in columns] for row in rows])
+    if args.json is not None:
+        with open(args.json, 'w') as file:
+            json.dump(rows, file, indent=2)
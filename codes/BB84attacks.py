@@ -0,0 +1,132 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84attacks.py - version 1.0
+
+# Eavesdropping strategies of Eve, each one applied to a whole batch of qubits (or frame) at once:
+# - intercept-resend: measure a fraction of the qubits in a random basis, resend the results
+# - fixed basis:      same, always measuring in the same basis
+# - Breidbart:        measure in the intermediate basis (pi/8 from Z and X): the best guess of each bit,
+#                     right with probability cos^2(pi/8) ~ 85% whatever the basis of Alice; the guessed state
+#                     of the Breidbart basis is resent, and Bob measures the guess of Eve with probability
+#                     cos^2(pi/8) in both bases: 25% of errors in the sifted key, as intercept-resend
+# - photon-number splitting (PNS): keep one photon of every multi-photon pulse (weak coherent source)
+#                     and block single-photon pulses; the kept photons are measured after the bases are
+#                     announced, so Eve knows those bits exactly without causing any error
+# usage:  interception = BreidbartAttack(fraction=0.5).attack(qubits, photons, rng)
+
+import numpy as np
+from BB84lib import BasisBatch, QubitBatch, random_bits, random_flags
+
+BREIDBART_SUCCESS = float(np.cos(np.pi / 8) ** 2)  # probability that the measurement in the Breidbart basis guesses the bit
+
+
+class Interception:
+    # result of an attack on a batch of pulses
+    def __init__(self, qubits, photons, basis_bits, guesses, intercepted, known = None):
+        self.qubits = qubits            # qubits sent on to Bob
+        self.photons = photons          # photons of each pulse sent on to Bob (None: one photon in every pulse)
+        self.basis_bits = basis_bits    # basis of the qubits resent by Eve
+        self.guesses = guesses          # Eve's guess of each bit of Alice (random where not intercepted)
+        self.intercepted = intercepted  # 1 where Eve measured (or split) the pulse
+        # 1 where Eve learns the bit exactly once the bases are announced
+        self.known = np.zeros(len(qubits), dtype=np.uint8) if known is None else known
+
+
+class InterceptResendAttack:
+    name = 'intercept-resend'
+    resends_qubits = True  # False: the attack needs pulses with many photons (headless simulation only)
+
+    def __init__(self, fraction = 1.0):
+        self.fraction = fraction  # fraction of the qubits intercepted
+
+    def intercepted(self, n, rng = None):
+        if self.fraction >= 1:
+            return np.ones(n, dtype=np.uint8)
+        return random_flags(n, self.fraction, rng)
+
+    def measurement_basis(self, n, rng = None):
+        # basis chosen by Eve for each qubit
+        return random_bits(n, rng)
+
+    def attack(self, qubits, photons = None, rng = None):
+        n = len(qubits)
+        intercepted = self.intercepted(n, rng)
+        # not intercepted <-> "measured" in its own basis: unchanged
+        basis_bits = np.where(intercepted, self.measurement_basis(n, rng), qubits.basis_bits)
+        resent = qubits.copy()
+        results = resent.measure(BasisBatch.from_b(basis_bits), random_bits(n, rng))
+        guesses = np.where(intercepted, results, random_bits(n, rng))
+        return Interception(resent, photons, basis_bits, guesses, intercepted)
+
+    def expected_qber(self):
+        # error rate caused in the sifted key: wrong basis half of the times, then a random result
+        return self.fraction / 4
+
+    def __str__(self):
+        return f"{self.name} ({100 * self.fraction:g}% of the qubits)"
+
+
+class FixedBasisAttack(InterceptResendAttack):
+    name = 'fixed-basis'
+
+    def __init__(self, fraction = 1.0, basis = 0):
+        super().__init__(fraction)
+        self.basis = basis  # 0 <-> 'Z', 1 <-> 'X'
+
+    def measurement_basis(self, n, rng = None):
+        return np.full(n, self.basis, dtype=np.uint8)
+
+    def __str__(self):
+        return f"{self.name} {'ZX'[self.basis]} ({100 * self.fraction:g}% of the qubits)"
+
+
+class BreidbartAttack(InterceptResendAttack):
+    name = 'breidbart'
+
+    def attack(self, qubits, photons = None, rng = None):
+        # only the four BB84 states travel on the simulated channel: the state of the Breidbart basis is emulated
+        # in the basis of Alice (the only one kept by the sifting), holding the guess of Eve flipped with probability
+        # sin^2(pi/8): what Bob measures from the Breidbart state
+        n = len(qubits)
+        intercepted = self.intercepted(n, rng)
+        guesses = qubits.values ^ random_flags(n, 1 - BREIDBART_SUCCESS, rng)
+        guesses = np.where(intercepted, guesses, random_bits(n, rng)).astype(np.uint8)
+        measured_by_bob = guesses ^ random_flags(n, 1 - BREIDBART_SUCCESS, rng)
+        resent = QubitBatch.from_bits(np.where(intercepted, measured_by_bob, qubits.values), qubits.basis_bits)
+        return Interception(resent, photons, qubits.basis_bits, guesses, intercepted)
+
+    def expected_qber(self):
+        # Bob gets the bit of Alice if Eve guesses it and Bob gets her guess, or if both go wrong: c^2 + (1 - c)^2 = 3/4
+        return self.fraction * 2 * BREIDBART_SUCCESS * (1 - BREIDBART_SUCCESS)
+
+
+class PhotonNumberSplittingAttack(InterceptResendAttack):
+    name = 'pns'
+    resends_qubits = False
+
+    def __init__(self, fraction = 1.0):
+        super().__init__(fraction)  # fraction of the single-photon pulses blocked
+
+    def attack(self, qubits, photons = None, rng = None):
+        n = len(qubits)
+        if photons is None:  # single-photon source: nothing to split
+            photons = np.ones(n, dtype=np.uint32)
+        multi_photon = photons >= 2
+        blocked = (photons == 1) & self.intercepted(n, rng).astype(bool)
+        photons = np.where(multi_photon, photons - 1, np.where(blocked, 0, photons)).astype(np.uint32)
+        # the stored photon is measured in the announced basis: the bit of Alice, exactly
+        guesses = np.where(multi_photon, qubits.values, random_bits(n, rng)).astype(np.uint8)
+        intercepted = (multi_photon | blocked).astype(np.uint8)
+        return Interception(qubits.copy(), photons, qubits.basis_bits, guesses, intercepted, multi_photon.astype(np.uint8))
+
+    def expected_qber(self):
+        # no error: the attack only lowers the rate of the clicks
+        return 0.0
+
+    def __str__(self):
+        return f"{self.name} ({100 * self.fraction:g}% of the single-photon pulses blocked)"
+
+
+# strategies by name
+STRATEGIES = {strategy.name: strategy for strategy in
+              [InterceptResendAttack, FixedBasisAttack, BreidbartAttack, PhotonNumberSplittingAttack]}
@@ -0,0 +1,213 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84cascade.py - version 1.0
+
+# Cascade error reconciliation: Bob corrects his key a' asking Alice the parities of blocks of her key a
+# - several passes, each one on a different permutation of the key (shared: derived from a public seed),
+#   with blocks twice as large as in the pass before; first block size from the estimated QBER (the caller passes
+#   an upper bound: BB84qber.reconciliation_qber)
+# - all the blocks with different parity are bisected together: one message carries the parities
+#   of many blocks, so there is one round trip per bisection level (not one per block)
+# - a corrected bit changes the parity of its block in every pass: those blocks are bisected too (the cascade)
+# - every parity sent by Alice is a bit leaked to Eve (privacy amplification must remove it)
+
+from math import ceil
+import numpy as np
+from BB84lib import bits_from_string
+
+PASSES = 4
+MIN_QBER = 0.001  # QBER assumed for the block sizes when the estimate is lower
+
+
+def binary_entropy(p):
+    # Shannon entropy h(p): at least n*h(QBER) bits must be disclosed to correct n bits with error rate QBER
+    # p: number or array (element by element, h(0) = h(1) = 0)
+    p = np.asarray(p, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h = -p * np.log2(p) - (1 - p) * np.log2(1 - p)
+    h = np.where((p <= 0) | (p >= 1), 0.0, h)
+    return h if h.ndim else float(h)
+
+
+def first_block_size(qber, n):
+    # blocks of the first pass contain ~0.73 errors on average (Brassard-Salvail)
+    # (a sample without errors does not mean a key without errors: at least MIN_QBER)
+    return max(1, min(n, ceil(0.73 / max(qber, MIN_QBER))))
+
+
+def pass_permutation(seed, n, pass_index):
+    # same permutation for Alice and Bob: from the public seed and the pass index
+    return np.random.default_rng([seed, pass_index]).permutation(n)
+
+
+class ParityOracle:
+    # Alice's side: answers the parity queries on her key (which is never changed)
+    def __init__(self, key, seed):
+        self.key = bits_from_string(key)
+        self.seed = seed
+        self.prefix = {}  # pass -> prefix parities of the permuted key: parity(start, end) = prefix[end] ^ prefix[start]
+
+    def parities(self, queries):
+        # queries: list of (pass, start, end) on the permuted key -> array of parities (0/1)
+        queries = np.asarray(queries, dtype=np.int64).reshape(-1, 3)
+        parities = np.empty(len(queries), dtype=np.uint8)
+        for pass_index in np.unique(queries[:, 0]):
+            prefix = self.__prefix(int(pass_index))
+            selected = queries[:, 0] == pass_index
+            parities[selected] = prefix[queries[selected, 2]] ^ prefix[queries[selected, 1]]
+        return parities
+
+    def __prefix(self, pass_index):
+        if pass_index not in self.prefix:
+            permuted = self.key[pass_permutation(self.seed, len(self.key), pass_index)]
+            self.prefix[pass_index] = np.concatenate(([0], np.bitwise_xor.accumulate(permuted))).astype(np.uint8)
+        return self.prefix[pass_index]
+
+
+class Cascade:
+    # Bob's side: decides the queries, corrects his key with the answers
+    # usage: while queries := cascade.next_queries(): cascade.receive_parities(<Alice's answers to queries>)
+    def __init__(self, key, qber, seed, passes = PASSES):
+        self.key = bits_from_string(key).copy()
+        self.seed = seed
+        n = len(self.key)
+        # adaptive block sizes: from the estimated QBER, doubled at every pass
+        self.block_sizes = []
+        block_size = first_block_size(qber, n)
+        for _ in range(passes):
+            self.block_sizes.append(block_size)
+            block_size = min(max(1, n), 2 * block_size)
+        self.permutations = []   # one for every started pass
+        self.positions = []      # inverse permutations: position of each bit in the permuted key
+        self.alice_parities = [] # parities of the blocks of every started pass (Alice's key)
+        self.bob_parities = []   # same blocks, Bob's (current) key
+        self.known = {}          # (pass, start, end) -> parity of Alice's key, for the bisected ranges
+        self.active = []         # ranges with an odd number of errors being bisected: [pass, start, end]
+        self.pending = []        # queries sent, waiting for the parities
+        self.pending_pass = None # pass whose blocks are in the pending queries (None: bisection queries)
+        # report
+        self.round_trips = 0
+        self.leaked_bits = 0
+        self.corrected = 0
+
+    def next_queries(self):
+        # queries of the next round trip: [] when the reconciliation is complete
+        while True:
+            self.__collect_wrong_blocks()
+            if self.active:
+                queries = []
+                for pass_index, start, end in self.active:
+                    query = (pass_index, start, (start + end) // 2)
+                    if query not in self.known:
+                        queries.append(query)
+                if queries:
+                    self.pending = list(dict.fromkeys(queries))
+                    self.pending_pass = None
+                    return self.pending
+                # parities already known (from previous passes): next bisection level without round trip
+                self.__bisect()
+                continue
+            if len(self.permutations) == len(self.block_sizes):
+                return []
+            self.pending = self.__start_pass()
+            self.pending_pass = len(self.permutations) - 1
+            return self.pending
+
+    def receive_parities(self, parities):
+        parities = bits_from_string(parities)
+        self.round_trips += 1
+        self.leaked_bits += len(self.pending)
+        for query, parity in zip(self.pending, parities.tolist()):
+            self.known[query] = parity
+        if self.pending_pass is not None:
+            self.alice_parities[self.pending_pass] = parities.copy()
+        else:
+            self.__bisect()
+        self.pending = []
+
+    @property
+    def efficiency(self):
+        # leaked bits / Shannon limit (1 is the best possible)
+        n = len(self.key)
+        limit = n * binary_entropy(self.corrected / n) if n > 0 else 0
+        return self.leaked_bits / limit if limit > 0 else None
+
+    def __start_pass(self):
+        pass_index = len(self.permutations)
+        n = len(self.key)
+        block_size = self.block_sizes[pass_index]
+        permutation = pass_permutation(self.seed, n, pass_index)
+        positions = np.empty(n, dtype=np.int64)
+        positions[permutation] = np.arange(n)
+        self.permutations.append(permutation)
+        self.positions.append(positions)
+        starts = np.arange(0, n, block_size)
+        self.bob_parities.append(np.bitwise_xor.reduceat(self.key[permutation], starts) if n > 0 else np.zeros(0, dtype=np.uint8))
+        self.alice_parities.append(self.bob_parities[-1].copy())  # replaced by the answers
+        return [(pass_index, int(start), int(min(start + block_size, n))) for start in starts]
+
+    def __block(self, pass_index, block):
+        start = block * self.block_sizes[pass_index]
+        return [pass_index, start, min(start + self.block_sizes[pass_index], len(self.key))]
+
+    def __collect_wrong_blocks(self):
+        # blocks with different parity (new pass or cascade of a correction) not yet being bisected
+        being_bisected = {(pass_index, start // self.block_sizes[pass_index]) for pass_index, start, _ in self.active}
+        for pass_index in range(len(self.alice_parities)):
+            if pass_index == self.pending_pass and self.pending:
+                continue  # parities not arrived yet
+            for block in np.flatnonzero(self.alice_parities[pass_index] != self.bob_parities[pass_index]).tolist():
+                if (pass_index, block) not in being_bisected:
+                    block_range = self.__block(pass_index, block)
+                    self.known[tuple(block_range)] = int(self.alice_parities[pass_index][block])
+                    self.active.append(block_range)
+        self.__correct_single_bits()
+
+    def __bisect(self):
+        # one bisection level for every active range, with the parities of the left halves
+        active = self.active
+        self.active = []
+        for pass_index, start, end in active:
+            alice_parity = self.known[(pass_index, start, end)]
+            if self.__bob_parity(pass_index, start, end) == alice_parity:
+                continue  # corrected in the meantime by another range
+            middle = (start + end) // 2
+            alice_left = self.known[(pass_index, start, middle)]
+            if self.__bob_parity(pass_index, start, middle) != alice_left:
+                self.active.append([pass_index, start, middle])
+            else:
+                # parity of the right half is derived: no bit leaked
+                self.known[(pass_index, middle, end)] = alice_parity ^ alice_left
+                self.active.append([pass_index, middle, end])
+        self.__correct_single_bits()
+
+    def __correct_single_bits(self):
+        # a range of one bit with different parity: that bit is wrong
+        single_bits = [r for r in self.active if r[1] + 1 == r[2]]
+        if not single_bits:
+            return
+        self.active = [r for r in self.active if r[1] + 1 < r[2]]
+        for pass_index, start, end in single_bits:
+            if self.__bob_parity(pass_index, start, end) != self.known[(pass_index, start, end)]:
+                self.__flip(int(self.permutations[pass_index][start]))
+
+    def __flip(self, position):
+        self.key[position] ^= 1
+        self.corrected += 1
+        # the parity of the block containing this bit changes in every started pass
+        for pass_index, positions in enumerate(self.positions):
+            self.bob_parities[pass_index][positions[position] // self.block_sizes[pass_index]] ^= 1
+
+    def __bob_parity(self, pass_index, start, end):
+        return int(np.bitwise_xor.reduce(self.key[self.permutations[pass_index][start:end]]))
+
+
+def reconcile(key_alice, key_bob, qber, seed, passes = PASSES):
+    # both sides in the same process (headless simulation): returns the Cascade with Bob's corrected key
+    oracle = ParityOracle(key_alice, seed)
+    cascade = Cascade(key_bob, qber, seed, passes)
+    queries = cascade.next_queries()
+    while queries:
+        cascade.receive_parities(oracle.parities(queries))
+        queries = cascade.next_queries()
+    return cascade
@@ -0,0 +1,75 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84channel.py - version 1.0
+
+# Noisy quantum channel towards Bob (fiber + Bob's detector), applied to a whole batch of qubits at once:
+# - loss: each photon reaches the detector with probability 10^(-attenuation * length / 10)
+# - detector efficiency: each photon that reaches the detector clicks with this probability
+# - dark counts: click without photon (or together with it), with a random result
+# - depolarization: the qubit is replaced by a random one (measured in any basis: random result)
+# - bit-flip: the value of the qubit is flipped (e.g. misalignment of the polarization)
+# Positions without click are announced by Bob together with his basis, and sifted away.
+# Pulses can carry more than one photon (weak coherent source): each of them can make the detector click.
+
+import numpy as np
+from BB84lib import QubitBatch, random_bits, random_flags
+
+
+class ChannelModel:
+    def __init__(self, length_km = 0.0, attenuation = 0.2, depolarization = 0.0, bit_flip = 0.0,
+                 detector_efficiency = 1.0, dark_count = 0.0):
+        self.length_km = length_km                      # length of the fiber
+        self.attenuation = attenuation                  # dB/km (0.2: standard fiber at 1550 nm)
+        self.depolarization = depolarization            # probability that a qubit is depolarized
+        self.bit_flip = bit_flip                        # probability that the value of a qubit is flipped
+        self.detector_efficiency = detector_efficiency  # probability that a photon on the detector clicks
+        self.dark_count = dark_count                    # probability of a dark count for each pulse
+
+    @property
+    def transmittance(self):
+        # probability that a photon sent by Alice makes Bob's detector click
+        return 10 ** (-self.attenuation * self.length_km / 10) * self.detector_efficiency
+
+    @property
+    def is_perfect(self):
+        return (self.transmittance >= 1) and (self.depolarization == 0) and (self.bit_flip == 0) and (self.dark_count == 0)
+
+    def expected_click_rate(self):
+        return 1 - (1 - self.transmittance) * (1 - self.dark_count)
+
+    def expected_qber(self):
+        # error rate of the sifted key: photons (depolarized or flipped) and dark counts (random results)
+        photon_error = self.depolarization / 2 + (1 - self.depolarization) * self.bit_flip
+        photon_only = self.transmittance * (1 - self.dark_count)
+        return (photon_only * photon_error + self.dark_count / 2) / self.expected_click_rate()
+
+    def transmit(self, qubits, rng = None, photons = None):
+        # returns (qubits as they are measured by Bob, clicks: 1 where Bob's detector clicked)
+        # photons: photons in each pulse (None: one photon in every pulse)
+        n = len(qubits)
+        if self.is_perfect:
+            return qubits, np.ones(n, dtype=np.uint8) if photons is None else (photons > 0).astype(np.uint8)
+        values = qubits.values
+        basis_bits = qubits.basis_bits
+        if photons is None:
+            photon = random_flags(n, self.transmittance, rng) if self.transmittance < 1 else np.ones(n, dtype=np.uint8)
+        else:  # at least one of the photons of the pulse is detected
+            photon = random_flags(n, 1 - (1 - self.transmittance) ** photons, rng)
+        dark = random_flags(n, self.dark_count, rng) if self.dark_count > 0 else np.zeros(n, dtype=np.uint8)
+        # random qubit: depolarized, or result given by a dark count
+        randomized = dark.astype(bool)
+        if self.depolarization > 0:
+            randomized |= random_flags(n, self.depolarization, rng).astype(bool)
+        if randomized.any():
+            values = np.where(randomized, random_bits(n, rng), values)
+            basis_bits = np.where(randomized, random_bits(n, rng), basis_bits)
+        if self.bit_flip > 0:
+            values = values ^ random_flags(n, self.bit_flip, rng)
+        return QubitBatch.from_bits(values, basis_bits), photon | dark
+
+    def as_dict(self):
+        return dict(vars(self))
+
+    def __str__(self):
+        return (f"{self.length_km:g} km at {self.attenuation:g} dB/km, depolarization {self.depolarization:g}, "
+                f"bit-flip {self.bit_flip:g}, detector efficiency {self.detector_efficiency:g}, dark counts {self.dark_count:g}")
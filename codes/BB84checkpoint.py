@@ -0,0 +1,226 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84checkpoint.py - version 1.0
+
+# Checkpoints of long runs: after a crash, a run goes on from its last checkpoint, so the work lost (and the time
+# to recover) depends on the interval between checkpoints, not on the length of the run.
+# A checkpoint <path> is made of:
+# - <path>.state: small state of the run (counters, parameters, random generators, ...): MAGIC + STATE_HEADER
+#   (bytes, CRC-32) + JSON, written to a temporary file and renamed, so it is always the previous or the new one
+# - <path>.<stream>.bits: bits of each stream (e.g. the sifted strings a and b), packed and append-only: each
+#   checkpoint writes only the bits added since the previous one, before the state that counts them (bits after
+#   the counted ones, left by an interrupted checkpoint, are overwritten)
+# Where they are used:
+# - BB84_simulation.py --stream --checkpoint path: totals and random generators every CHECKPOINT_FRAMES frames
+# - streaming mode of the clients: Alice and Bob save their sifted frames every BB84_CHECKPOINT_FRAMES frames in
+#   the directory BB84_CHECKPOINT (<party>_<session>); a stream of the same n started again (after a crash of a
+#   client or of the server) goes on from the last checkpoint that both of them have: Alice offers her commit points
+#   with OP_STREAM_START, Bob answers with OP_STREAM_RESUME (first frame, bits already sifted)
+# - scripted mode of the server: the rounds already completed are not run again (server_<session>)
+# usage as script:   python BB84checkpoint.py path   (show a checkpoint)
+
+import os
+import json
+import zlib
+from uuid import uuid4
+from struct import Struct
+import numpy as np
+
+MAGIC = b'BB84CKPT\x01'
+STATE_HEADER = Struct('<II')  # bytes of the state (JSON), CRC-32 of them
+CHECKPOINT_FRAMES = 16  # frames between two checkpoints (environment variable BB84_CHECKPOINT_FRAMES)
+CHECKPOINT_HISTORY = 8  # commit points kept for a stream: Alice is at most STREAM_WINDOW frames ahead of Bob
+
+
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.bits = {}  # stream -> committed bits
+        self.pending = {}  # stream -> arrays of bits appended after the last commit
+
+    def load(self):
+        # last committed state (dict), None if there is no valid checkpoint
+        try:
+            with open(self.path + '.state', 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        start = len(MAGIC) + STATE_HEADER.size
+        if (data[:len(MAGIC)] != MAGIC) or (len(data) < start):
+            return None
+        length, crc = STATE_HEADER.unpack_from(data, len(MAGIC))
+        body = data[start:]
+        if (len(body) != length) or (zlib.crc32(body) != crc):
+            return None
+        state = json.loads(body)
+        self.bits = state.pop('bits')
+        self.pending = {}
+        return state
+
+    def append(self, stream, bits):
+        self.pending.setdefault(stream, []).append(np.asarray(bits, dtype=np.uint8))
+
+    def truncate(self, bits):
+        # committed bits of each stream cut to bits[stream]: the next commit writes after them
+        self.bits = dict(bits)
+        self.pending = {}
+
+    def commit(self, state):
+        # the pending bits go on disk before the state that counts them: a crash leaves the previous checkpoint valid
+        for stream, arrays in self.pending.items():
+            self.bits[stream] = self.__write_bits(stream, self.bits.get(stream, 0), np.concatenate(arrays))
+        self.pending = {}
+        body = json.dumps(dict(state, bits=self.bits), separators=(',', ':')).encode('utf-8')
+        temporary = self.path + '.state.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(MAGIC + STATE_HEADER.pack(len(body), zlib.crc32(body)) + body)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path + '.state')
+
+    def read(self, stream):
+        # committed bits of a stream (array of uint8)
+        count = self.bits.get(stream, 0)
+        if count == 0:
+            return np.zeros(0, dtype=np.uint8)
+        with open(self.__bits_path(stream), 'rb') as file:
+            data = file.read((count + 7) // 8)
+        return np.unpackbits(np.frombuffer(data, dtype=np.uint8), count=count)
+
+    def remove(self):
+        for path in [self.path + '.state'] + [self.__bits_path(stream) for stream in set(self.bits) | set(self.pending)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.bits = {}
+        self.pending = {}
+
+
+    def __bits_path(self, stream):
+        return f"{self.path}.{stream}.bits"
+
+    def __write_bits(self, stream, committed, bits):
+        # bits packed after the committed ones (their last byte, if partial, is written again): new count
+        path = self.__bits_path(stream)
+        with open(path, 'r+b' if os.path.exists(path) else 'w+b') as file:
+            offset = committed // 8
+            if committed % 8:
+                file.seek(offset)
+                last = np.unpackbits(np.frombuffer(file.read(1), dtype=np.uint8))
+                bits = np.concatenate([last[:committed % 8], bits])
+            file.seek(offset)
+            file.write(np.packbits(bits).tobytes())
+            file.truncate()
+            file.flush()
+            os.fsync(file.fileno())
+        return 8 * offset + len(bits)
+
+
+class StreamCheckpoint:
+    # checkpoints of a stream on the side of Alice or Bob: every `interval` frames sifted in order, their sifted
+    # strings (a and b, or a' and b') go to the checkpoint and leave the memory
+    # commit points: (frames, sifted bits of those frames), the last CHECKPOINT_HISTORY ones
+    def __init__(self, path, interval = CHECKPOINT_FRAMES):
+        self.checkpoint = Checkpoint(path)
+        self.interval = max(1, interval)
+        self.state = None
+        self.frames = 0  # frames committed
+        self.sifted_bits = 0  # sifted bits of the committed frames
+
+    def open(self, n, stream_id = None):
+        # Alice: the interrupted stream of n qubits, or a new one; Bob: the stream with this id, or a new one
+        # returns the id of the stream
+        state = self.checkpoint.load()
+        if (state is None) or (state['n'] != n) or ((stream_id is not None) and (state['stream'] != stream_id)):
+            state = {'n': n, 'stream': stream_id or uuid4().hex, 'commits': [[0, 0]]}
+            self.checkpoint.truncate({'a': 0, 'b': 0})
+            self.checkpoint.commit(state)
+        self.state = state
+        self.frames, self.sifted_bits = state['commits'][-1]
+        return state['stream']
+
+    def commit_points(self):
+        return [frames for frames, _ in self.state['commits']]
+
+    def resume(self, frames):
+        # back to the commit point of the given frames (the last one in common with the other party; 0: start again)
+        commits = [commit for commit in self.state['commits'] if commit[0] <= frames] or [[0, 0]]
+        self.frames, self.sifted_bits = commits[-1]
+        self.state['commits'] = commits
+        self.checkpoint.truncate({'a': self.sifted_bits, 'b': self.sifted_bits})
+        self.checkpoint.commit(self.state)
+
+    def update(self, sifted):
+        # sifted: frame index -> (a, b) of the sifted frames not committed yet; the frames that complete
+        # an interval are committed, in order, and removed from it
+        while all((index in sifted) for index in range(self.frames, self.frames + self.interval)):
+            for index in range(self.frames, self.frames + self.interval):
+                a, b = sifted.pop(index)
+                self.checkpoint.append('a', a)
+                self.checkpoint.append('b', b)
+                self.sifted_bits += len(a)
+            self.frames += self.interval
+            self.state['commits'] = (self.state['commits'] + [[self.frames, self.sifted_bits]])[-CHECKPOINT_HISTORY:]
+            self.checkpoint.commit(self.state)
+
+    def sifted(self):
+        # sifted strings of the committed frames (arrays of bits)
+        return self.checkpoint.read('a'), self.checkpoint.read('b')
+
+    def remove(self):
+        self.checkpoint.remove()
+
+
+def stream_start_payload(n, stream_id = None, commit_points = ()):
+    # payload of OP_STREAM_START: n, then (with checkpoints) id of the stream and commit points of Alice
+    if stream_id is None:
+        return str(n)
+    return f"{n}\n{stream_id}\n{','.join(str(frames) for frames in commit_points)}"
+
+def parse_stream_start(payload):
+    # (qubits, id of the stream or None, commit points of Alice)
+    lines = payload.decode('utf-8').split('\n')
+    if len(lines) < 3:
+        return int(lines[0]), None, []
+    return int(lines[0]), lines[1], [int(frames) for frames in lines[2].split(',') if frames]
+
+def stream_resume_payload(frames, sifted_bits):
+    # payload of OP_STREAM_RESUME: first frame to send, sifted bits of the frames before it
+    return f"{frames}\n{sifted_bits}"
+
+def parse_stream_resume(payload):
+    frames, sifted_bits = payload.decode('utf-8').split('\n')
+    return int(frames), int(sifted_bits)
+
+
+def checkpoint_path(party, session_id = None):
+    # checkpoint of a party in the directory BB84_CHECKPOINT (None: no checkpoints)
+    directory = os.environ.get('BB84_CHECKPOINT')
+    if not directory:
+        return None
+    return os.path.join(directory, party if session_id is None else f"{party}_{session_id}")
+
+def checkpoint_frames():
+    # frames between two checkpoints of a stream (BB84_CHECKPOINT_FRAMES)
+    return int(os.environ.get('BB84_CHECKPOINT_FRAMES', CHECKPOINT_FRAMES))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Show a BB84 checkpoint")
+    parser.add_argument("path", help="path of the checkpoint, without extension")
+    args = parser.parse_args()
+
+    checkpoint = Checkpoint(args.path)
+    state = checkpoint.load()
+    if state is None:
+        print(f"Error: no valid checkpoint in '{args.path}.state'")
+    else:
+        for stream, count in checkpoint.bits.items():
+            print(f"stream {stream}: {count} bits")
+        print(json.dumps(state, indent=1)[:4000])
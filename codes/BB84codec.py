@@ -0,0 +1,243 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84codec.py - version 1.0
+
+# Wire encodings of the BB84 payloads exchanged through the server
+# - text:   one UTF-8 character per qubit/bit, key-requests and answers as full-length 'x'/'?' strings
+# - binary: 2 bits per qubit, 1 bit per basis or key bit, key-requests as delta/varint-encoded positions
+# Clients offer the codecs they know when connecting, the server chooses one for each client
+# and transcodes the payloads it relays.
+# In streaming mode every payload is prefixed by the index of its frame (varint, same for all the codecs).
+# Qubits relayed to Bob and his basis b' also carry the positions where his detector clicked (noisy channel).
+
+import numpy as np
+from BB84lib import QubitBatch, bits_from_string, bits_to_string, key_request_from_positions, reveal_bits, \
+                   mark_no_clicks, split_no_clicks
+
+
+## varint: unsigned integers in 7-bit groups, least significant first (high bit set <-> more bytes follow)
+
+def encode_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decode_varint(data, offset):
+    # returns (value, offset of the next byte)
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def encode_frame(index, payload):
+    out = bytearray()
+    encode_varint(index, out)
+    return bytes(out) + payload
+
+def decode_frame(payload):
+    # returns (index of the frame, payload of the frame)
+    index, offset = decode_varint(payload, 0)
+    return index, payload[offset:]
+
+
+class TextCodec:
+    name = 'text'
+
+    def encode_qubits(self, qubits):
+        return qubits.to_compact_string().encode('utf-8')
+
+    def decode_qubits(self, payload):
+        return QubitBatch.from_compact_string(payload.decode('utf-8'))
+
+    def encode_detected_qubits(self, qubits, clicks):
+        # 'x' <-> no click
+        return mark_no_clicks(qubits.to_compact_string(), clicks).encode('utf-8')
+
+    def decode_detected_qubits(self, payload):
+        # returns (qubits, clicks)
+        qubits_str, clicks = split_no_clicks(payload.decode('utf-8'))
+        return QubitBatch.from_compact_string(qubits_str), clicks
+
+    def encode_bits(self, bits):
+        # bits: string of '0'/'1' characters (or array of 0/1), None <-> information not up to date
+        if bits is None:
+            return b','
+        if type(bits) is not str:
+            bits = bits_to_string(bits)
+        return bits.encode('utf-8')
+
+    def decode_bits(self, payload):
+        if payload == b',':
+            return None
+        return payload.decode('utf-8')
+
+    def encode_detections(self, bits, clicks):
+        # Bob's basis b' with 'x' where his detector did not click
+        if bits is None:
+            return b','
+        if type(bits) is not str:
+            bits = bits_to_string(bits)
+        return mark_no_clicks(bits, clicks).encode('utf-8')
+
+    def decode_detections(self, payload):
+        # returns (bits, clicks) or (None, None)
+        if payload == b',':
+            return None, None
+        return split_no_clicks(payload.decode('utf-8'))
+
+    def encode_key_request(self, length, positions):
+        return key_request_from_positions(length, positions).encode('utf-8')
+
+    def decode_key_request(self, payload):
+        # returns (key length, sorted positions)
+        request = np.frombuffer(payload, dtype=np.uint8)
+        return len(request), np.flatnonzero(request == ord('?')).tolist()
+
+    def encode_revealed_bits(self, key, positions):
+        # key: string of '0'/'1' characters; None <-> request not up to date
+        if key is None:
+            return b''
+        return reveal_bits(key, key_request_from_positions(len(key), positions)).encode('utf-8')
+
+    def decode_revealed_bits(self, payload):
+        # returns only the requested bits (string of '0'/'1' characters) or None
+        if payload == b'':
+            return None
+        return payload.decode('utf-8').replace('x', '')
+
+    def encode_parity_queries(self, queries):
+        # queries: list of (pass, start, end) -> "pass,start,end;pass,start,end;..."
+        return ';'.join(f"{pass_index},{start},{end}" for pass_index, start, end in queries).encode('utf-8')
+
+    def decode_parity_queries(self, payload):
+        if payload == b'':
+            return []
+        return [tuple(int(value) for value in query.split(',')) for query in payload.decode('utf-8').split(';')]
+
+
+class BinaryCodec:
+    name = 'binary'
+
+    def encode_qubits(self, qubits):
+        out = bytearray()
+        encode_varint(len(qubits), out)
+        return bytes(out) + qubits.packed_values.tobytes() + qubits.packed_basis.tobytes()
+
+    def decode_qubits(self, payload):
+        n, offset = decode_varint(payload, 0)
+        size = (n + 7) // 8
+        packed = np.frombuffer(payload, dtype=np.uint8, offset=offset)
+        qubits = QubitBatch()
+        qubits.n = n
+        qubits.packed_values = packed[:size].copy()
+        qubits.packed_basis = packed[size:2*size].copy()
+        return qubits
+
+    def encode_detected_qubits(self, qubits, clicks):
+        # qubits, then the clicks packed (1 bit per qubit)
+        return self.encode_qubits(qubits) + np.packbits(clicks).tobytes()
+
+    def decode_detected_qubits(self, payload):
+        qubits = self.decode_qubits(payload)
+        size = (len(qubits) + 7) // 8
+        clicks = np.unpackbits(np.frombuffer(payload, dtype=np.uint8, offset=len(payload) - size), count=len(qubits))
+        return qubits, clicks
+
+    def encode_bits(self, bits):
+        # empty payload <-> information not up to date (an empty string is encoded as its length 0)
+        if bits is None:
+            return b''
+        bits = bits_from_string(bits)
+        out = bytearray()
+        encode_varint(len(bits), out)
+        return bytes(out) + np.packbits(bits).tobytes()
+
+    def decode_bits(self, payload):
+        if payload == b'':
+            return None
+        n, offset = decode_varint(payload, 0)
+        return bits_to_string(np.unpackbits(np.frombuffer(payload, dtype=np.uint8, offset=offset), count=n))
+
+    def encode_detections(self, bits, clicks):
+        # bits, then the clicks packed
+        if bits is None:
+            return b''
+        return self.encode_bits(bits) + np.packbits(clicks).tobytes()
+
+    def decode_detections(self, payload):
+        if payload == b'':
+            return None, None
+        n, offset = decode_varint(payload, 0)
+        packed = np.frombuffer(payload, dtype=np.uint8, offset=offset)
+        size = (n + 7) // 8
+        return bits_to_string(np.unpackbits(packed[:size], count=n)), np.unpackbits(packed[size:], count=n)
+
+    def encode_key_request(self, length, positions):
+        # key length, number of positions, then the gaps between consecutive sorted positions
+        out = bytearray()
+        encode_varint(length, out)
+        encode_varint(len(positions), out)
+        previous = -1
+        for position in sorted(positions):
+            encode_varint(position - previous - 1, out)
+            previous = position
+        return bytes(out)
+
+    def decode_key_request(self, payload):
+        length, offset = decode_varint(payload, 0)
+        count, offset = decode_varint(payload, offset)
+        positions = []
+        previous = -1
+        for _ in range(count):
+            gap, offset = decode_varint(payload, offset)
+            previous += gap + 1
+            positions.append(previous)
+        return length, positions
+
+    def encode_revealed_bits(self, key, positions):
+        # only the requested bits, packed, in the order of the positions
+        if key is None:
+            return b''
+        return self.encode_bits(bits_from_string(key)[np.asarray(positions, dtype=np.intp)])
+
+    def decode_revealed_bits(self, payload):
+        return self.decode_bits(payload)
+
+    def encode_parity_queries(self, queries):
+        # number of queries, then pass, start and length of each block
+        out = bytearray()
+        encode_varint(len(queries), out)
+        for pass_index, start, end in queries:
+            encode_varint(pass_index, out)
+            encode_varint(start, out)
+            encode_varint(end - start, out)
+        return bytes(out)
+
+    def decode_parity_queries(self, payload):
+        count, offset = decode_varint(payload, 0)
+        queries = []
+        for _ in range(count):
+            pass_index, offset = decode_varint(payload, offset)
+            start, offset = decode_varint(payload, offset)
+            length, offset = decode_varint(payload, offset)
+            queries.append((pass_index, start, start + length))
+        return queries
+
+
+# codecs known by this version, in order of preference
+CODECS = {codec.name: codec for codec in [BinaryCodec(), TextCodec()]}
+DEFAULT_CODEC = TextCodec.name  # used with clients that do not offer any codec
+
+def negotiate_codec(offered):
+    # first codec offered by the client that is also known here
+    for name in offered:
+        if name in CODECS:
+            return CODECS[name]
+    return CODECS[DEFAULT_CODEC]
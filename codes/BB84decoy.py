@@ -0,0 +1,101 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84decoy.py - version 1.0
+
+# Decoy-state BB84: Alice sends weak coherent pulses (Poisson photon numbers), each one with an intensity
+# chosen at random among signal, decoy and vacuum. After sifting she announces the intensity of every pulse:
+# the gain (clicks / pulses) and the QBER of each intensity bound the yield and the error rate of the
+# single-photon pulses, the only ones that Eve cannot split (vacuum + weak decoy, Ma-Qi-Zhao-Lo 2005).
+# The key comes from the signal pulses; the asymptotic key rate (GLLP) is
+#   R = q * (Q1 * (1 - h(e1)) - f * Q_signal * h(E_signal))
+# where q is the fraction of pulses that are signals sifted in the same basis.
+
+from math import exp
+import numpy as np
+from BB84lib import random_floats, random_photons
+from BB84cascade import binary_entropy
+
+SIGNAL, DECOY, VACUUM = 0, 1, 2  # intensity classes
+INTENSITIES = (0.5, 0.1, 0.0)  # mean photons per pulse of each class
+PROBABILITIES = (0.8, 0.15, 0.05)  # probability that a pulse belongs to each class
+RECONCILIATION_EFFICIENCY = 1.16  # f: parities disclosed by the reconciliation / Shannon limit (Cascade)
+
+
+class DecoySource:
+    def __init__(self, intensities = INTENSITIES, probabilities = PROBABILITIES):
+        if not (intensities[SIGNAL] > intensities[DECOY] > intensities[VACUUM] == 0):
+            raise ValueError("intensities must be signal > decoy > vacuum = 0!")
+        self.intensities = np.asarray(intensities, dtype=float)
+        self.probabilities = np.asarray(probabilities, dtype=float) / sum(probabilities)
+
+    def emit(self, n, rng = None):
+        # returns (intensity class of each pulse, photons of each pulse)
+        classes = np.searchsorted(np.cumsum(self.probabilities)[:-1], random_floats(n, rng), side='right').astype(np.uint8)
+        photons = np.zeros(n, dtype=np.uint32)
+        for intensity_class in (SIGNAL, DECOY):  # one Poisson draw per class: same mean for all its pulses
+            pulses = np.flatnonzero(classes == intensity_class)
+            photons[pulses] = random_photons(len(pulses), self.intensities[intensity_class], rng)
+        return classes, photons
+
+    def __str__(self):
+        return ", ".join(f"{name} {mu:g} ({100 * p:g}%)" for name, mu, p in zip(["signal", "decoy", "vacuum"], self.intensities, self.probabilities))
+
+
+class DecoyStatistics:
+    # counts of each intensity class, accumulated frame by frame
+    def __init__(self, source):
+        self.source = source
+        classes = len(source.intensities)
+        self.sent = np.zeros(classes, dtype=np.int64)    # pulses sent
+        self.clicks = np.zeros(classes, dtype=np.int64)  # pulses detected by Bob
+        self.sifted = np.zeros(classes, dtype=np.int64)  # detected and measured in the same basis
+        self.errors = np.zeros(classes, dtype=np.int64)  # sifted bits different for Alice and Bob
+
+    def update(self, classes, clicks, same_basis, errors):
+        # errors: 1 where the sifted bits of Alice and Bob differ (one value for each sifted position)
+        count = len(self.sent)
+        sifted_classes = classes[same_basis]
+        self.sent += np.bincount(classes, minlength=count)
+        self.clicks += np.bincount(classes[np.asarray(clicks, dtype=bool)], minlength=count)
+        self.sifted += np.bincount(sifted_classes, minlength=count)
+        self.errors += np.bincount(sifted_classes[np.asarray(errors, dtype=bool)], minlength=count)
+
+    def get_state(self):
+        # counts as lists (JSON), for the checkpoints of a streamed run
+        return {'sent': self.sent.tolist(), 'clicks': self.clicks.tolist(), 'sifted': self.sifted.tolist(), 'errors': self.errors.tolist()}
+
+    def set_state(self, state):
+        for name in ('sent', 'clicks', 'sifted', 'errors'):
+            getattr(self, name)[:] = state[name]
+
+    def gains(self):
+        return self.clicks / np.maximum(self.sent, 1)
+
+    def qbers(self):
+        return self.errors / np.maximum(self.sifted, 1)
+
+    def estimate(self):
+        # bounds on the single-photon pulses and key rate per pulse sent (None if they cannot be estimated)
+        mu, nu = float(self.source.intensities[SIGNAL]), float(self.source.intensities[DECOY])
+        gains, qbers = self.gains(), self.qbers()
+        y0 = float(gains[VACUUM])  # background: dark counts
+        e0 = 0.5
+        # lower bound of the yield of single photons, upper bound of their error rate
+        y1 = mu / (mu * nu - nu ** 2) * (gains[DECOY] * exp(nu) - gains[SIGNAL] * exp(mu) * nu ** 2 / mu ** 2
+                                        - (mu ** 2 - nu ** 2) / mu ** 2 * y0)
+        y1 = max(0.0, float(y1))
+        e1 = min(0.5, max(0.0, float(qbers[DECOY] * gains[DECOY] * exp(nu) - e0 * y0) / (y1 * nu))) if y1 > 0 else 0.5
+        q1 = y1 * mu * exp(-mu)  # gain of the single-photon signal pulses
+        sifted_signals = self.sifted[SIGNAL] / max(self.clicks[SIGNAL], 1)  # same basis, among detected signals
+        rate = float(self.source.probabilities[SIGNAL] * sifted_signals * (
+            q1 * (1 - binary_entropy(e1)) - RECONCILIATION_EFFICIENCY * gains[SIGNAL] * binary_entropy(qbers[SIGNAL])))
+        return {
+            'gains': gains.tolist(),
+            'qbers': qbers.tolist(),
+            'y0': y0,
+            'y1_lower': y1,
+            'e1_upper': e1,
+            'q1_lower': q1,
+            'key_rate': max(0.0, rate),
+            'secret_bits': max(0.0, rate) * int(self.sent.sum())
+            }
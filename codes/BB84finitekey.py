@@ -0,0 +1,205 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84finitekey.py - version 1.0
+
+# Finite-key analysis of BB84: length of the secret key with composable security (Tomamichel, Lim, Gisin, Renner 2012)
+#   l = n * (1 - h(Q + mu)) - leak_EC - log2(2 / (eps_sec^2 * eps_cor))
+# - n: bits of the sifted key left after the k bits compared to estimate the QBER Q (the compared bits are discarded)
+# - mu: how much the phase error rate of the key may exceed the error rate of the sample (sampling without replacement)
+#       mu = sqrt((n + k) / (n * k) * (k + 1) / k * ln(2 / eps_sec))
+#   Q + mu is replaced by the Chernoff bound when it is smaller: the error rate of the whole n + k bits is at most the
+#   upper confidence bound of the binomial tail of the sample, so the n key bits hold the rest of those errors
+#   (each bound at eps_sec / 2: together they fail with probability at most eps_sec)
+# - leak_EC: bits disclosed by the reconciliation (parities of Cascade; f * n * h(Q) when planning)
+# - eps_sec: probability that the key is not secret, eps_cor: probability that Alice and Bob keys differ (after the verification hash, BB84privacy.py)
+# Every function takes numbers or NumPy arrays (broadcast together): millions of points of a grid are evaluated at once.
+# The expensive functions are memoized lookup tables: the binary entropy on a fine grid (taken at the grid point nearest
+# to 0.5: never smaller than the exact value, so the key is never overestimated), and the upper confidence bounds
+# of the QBER for every number of errors of a sample size (Chernoff bound of the binomial tail).
+# usage as script:   python BB84finitekey.py [--sifted n n ...] [--sample-fraction f f ...] [--qber q q ...]
+#                    [--eps-sec e] [--eps-cor e] [--efficiency f]
+
+from math import log
+from functools import lru_cache
+import numpy as np
+from BB84privacy import EPSILON, EPSILON_CORRECTNESS
+from BB84decoy import RECONCILIATION_EFFICIENCY
+from BB84cascade import binary_entropy
+
+ENTROPY_TABLE_BITS = 16  # the entropy table divides [0, 0.5] in 2^16 intervals
+NEWTON_STEPS = 8  # steps of the Chernoff bound (error below 1e-13)
+TABLE_MAX_SAMPLES = 1 << 16  # larger samples: Chernoff bound of each element instead of a table
+
+
+@lru_cache(maxsize=None)
+def entropy_table(bits = ENTROPY_TABLE_BITS):
+    # h on 2^bits + 1 equally spaced points of [0, 0.5] (read-only, computed once)
+    table = binary_entropy(np.linspace(0, 0.5, (1 << bits) + 1))
+    table.flags.writeable = False
+    return table
+
+def binary_entropy_bound(p, bits = ENTROPY_TABLE_BITS):
+    # h(p) from the table, at the grid point nearest to 0.5 (h grows towards 0.5): never smaller than h(p)
+    table = entropy_table(bits)
+    intervals = len(table) - 1
+    p = np.clip(np.asarray(p, dtype=float), 0.0, 1.0)
+    index = np.ceil(np.minimum(p, 1 - p) * 2 * intervals)
+    return table[np.minimum(index, intervals).astype(np.intp)]
+
+
+def kl_divergence(q, p):
+    # relative entropy (nats) between Bernoulli(q) and Bernoulli(p)
+    q = np.asarray(q, dtype=float)
+    p = np.asarray(p, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        first = np.where(q > 0, q * np.log(q / p), 0.0)
+        second = np.where(q < 1, (1 - q) * np.log((1 - q) / (1 - p)), 0.0)
+    return first + second
+
+def chernoff_bound(observed, samples, epsilon):
+    # largest p with samples * D(observed || p) <= ln(1 / epsilon), element by element (arrays, broadcast):
+    # upper bound of the true error rate with probability 1 - epsilon (Chernoff-Hoeffding, also without replacement)
+    # Newton's method on u = -ln(1 - p), where D is convex and increasing: from a starting point above the root
+    # (Hoeffding bound, by Pinsker's inequality, or (target + H(q)) / (1 - q)) every step stays above it
+    observed = np.asarray(observed, dtype=float)
+    target = log(1 / epsilon) / np.asarray(samples, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        entropy = (-np.where(observed > 0, observed * np.log(observed), 0.0)
+                   - np.where(observed < 1, (1 - observed) * np.log1p(-observed), 0.0))
+        hoeffding = observed + np.sqrt(target / 2)
+        u = np.minimum(np.where(hoeffding < 1, -np.log1p(-np.minimum(hoeffding, 1)), np.inf), (target + entropy) / (1 - observed))
+        for _ in range(NEWTON_STEPS):
+            p = -np.expm1(-u)
+            u = u - (kl_divergence(observed, p) - target) * p / (p - observed)
+    return np.where(observed >= 1, 1.0, -np.expm1(-u))
+
+@lru_cache(maxsize=256)
+def qber_bound_table(samples, epsilon = EPSILON):
+    # chernoff_bound for every number of errors 0..samples of one sample size (read-only, computed once)
+    table = chernoff_bound(np.arange(samples + 1) / samples, samples, epsilon)
+    table.flags.writeable = False
+    return table
+
+def qber_upper_bound(errors, samples, epsilon = EPSILON):
+    # upper bound of the error rate from the errors among the compared bits (numbers or arrays, broadcast; fractional
+    # errors, e.g. expected ones, are rounded up): from the table of the sample size if there is only one, otherwise
+    # element by element; 1 without compared bits
+    errors, samples = np.broadcast_arrays(np.asarray(errors, dtype=float), np.asarray(samples, dtype=float))
+    errors = np.clip(np.ceil(np.round(errors, 9)), 0, samples)
+    bound = np.ones(errors.shape)
+    valid = samples > 0
+    sizes = np.unique(samples[valid])
+    if (len(sizes) == 1) and (sizes[0] <= TABLE_MAX_SAMPLES):
+        bound[valid] = qber_bound_table(int(sizes[0]), float(epsilon))[errors[valid].astype(np.intp)]
+    elif len(sizes) > 0:
+        bound[valid] = chernoff_bound(errors[valid] / samples[valid], samples[valid], epsilon)
+    return bound if bound.ndim else float(bound)
+
+
+def sampling_deviation(n, k, eps_sec = EPSILON):
+    # mu: deviation of the phase error rate of n bits from the error rate of k sampled bits (infinite without bits)
+    n = np.asarray(n, dtype=float)
+    k = np.asarray(k, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mu = np.sqrt((n + k) / (n * k) * (k + 1) / k * log(2 / eps_sec))
+    return np.where((n > 0) & (k > 0), mu, np.inf)
+
+def phase_error_bound(n, k, errors, eps_sec = EPSILON):
+    # phase error rate of n key bits, from k compared bits with the given errors (numbers or arrays): the smaller
+    # one of Q + mu and of the Chernoff bound, at most 0.5
+    n = np.asarray(n, dtype=float)
+    k = np.asarray(k, dtype=float)
+    errors = np.asarray(errors, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        qber = np.where(k > 0, errors / k, 0.5)
+        serfling = qber + sampling_deviation(n, k, eps_sec / 2)
+        # errors of the whole n + k bits at most (n + k) * bound, those of the sample excluded
+        chernoff = np.where(n > 0, (qber_upper_bound(errors, k, eps_sec / 2) * (n + k) - errors) / n, np.inf)
+    bound = np.minimum(np.minimum(serfling, chernoff), 0.5)
+    return bound if bound.ndim else float(bound)
+
+def finite_key_length(sifted, sampled, errors, leak, eps_sec = EPSILON, eps_cor = EPSILON_CORRECTNESS):
+    # secret key bits from the observed counts: sifted key, compared bits, errors among them, bits disclosed
+    # by the reconciliation (numbers or arrays)
+    sifted = np.asarray(sifted, dtype=float)
+    sampled = np.asarray(sampled, dtype=float)
+    n = sifted - sampled
+    phase_error = phase_error_bound(n, sampled, errors, eps_sec)
+    length = np.maximum(n, 0) * (1 - binary_entropy_bound(phase_error)) - leak - np.log2(2 / (eps_sec ** 2 * eps_cor))
+    length = np.maximum(0, np.floor(length)).astype(np.int64)
+    return length if length.ndim else int(length)
+
+def expected_leak(n, qber, efficiency = RECONCILIATION_EFFICIENCY):
+    # parities disclosed to correct n bits with the given QBER: f times the Shannon limit
+    return efficiency * np.asarray(n, dtype=float) * binary_entropy(qber)
+
+def planned_key_length(sifted, sample_fraction, qber, efficiency = RECONCILIATION_EFFICIENCY,
+                       eps_sec = EPSILON, eps_cor = EPSILON_CORRECTNESS):
+    # secret key bits expected from a sifted key on a channel with the given QBER (capacity planning)
+    sifted = np.asarray(sifted, dtype=float)
+    sampled = np.floor(sifted * np.asarray(sample_fraction, dtype=float))
+    errors = np.asarray(qber, dtype=float) * sampled
+    return finite_key_length(sifted, sampled, errors, expected_leak(sifted - sampled, qber, efficiency), eps_sec, eps_cor)
+
+def key_length_grid(sifted, sample_fraction, qber, **options):
+    # planned_key_length on every combination of the values: arrays with one axis for each parameter
+    sifted, sample_fraction, qber = np.meshgrid(np.asarray(sifted, dtype=float), np.asarray(sample_fraction, dtype=float),
+                                                np.asarray(qber, dtype=float), indexing='ij')
+    length = planned_key_length(sifted, sample_fraction, qber, **options)
+    return {'sifted': sifted, 'sample_fraction': sample_fraction, 'qber': qber,
+            'key_bits': length, 'rate': length / np.maximum(sifted, 1)}
+
+
+class FiniteKeyEstimate:
+    # finite-key analysis of the counts observed in a session
+    def __init__(self, sifted, sampled, errors, leak = None, sent = None, eps_sec = EPSILON, eps_cor = EPSILON_CORRECTNESS):
+        self.sifted = sifted
+        self.sampled = sampled
+        self.errors = errors
+        self.sent = sent  # qubits sent by Alice (None: unknown)
+        self.eps_sec = eps_sec
+        self.eps_cor = eps_cor
+        self.qber = errors / sampled if sampled > 0 else None
+        self.leak_estimated = leak is None  # reconciliation not done yet: expected leak
+        self.leak = float(expected_leak(sifted - sampled, self.qber or 0.0)) if leak is None else leak
+        self.phase_error_bound = phase_error_bound(sifted - sampled, sampled, errors, eps_sec)
+        self.key_bits = finite_key_length(sifted, sampled, errors, self.leak, eps_sec, eps_cor)
+
+    @property
+    def rate(self):
+        # secret bits per qubit sent (per sifted bit if the qubits sent are unknown)
+        return self.key_bits / max(self.sent if self.sent else self.sifted, 1)
+
+    def __str__(self):
+        if self.sampled == 0:
+            return "Finite-key bound unknown (no compared bits)"
+        leak = f"{'expected ' if self.leak_estimated else ''}reconciliation leak {self.leak:.0f} bits"
+        return (f"Finite-key bound (statistical fluctuations of the sample included): at most {self.key_bits} secret bits from {self.sifted - self.sampled} bits "
+                f"(phase error <= {100 * self.phase_error_bound:.2f}%, {leak}, eps_sec {self.eps_sec:g}, eps_cor {self.eps_cor:g}; "
+                f"rate {self.rate:.4g} per {'qubit sent' if self.sent else 'sifted bit'})")
+
+
+if __name__ == "__main__":
+    import argparse
+    from time import perf_counter
+    from CUlib import print_in_table
+
+    parser = argparse.ArgumentParser(description="Finite-key secret key length on a grid of sifted lengths, sample fractions and QBERs")
+    parser.add_argument("--sifted", type=float, nargs='+', default=[1e4, 1e5, 1e6, 1e7], help="bits of the sifted key")
+    parser.add_argument("--sample-fraction", type=float, nargs='+', default=[0.05, 0.1, 0.2], help="fraction of the sifted key compared")
+    parser.add_argument("--qber", type=float, nargs='+', default=[0.01, 0.02, 0.05], help="QBER of the channel")
+    parser.add_argument("--eps-sec", type=float, default=EPSILON, help="probability that the key is not secret")
+    parser.add_argument("--eps-cor", type=float, default=EPSILON_CORRECTNESS, help="probability that the keys differ")
+    parser.add_argument("--efficiency", type=float, default=RECONCILIATION_EFFICIENCY, help="parities disclosed / Shannon limit")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    grid = key_length_grid(args.sifted, args.sample_fraction, args.qber, efficiency=args.efficiency,
+                           eps_sec=args.eps_sec, eps_cor=args.eps_cor)
+    seconds = perf_counter() - start
+    rows = [["sifted bits", "sample fraction", "QBER", "secret bits", "rate"]]
+    for index in zip(*(axis.ravel() for axis in np.indices(grid['key_bits'].shape))):
+        rows.append([f"{grid['sifted'][index]:.0f}", f"{grid['sample_fraction'][index]:g}", f"{grid['qber'][index]:g}",
+                     str(grid['key_bits'][index]), f"{grid['rate'][index]:.4f}"])
+    print_in_table(rows)
+    print(f"{grid['key_bits'].size} points in {seconds:.4f} s")
@@ -0,0 +1,174 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84keypool.py - version 1.0
+
+# Persistent pool of secret key: the keys distilled by a party are appended to files that outlive the
+# session, applications take fresh key from it and the same byte is never handed out twice.
+# A pool <path> is made of three files:
+# - <path>.key: key bytes, append-only, read through a memory map (taken key = memoryview, no copies); only whole
+#   bytes of key are stored: the last bits of a key that do not fill a byte are dropped, never padded
+# - <path>.idx: index of the key blocks, one fixed-size record per append (offset, bytes, bits, time)
+# - <path>.pos: bytes already consumed (memory-mapped counter), saved before the key is handed out
+# Bytes of the .key file not covered by the index (append interrupted by a crash) are never used.
+# Appends and takes are serialized between threads and, where fcntl exists, between processes.
+# usage as script:   python BB84keypool.py path [--take n]
+
+import os
+import mmap
+from time import time
+from struct import Struct
+from threading import Lock
+import numpy as np
+from BB84lib import bits_from_string
+
+try:
+    import fcntl  # file locks shared with the other processes (not available on Windows)
+except ImportError:
+    fcntl = None
+
+BLOCK_RECORD = Struct('<QQQd')  # offset, length in bytes, length in bits, time of the append
+POSITION_RECORD = Struct('<Q')  # bytes consumed
+DEFAULT_DIRECTORY = 'key_pool'  # directory of the pools of the clients (environment variable BB84_KEY_POOL)
+
+
+class KeyPool:
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = Lock()
+        self.key_file = open(path + '.key', 'a+b')
+        self.index_file = open(path + '.idx', 'a+b')
+        self.position_file = open(path + '.pos', 'a+b')
+        if os.fstat(self.position_file.fileno()).st_size < POSITION_RECORD.size:
+            self.position_file.write(bytes(POSITION_RECORD.size))
+            self.__sync(self.position_file)
+        self.position_map = mmap.mmap(self.position_file.fileno(), POSITION_RECORD.size)
+        self.key_map = None  # mapping of the .key file, recreated when the file grows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        # memoryviews already taken keep their mapping alive
+        self.position_map.close()
+        for file in (self.key_file, self.index_file, self.position_file):
+            file.close()
+
+
+    def append(self, key):
+        # key: string of '0'/'1' characters, array of bits or bytes; bits are packed in whole bytes (the last
+        # len(bits) % 8 bits are dropped: padding would be handed out as key)
+        # returns the record of the new block
+        if type(key) not in (bytes, bytearray, memoryview):
+            bits = bits_from_string(key)
+            key = np.packbits(bits[:len(bits) - len(bits) % 8]).tobytes()
+        n_bits = 8 * len(key)
+        with self.__locked():
+            offset = self.size()
+            # the key goes on disk before its index record: a block in the index is always complete
+            self.key_file.truncate(offset)
+            self.key_file.seek(offset)
+            self.key_file.write(key)
+            self.__sync(self.key_file)
+            record = (offset, len(key), n_bits, time())
+            self.index_file.write(BLOCK_RECORD.pack(*record))
+            self.__sync(self.index_file)
+        return record
+
+    def take(self, n):
+        # n bytes of fresh key as a read-only memoryview, None if the pool holds fewer than n bytes
+        if n < 0:
+            raise ValueError(f"cannot take {n} bytes of key")
+        if n == 0:
+            return memoryview(b'')
+        with self.__locked():
+            start = self.consumed()
+            if n > self.size() - start:
+                return None
+            # consumed before being handed out: after a crash the key may be lost, never reused
+            self.position_map[:] = POSITION_RECORD.pack(start + n)
+            self.position_map.flush()
+            if (self.key_map is None) or (len(self.key_map) < start + n):
+                self.key_map = mmap.mmap(self.key_file.fileno(), self.size(), access=mmap.ACCESS_READ)
+            return memoryview(self.key_map)[start:start + n]
+
+
+    def blocks(self):
+        # records (offset, bytes, bits, time) of the key blocks, in order of append
+        self.index_file.seek(0)
+        data = self.index_file.read()
+        return list(BLOCK_RECORD.iter_unpack(data[:len(data) - len(data) % BLOCK_RECORD.size]))
+
+    def size(self):
+        # bytes of key appended (complete blocks only)
+        n_blocks = os.fstat(self.index_file.fileno()).st_size // BLOCK_RECORD.size
+        if n_blocks == 0:
+            return 0
+        self.index_file.seek((n_blocks - 1) * BLOCK_RECORD.size)
+        offset, length, _, _ = BLOCK_RECORD.unpack(self.index_file.read(BLOCK_RECORD.size))
+        return offset + length
+
+    def consumed(self):
+        return POSITION_RECORD.unpack(self.position_map[:])[0]
+
+    def available(self):
+        return self.size() - self.consumed()
+
+
+    def __sync(self, file):
+        file.flush()
+        os.fsync(file.fileno())
+
+    def __locked(self):
+        return PoolLock(self.lock, self.position_file if fcntl is not None else None)
+
+
+class PoolLock:
+    # lock of the threads of this process, then lock of the .pos file (other processes)
+    def __init__(self, lock, file):
+        self.lock = lock
+        self.file = file
+
+    def __enter__(self):
+        self.lock.acquire()
+        if self.file is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        if self.file is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.lock.release()
+
+
+def client_pool_path(client_name, session_id, directory = None):
+    # pool of a client: one per party and session, in BB84_KEY_POOL (default: key_pool)
+    if directory is None:
+        directory = os.environ.get('BB84_KEY_POOL', DEFAULT_DIRECTORY)
+    return os.path.join(directory, f"{client_name}_{session_id}")
+
+
+if __name__ == "__main__":
+    import argparse
+    from datetime import datetime
+
+    parser = argparse.ArgumentParser(description="Show (and consume) a BB84 key pool")
+    parser.add_argument("path", help="path of the pool, without extension")
+    parser.add_argument("--take", type=int, default=None, help="consume n bytes of key and print them (hex)")
+    args = parser.parse_args()
+
+    with KeyPool(args.path) as pool:
+        for offset, length, n_bits, timestamp in pool.blocks():
+            print(f"block at {offset:>10}: {length:>8} bytes ({n_bits} bits), {datetime.fromtimestamp(timestamp):%Y-%m-%d %H:%M:%S}")
+        print(f"size: {pool.size()} bytes, consumed: {pool.consumed()} bytes, available: {pool.available()} bytes")
+        if args.take is not None:
+            key = pool.take(args.take)
+            if key is None:
+                print(f"Error: only {pool.available()} bytes of key available")
+            else:
+                print(key.hex())
+                key.release()
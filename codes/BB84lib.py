@@ -2,7 +2,8 @@
 # by Manuel Maiuolo (manuelmaiuolo@gmail.com)
 # BB84lib.py - version 1.0
 
-from random import randint
+import numpy as np
+from BB84random import default_source
 
 class Basis:
     def __init__(self, value = None):
@@ -63,7 +64,7 @@ class Qubit:
         else:
             # measurement is made in the other basis
             # -> qubit randomly collapses on a new value
-            result = randint(0, 1) * 2 - 1  # will be +1 or -1
+            result = int(random_bits(1)[0]) * 2 - 1  # will be +1 or -1
             if basis.value == 'Z':
                 self.value = '0' if (result == +1) else '1'
             else:  # basis.value == 'X'
@@ -71,11 +72,255 @@ class Qubit:
             return result
 
 def quantum_list_to_compact_string(qlist):
-    # where qlist is a list of Qubit instances or Basis instances
+    # where qlist is a list of Qubit instances or Basis instances (or a QubitBatch / BasisBatch)
+    if isinstance(qlist, (QubitBatch, BasisBatch)):
+        return qlist.to_compact_string()
     info = ""  # will be the compact string representing qubits OR basis
     for qelement in qlist:
         info += str(qelement.value)
     return info
 
 
+## region batch engine: many qubits at once, stored as packed bits (vectorized with NumPy)
 
+# random numbers: from the default source of BB84random, unless a source is given
+
+def random_bits(n, rng = None):
+    # n random bits as an array of uint8 (each element is 0 or 1)
+    # rng: RandomSource or numpy Generator to use instead of the default one (e.g. seeded, for reproducible simulations)
+    return (default_source() if rng is None else rng).integers(0, 2, size=n, dtype=np.uint8)
+
+def random_floats(n, rng = None):
+    # n random floats, uniform in [0, 1)
+    return (default_source() if rng is None else rng).random(n)
+
+def random_flags(n, probability, rng = None):
+    # n random bits, each one is 1 with the given probability
+    return (random_floats(n, rng) < probability).astype(np.uint8)
+
+def random_photons(n, mean, rng = None):
+    # photons in each of n pulses of a weak coherent source (Poisson distribution with the given mean)
+    return (default_source() if rng is None else rng).poisson(mean, size=n).astype(np.uint32)
+
+def bits_from_string(bits):
+    # bits can be a string of '0'/'1' characters, an array or any sequence of 0/1 values
+    if type(bits) is str:
+        array = np.frombuffer(bits.encode('ascii'), dtype=np.uint8) - ord('0')
+    else:
+        array = np.asarray(bits, dtype=np.uint8)
+    if array.size > 0 and array.max() > 1:
+        raise ValueError("bits are neither 0 nor 1!")
+    return array
+
+def bits_to_string(bits):
+    # inverse of bits_from_string: array of 0/1 values -> string of '0'/'1' characters
+    return (np.asarray(bits, dtype=np.uint8) + ord('0')).tobytes().decode('ascii')
+
+def packed_bits(packed, n, key):
+    # bits[key] of n bits packed with np.packbits, unpacking only the bytes needed:
+    # one byte for an index (returns 0 or 1), the bytes of the range for a slice of step 1
+    if isinstance(key, (int, np.integer)):
+        index = int(key) + n if key < 0 else int(key)
+        if not 0 <= index < n:
+            raise IndexError("index out of range!")
+        return (int(packed[index >> 3]) >> (7 - (index & 7))) & 1
+    if isinstance(key, slice) and key.step in (None, 1):
+        start, stop, _ = key.indices(n)
+        if stop <= start:
+            return np.zeros(0, dtype=np.uint8)
+        first_byte = start >> 3
+        return np.unpackbits(packed[first_byte:(stop + 7) >> 3])[start - 8 * first_byte:stop - 8 * first_byte]
+    # mask/indices array or other slices
+    return np.unpackbits(packed, count=n)[key]
+
+
+class BasisBatch:
+    # n basis stored as packed bits: 0 <-> 'Z', 1 <-> 'X' (same convention of Basis.set_from_b)
+    def __init__(self, n = 0):
+        # default: computational basis
+        self.n = n
+        self.packed = np.zeros((n + 7) // 8, dtype=np.uint8)
+
+    @classmethod
+    def from_b(cls, b):
+        batch = cls()
+        batch.set_from_b(b)
+        return batch
+
+    def set_from_b(self, b):
+        bits = bits_from_string(b)
+        self.n = len(bits)
+        self.packed = np.packbits(bits)
+
+    @property
+    def bits(self):
+        return np.unpackbits(self.packed, count=self.n)
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        # one Basis instance per element: useful only to show few basis
+        for bit in self.bits:
+            basis = Basis()
+            basis.set_from_b(bit)
+            yield basis
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            basis = Basis()
+            basis.set_from_b(packed_bits(self.packed, self.n, key))
+            return basis
+        # slice or mask/indices array
+        return BasisBatch.from_b(packed_bits(self.packed, self.n, key))
+
+    def to_compact_string(self):
+        return np.frombuffer(b'ZX', dtype=np.uint8)[self.bits].tobytes().decode('ascii')
+
+
+class QubitBatch:
+    # n qubits stored as two packed bit arrays (2 bits per qubit):
+    # values: 0 <-> '0' or '+', 1 <-> '1' or '-'
+    # basis:  0 <-> 'Z' ('0', '1'), 1 <-> 'X' ('+', '-')
+    SYMBOLS = np.frombuffer(b'01+-', dtype=np.uint8)  # index: basis * 2 + value
+
+    def __init__(self, n = 0):
+        # default: |0>
+        self.n = n
+        self.packed_values = np.zeros((n + 7) // 8, dtype=np.uint8)
+        self.packed_basis = np.zeros((n + 7) // 8, dtype=np.uint8)
+
+    @classmethod
+    def from_bits(cls, values, basis_bits):
+        batch = cls()
+        batch.__set_bits(bits_from_string(values), bits_from_string(basis_bits))
+        return batch
+
+    @classmethod
+    def from_compact_string(cls, qubits_str):
+        codes = np.frombuffer(qubits_str.encode('utf-8'), dtype=np.uint8)
+        lookup = np.full(256, 4, dtype=np.uint8)  # 4 <-> invalid symbol
+        lookup[QubitBatch.SYMBOLS] = np.arange(4, dtype=np.uint8)
+        indexes = lookup[codes]
+        if indexes.size > 0 and indexes.max() > 3:
+            raise ValueError("qubits string contains symbols other than 0, 1, + and -!")
+        return cls.from_bits(indexes & 1, indexes >> 1)
+
+    @classmethod
+    def concatenate(cls, batches):
+        batches = list(batches)
+        return cls.from_bits(np.concatenate([batch.values for batch in batches] or [np.zeros(0, np.uint8)]),
+                             np.concatenate([batch.basis_bits for batch in batches] or [np.zeros(0, np.uint8)]))
+
+    def __set_bits(self, values, basis_bits):
+        if len(values) != len(basis_bits):
+            raise ValueError("values and basis do not have the same length!")
+        self.n = len(values)
+        self.packed_values = np.packbits(values)
+        self.packed_basis = np.packbits(basis_bits)
+
+    @property
+    def values(self):
+        return np.unpackbits(self.packed_values, count=self.n)
+
+    @property
+    def basis_bits(self):
+        return np.unpackbits(self.packed_basis, count=self.n)
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        # one Qubit instance per element: useful only to show few qubits
+        for symbol in self.to_compact_string():
+            yield Qubit(symbol)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            # only the byte holding the qubit is decoded
+            symbol = QubitBatch.SYMBOLS[(packed_bits(self.packed_basis, self.n, key) << 1) | packed_bits(self.packed_values, self.n, key)]
+            return Qubit(chr(symbol))
+        # slice or mask/indices array
+        return QubitBatch.from_bits(packed_bits(self.packed_values, self.n, key), packed_bits(self.packed_basis, self.n, key))
+
+    def copy(self):
+        return QubitBatch.from_bits(self.values, self.basis_bits)
+
+    def set_from_a_and_basis(self, a, basis):
+        # vectorized version of Qubit.set_from_a_and_basis: basis value only decides the polarization
+        if not isinstance(basis, BasisBatch):
+            raise ValueError("basis is not an instance of the BasisBatch class!")
+        a = bits_from_string(a)
+        if len(a) != len(basis):
+            raise ValueError("string a and basis do not have the same length!")
+        self.__set_bits(a, basis.bits)
+
+    def measure(self, basis, random = None):
+        # vectorized version of Qubit.measure
+        # returns the results as bits (0 <-> +1, 1 <-> -1) and collapses the qubits on the measured basis
+        if len(basis) != self.n:
+            raise ValueError("qubits and basis do not have the same length!")
+        values = self.values
+        basis_bits = basis.bits
+        # where measurement is made in the other basis -> qubit randomly collapses on a new value
+        other_basis = basis_bits != self.basis_bits
+        if random is None:
+            random = random_bits(self.n)
+        results = np.where(other_basis, random, values).astype(np.uint8)
+        self.__set_bits(results, basis_bits)
+        return results
+
+    def to_compact_string(self):
+        return QubitBatch.SYMBOLS[(self.basis_bits << 1) | self.values].tobytes().decode('ascii')
+
+## end region batch engine
+
+
+## region protocol steps shared by clients, server and headless simulation
+
+def sift(bits, basis_bits, other_basis_bits, clicks = None):
+    # keep only the bits where the two parties used the same basis (and Bob's detector clicked)
+    # returns (kept bits, mask of the kept positions)
+    same_basis = bits_from_string(basis_bits) == bits_from_string(other_basis_bits)
+    if clicks is not None:
+        same_basis &= np.asarray(clicks, dtype=bool)
+    return bits_from_string(bits)[same_basis], same_basis
+
+def mark_no_clicks(text, clicks):
+    # text with an 'x' in every position where Bob's detector did not click
+    codes = np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+    return np.where(clicks, codes, ord('x')).astype(np.uint8).tobytes().decode('ascii')
+
+def split_no_clicks(text, filler = '0'):
+    # inverse of mark_no_clicks: returns (text with filler instead of 'x', clicks)
+    codes = np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+    clicks = (codes != ord('x')).astype(np.uint8)
+    return np.where(clicks, codes, ord(filler)).astype(np.uint8).tobytes().decode('ascii'), clicks
+
+def blank_string(text, keep):
+    # text with a space in every position where keep is False
+    codes = np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+    return np.where(keep, codes, ord(' ')).astype(np.uint8).tobytes().decode('ascii')
+
+def sample_positions(length, count, rng = None):
+    # count distinct random positions in [0..length-1] (O(count), not O(length)),
+    # in random order: every prefix is a random sample too (sequential tests reveal them a few at a time)
+    return (default_source() if rng is None else rng).choice(length, size=count, replace=False).tolist()
+
+def key_request_from_positions(length, positions):
+    # string <key-request>: '?' in requested positions, 'x' in other positions
+    request = np.full(length, ord('x'), dtype=np.uint8)
+    request[np.asarray(positions, dtype=np.intp)] = ord('?')
+    return request.tobytes().decode('ascii')
+
+def reveal_bits(bits, key_request):
+    # obfuscated string of bits: only the positions requested with '?' are shown, 'x' elsewhere
+    codes = np.frombuffer(bits.encode('ascii'), dtype=np.uint8)
+    request = np.frombuffer(key_request.encode('ascii'), dtype=np.uint8)
+    return np.where(request == ord('?'), codes, ord('x')).astype(np.uint8).tobytes().decode('ascii')
+
+def detection_probability(bits_count):
+    # ideal case: each compared bit reveals a full intercept-resend attack with probability 1/4
+    return 1 - (0.75) ** bits_count
+
+## end region protocol steps
@@ -0,0 +1,213 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84metrics.py - version 1.0
+
+# Numbers of a running process (server, Alice, Bob, Eve or headless simulation):
+# - counters:   messages and bytes sent/received for each opcode, key bits produced
+# - gauges:     QBER, queue depths, key bits per second (over the last RATE_WINDOW seconds)
+# - histograms: latency of each phase of the protocol (prepare, transmit, measure, sift, sample, reconcile, amplify);
+#               a phase that does not complete (exception, timeout, abort()) counts in phases_aborted_total instead
+# Read them with default_metrics().snapshot() (dict) or on http://127.0.0.1:<port>/metrics (Prometheus text format;
+# /snapshot gives the same dict as JSON). Every process serves its own port: METRICS_PORT + index of the party
+# (server 12085, Alice 12086, Bob 12087, Eve 12088), base port from the environment variable BB84_METRICS_PORT
+# (0: no endpoint).
+
+import os
+import json
+from time import time, perf_counter
+from bisect import bisect_left
+from collections import deque
+from threading import Lock, Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+NAMESPACE = 'bb84'
+METRICS_PORT = 12085
+ENDPOINT_PARTIES = ('server', 'Alice', 'Bob', 'Eve')
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)  # seconds
+RATE_WINDOW = 10  # seconds of the key rates
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = Lock()  # updated by the threads of the clients and by the event loop of the server
+        self.counters = {}    # (name, labels) -> value
+        self.gauges = {}      # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [count of each bucket..., count of +Inf, sum]
+        self.windows = {}     # name -> deque of (time, amount) of the last RATE_WINDOW seconds
+        self.start_time = time()
+        self.phase_hook = None  # function(phase, begin) called at the boundaries of the phases (e.g. trace)
+
+    def inc(self, name, amount = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            histogram[bisect_left(LATENCY_BUCKETS, value)] += 1
+            histogram[-1] += value
+
+    def phase(self, name, **labels):
+        # with default_metrics().phase('sift'): ...  -> latency of the block in phase_seconds{phase="sift"}
+        # (with ... as phase: ... phase.abort(); return  -> the incomplete phase is not a latency)
+        return PhaseTimer(self, name, labels)
+
+    def throughput(self, name, amount):
+        # amount (e.g. key bits) produced now: counter <name>_total and gauge <name>_per_second
+        now = time()
+        with self.lock:
+            window = self.windows.setdefault(name, deque())
+            window.append((now, amount))
+            while window[0][0] < now - RATE_WINDOW:
+                window.popleft()
+            self.counters[(name + '_total', ())] = self.counters.get((name + '_total', ()), 0) + amount
+        self.set(name + '_per_second', self.rate(name, now))
+
+    def rate(self, name, now = None):
+        # amount per second over the last RATE_WINDOW seconds, always the whole window: just after start
+        # a first key would otherwise be divided by the few milliseconds of uptime
+        now = time() if now is None else now
+        with self.lock:
+            window = self.windows.get(name, ())
+            amount = sum(value for timestamp, value in window if timestamp >= now - RATE_WINDOW)
+        return amount / RATE_WINDOW
+
+
+    def snapshot(self):
+        # all the metrics as a dict (keys in Prometheus notation: name{label="value"})
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {key: list(histogram) for key, histogram in self.histograms.items()}
+        for name in list(self.windows):
+            gauges[(name + '_per_second', ())] = self.rate(name)
+        result = {
+            'uptime_seconds': time() - self.start_time,
+            'counters': {series_name(*key): value for key, value in sorted(counters.items())},
+            'gauges': {series_name(*key): value for key, value in sorted(gauges.items())},
+            'histograms': {}
+            }
+        for key, histogram in sorted(histograms.items()):
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram[:-1]):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            result['histograms'][series_name(*key)] = {'buckets': buckets, 'count': cumulative, 'sum': histogram[-1]}
+        return result
+
+    def render(self):
+        # Prometheus text exposition format
+        snapshot = self.snapshot()
+        lines = [f"# TYPE {NAMESPACE}_uptime_seconds gauge", f"{NAMESPACE}_uptime_seconds {snapshot['uptime_seconds']:.3f}"]
+        for kind in ('counters', 'gauges'):
+            typed = set()
+            for series, value in snapshot[kind].items():
+                name = series.split('{')[0]
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {NAMESPACE}_{name} {kind[:-1] if kind == 'gauges' else 'counter'}")
+                lines.append(f"{NAMESPACE}_{series} {value}")
+        typed = set()
+        for series, histogram in snapshot['histograms'].items():
+            name, _, labels = series.partition('{')
+            labels = labels[:-1]  # without the closing brace (a label value may end with one)
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {NAMESPACE}_{name} histogram")
+            separator = ',' if labels else ''
+            for bound, count in histogram['buckets'].items():
+                lines.append(f'{NAMESPACE}_{name}_bucket{{{labels}{separator}le="{bound}"}} {count}')
+            suffix = f"{{{labels}}}" if labels else ''
+            lines.append(f"{NAMESPACE}_{name}_sum{suffix} {histogram['sum']}")
+            lines.append(f"{NAMESPACE}_{name}_count{suffix} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+
+class PhaseTimer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.labels = dict(labels, phase=name)
+        self.aborted = False
+
+    def abort(self):
+        # the block ends before the phase completes (e.g. a timeout): its latency is not recorded
+        self.aborted = True
+
+    def __enter__(self):
+        if self.metrics.phase_hook is not None:
+            self.metrics.phase_hook(self.labels['phase'], True)
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = perf_counter() - self.start
+        if self.aborted or (exc_type is not None):
+            self.metrics.inc('phases_aborted_total', **self.labels)
+        else:
+            self.metrics.observe('phase_seconds', self.seconds, **self.labels)
+        if self.metrics.phase_hook is not None:
+            self.metrics.phase_hook(self.labels['phase'], False)
+
+
+def series_name(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{label}="{escape_label(value)}"' for label, value in labels) + '}'
+
+def escape_label(value):
+    # label value of the text format: backslash, double quote and line feed escaped
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_default_metrics = Metrics()  # metrics of this process
+
+def default_metrics():
+    return _default_metrics
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = _default_metrics.render(), 'text/plain; version=0.0.4'
+        elif self.path == '/snapshot':
+            body, content_type = json.dumps(_default_metrics.snapshot(), indent=1), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # the console belongs to the menu
+
+
+def serve_metrics(port, host = '127.0.0.1'):
+    # endpoint in a daemon thread; None if the port is not available
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    except OSError as e:
+        print(f"Metrics endpoint not available on {host}:{port} ({e})")
+        return None
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def serve_from_environment(party):
+    # port of the party from BB84_METRICS_PORT (default METRICS_PORT; 0: no endpoint)
+    base_port = int(os.environ.get('BB84_METRICS_PORT', METRICS_PORT))
+    if base_port == 0:
+        return None
+    return serve_metrics(base_port + ENDPOINT_PARTIES.index(party))
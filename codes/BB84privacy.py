@@ -0,0 +1,77 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84privacy.py - version 1.0
+
+# Privacy amplification: Alice and Bob compress their (equal) reconciled keys with the same random
+# Toeplitz matrix, so that the little information Eve has about the key becomes negligible
+# - the matrix (m x n) is given by its first row and column: n + m - 1 random bits, sent in clear
+# - product matrix * key (mod 2) computed as a convolution with FFT: O(n log n), not O(n*m)
+# - output length m from what Eve may know: the QBER and the bits disclosed on the public channel, and at most the
+#   finite-key length of BB84finitekey.py (the QBER of a finite sample is not exact)
+# Verification of the reconciled keys: both keys hashed with the same public random Toeplitz matrix to
+# VERIFICATION_BITS bits; different keys give the same hash with probability at most EPSILON_CORRECTNESS
+
+from math import ceil, floor, log2
+import numpy as np
+from BB84lib import bits_from_string, random_bits
+from BB84cascade import binary_entropy
+
+EPSILON = 1e-10  # probability that the final key is not secret
+EPSILON_CORRECTNESS = 1e-15  # probability that the keys of Alice and Bob differ after the verification
+VERIFICATION_BITS = ceil(log2(1 / EPSILON_CORRECTNESS))  # length of the hash compared (disclosed bits)
+
+
+def secure_key_length(n, qber, leaked_bits, epsilon = EPSILON):
+    # n * (1 - h(QBER)): bits of the key unknown to Eve (phase errors = bit errors in BB84),
+    # minus the bits disclosed (compared bits, parities of the reconciliation), minus the security margin
+    length = n * (1 - binary_entropy(qber)) - leaked_bits - 2 * log2(1 / epsilon)
+    return max(0, floor(length))
+
+
+def amplified_key_length(n, qber, leaked_bits, finite_key_bits = None, epsilon = EPSILON):
+    # output length of the Toeplitz hashing: the secure length, at most finite_key_bits (None: no bits compared)
+    length = secure_key_length(n, qber, leaked_bits, epsilon)
+    return length if finite_key_bits is None else min(length, max(0, int(finite_key_bits)))
+
+
+def toeplitz_seed(n, m, rng = None):
+    # random bits defining the Toeplitz matrix for a key of n bits compressed to m bits
+    return random_bits(n + m - 1, rng) if m > 0 else np.zeros(0, dtype=np.uint8)
+
+
+def fast_fft_size(length):
+    # smallest size >= length with only 2, 3 and 5 as prime factors (fast for the FFT)
+    best = 1 << (length - 1).bit_length()
+    power5 = 1
+    while power5 < best:
+        power35 = power5
+        while power35 < best:
+            size = power35
+            while size < length:
+                size *= 2
+            best = min(best, size)
+            power35 *= 3
+        power5 *= 5
+    return best
+
+
+def toeplitz_hash(key, seed):
+    # m = len(seed) - n + 1 output bits: out[i] = sum_j seed[i - j + n - 1] * key[j] (mod 2),
+    # that is the convolution seed * key, taken in [n-1 .. n+m-2]
+    key = bits_from_string(key)
+    seed = bits_from_string(seed)
+    n = len(key)
+    m = len(seed) - n + 1
+    if n == 0 or m <= 0:
+        return np.zeros(0, dtype=np.uint8)
+    # circular convolution of len(seed) points is enough: out[i] never wraps around (i - j + n - 1 >= 0)
+    size = fast_fft_size(len(seed))
+    product = np.fft.irfft(np.fft.rfft(seed, size) * np.fft.rfft(key, size), size)
+    # every value is an integer (at most n): exact after rounding, then mod 2
+    return (np.rint(product[n - 1:n - 1 + m]).astype(np.int64) & 1).astype(np.uint8)
+
+
+def verification_hash(key, seed):
+    # hash of a reconciled key: the same public seed (integer) for Alice and Bob, a new one for every key
+    n = len(bits_from_string(key))
+    return toeplitz_hash(key, toeplitz_seed(n, VERIFICATION_BITS, np.random.default_rng(seed)))
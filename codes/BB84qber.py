@@ -0,0 +1,121 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84qber.py - version 1.0
+
+# Estimation of the QBER (quantum bit error rate) from the bits of the key compared by Alice and Bob
+# - QBEREstimate: observed error rate with its confidence interval (Wilson score interval)
+# - SequentialTest: Wald's sequential probability ratio test, to stop comparing bits as soon as
+#   the key can be accepted (QBER of a clean channel) or must be aborted (QBER of an eavesdropped channel)
+
+from math import ceil, inf, log, sqrt
+from statistics import NormalDist
+import numpy as np
+from BB84lib import bits_from_string
+
+QBER_ACCEPT = 0.02  # QBER tolerated on the channel without Eve
+QBER_ABORT = 0.25   # QBER caused by an intercept-resend attack on every qubit
+CONFIDENCE = 0.95
+
+
+def count_errors(bits, other_bits):
+    # how many positions are different in two strings (or arrays) of bits
+    return int((bits_from_string(bits) != bits_from_string(other_bits)).sum())
+
+
+def reconciliation_qber(errors, samples, confidence = CONFIDENCE):
+    # QBER for the block sizes of the reconciliation: upper bound of the confidence interval, at least QBER_ACCEPT
+    # (a sample of a few bits without errors does not mean a key without errors: blocks too large leave errors)
+    if samples == 0:
+        return QBER_ACCEPT
+    return max(QBER_ACCEPT, QBEREstimate(errors, samples, confidence).high)
+
+
+class QBEREstimate:
+    def __init__(self, errors, samples, confidence = CONFIDENCE):
+        self.errors = errors
+        self.samples = samples
+        self.confidence = confidence
+        self.low, self.high = self.__wilson_interval()
+
+    @property
+    def qber(self):
+        if self.samples == 0:
+            return None
+        return self.errors / self.samples
+
+    def __wilson_interval(self):
+        # interval for the true QBER: good even with few samples and 0 errors (unlike qber +- z*sigma)
+        if self.samples == 0:
+            return 0.0, 1.0
+        z = NormalDist().inv_cdf(0.5 + self.confidence / 2)
+        n = self.samples
+        p = self.errors / n
+        denominator = 1 + z * z / n
+        center = (p + z * z / (2 * n)) / denominator
+        half_width = z * sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+        return max(0.0, center - half_width), min(1.0, center + half_width)
+
+    def __str__(self):
+        if self.samples == 0:
+            return "QBER unknown (no compared bits)"
+        return (f"QBER = {100 * self.qber:.2f}% ({self.errors} different bits out of {self.samples}), "
+                f"{100 * self.confidence:g}% confidence interval: [{100 * self.low:.2f}%, {100 * self.high:.2f}%]")
+
+
+class SequentialTest:
+    ACCEPT = 'accept'
+    ABORT = 'abort'
+
+    def __init__(self, qber_accept = QBER_ACCEPT, qber_abort = QBER_ABORT, alpha = 0.01, beta = 0.01):
+        # alpha: probability of aborting a clean key, beta: probability of accepting an eavesdropped key
+        self.qber_accept = qber_accept
+        self.qber_abort = qber_abort
+        self.alpha = alpha
+        self.beta = beta
+        # log-likelihood ratio (eavesdropped vs clean) added by each equal and each different bit
+        self.llr_equal = log((1 - qber_abort) / (1 - qber_accept))
+        self.llr_error = log(qber_abort / qber_accept) if qber_accept > 0 else inf
+        self.upper = log((1 - beta) / alpha)  # reached: abort
+        self.lower = log(beta / (1 - alpha))  # reached: accept
+        self.errors = 0
+        self.samples = 0
+        self.decision = None  # None while more bits are needed
+
+    def update(self, errors, samples):
+        # add the result of new compared bits: returns the decision (None if not taken yet)
+        self.errors += errors
+        self.samples += samples
+        llr = self.log_likelihood_ratio()
+        if llr >= self.upper:
+            self.decision = self.ABORT
+        elif llr <= self.lower:
+            self.decision = self.ACCEPT
+        return self.decision
+
+    def log_likelihood_ratio(self):
+        llr = (self.samples - self.errors) * self.llr_equal
+        if self.errors > 0:
+            llr += self.errors * self.llr_error
+        return llr
+
+    def min_samples_to_accept(self):
+        # bits to compare before a key without errors can be accepted
+        return ceil(self.lower / self.llr_equal)
+
+    def estimate(self, confidence = CONFIDENCE):
+        return QBEREstimate(self.errors, self.samples, confidence)
+
+
+def sequential_comparison(key, other_key, positions, test = None, round_bits = None):
+    # compare the bits of two keys in the given positions, a round at a time, until the test decides
+    # returns (test, positions actually compared)
+    test = SequentialTest() if test is None else test
+    round_bits = test.min_samples_to_accept() if round_bits is None else round_bits
+    key = bits_from_string(key)
+    other_key = bits_from_string(other_key)
+    compared = 0
+    while compared < len(positions) and test.decision is None:
+        chunk = np.asarray(positions[compared:compared + round_bits], dtype=np.intp)
+        test.update(int((key[chunk] != other_key[chunk]).sum()), len(chunk))
+        compared += len(chunk)
+    return test, positions[:compared]
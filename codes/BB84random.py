@@ -0,0 +1,163 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84random.py - version 1.0
+
+# Random numbers of the whole project, produced in bulk:
+# - pcg64 / philox: NumPy generators (seeded <-> reproducible runs)
+# - crypto:         bits and floats from the operating system (os.urandom), seeds are ignored
+# Bits are unpacked from blocks of random bytes and kept in a buffer: the hot paths never ask the
+# generator for one bit at a time.
+# Every party (Alice, Bob, Eve, channel, server) can have its own stream, all derived from one seed:
+# e.g. changing the strategy of Eve does not change the bits of Alice.
+# Processes of the same run can share the configuration with the environment variables BB84_RNG and BB84_SEED.
+
+import os
+import secrets
+from threading import Lock
+import numpy as np
+
+KINDS = ('pcg64', 'philox', 'crypto')
+PARTIES = ('Alice', 'Bob', 'Eve', 'channel', 'server')
+BLOCK_BYTES = 1 << 16  # random bytes drawn at a time to refill the buffer of bits
+
+
+class RandomSource:
+    # the subset of numpy.random.Generator used by the project, plus bits() (buffered)
+    def __init__(self, kind = 'pcg64', seed = None):
+        # seed: integer, sequence of integers or SeedSequence (None: fresh entropy)
+        if kind not in KINDS:
+            raise ValueError(f"unknown random generator '{kind}' (known: {', '.join(KINDS)})")
+        self.kind = kind
+        if kind == 'crypto':
+            self.generator = None
+        else:
+            bit_generator = np.random.PCG64 if kind == 'pcg64' else np.random.Philox
+            self.generator = np.random.Generator(bit_generator(seed))
+        self.buffer = np.zeros(0, dtype=np.uint8)  # random bits not used yet
+        self.refill = None  # last refill of the buffer: (state of the generator before it, bytes drawn, bits left before it)
+        self.origin = None  # (kind, seed of the run, party) of the default source: recorded in the traces
+        self.lock = Lock()  # clients draw bits from more than one thread
+
+    def random_bytes(self, n):
+        if self.generator is None:
+            return os.urandom(n)
+        return self.generator.bytes(n)
+
+    def bits(self, n):
+        # n random bits as an array of uint8 (each element is 0 or 1)
+        with self.lock:
+            if n > len(self.buffer):
+                block = max(BLOCK_BYTES, (n - len(self.buffer) + 7) // 8)
+                if self.generator is not None:
+                    self.refill = (self.generator.bit_generator.state, block, self.buffer)
+                fresh = np.unpackbits(np.frombuffer(self.random_bytes(block), dtype=np.uint8))
+                self.buffer = np.concatenate([self.buffer, fresh])
+            result = self.buffer[:n]
+            self.buffer = self.buffer[n:]
+        return result
+
+    def integers(self, low, high = None, size = None, dtype = np.int64):
+        if high is None:
+            low, high = 0, low
+        if (low, high) == (0, 2) and size is not None:
+            return self.bits(size).astype(dtype, copy=False)
+        return self.__generator().integers(low, high, size=size, dtype=dtype)
+
+    def random(self, size = None):
+        # floats in [0, 1) with 53 random bits
+        if self.generator is not None:
+            return self.generator.random(size)
+        values = (np.frombuffer(os.urandom(8 * (size or 1)), dtype=np.uint64) >> np.uint64(11)) * (1.0 / 2**53)
+        return values if size is not None else float(values[0])
+
+    def poisson(self, lam, size = None):
+        return self.__generator().poisson(lam, size)
+
+    def choice(self, a, size = None, replace = True):
+        return self.__generator().choice(a, size=size, replace=replace)
+
+    def get_state(self):
+        # state of the source (JSON): set_state() makes a source go on with the same numbers (crypto: no state)
+        # the buffer is not saved: it is drawn again from the state of the generator before the last refill
+        with self.lock:
+            if self.generator is None:
+                return {'kind': self.kind}
+            state = {'kind': self.kind, 'generator': json_state(self.generator.bit_generator.state), 'refill': None}
+            if self.refill is not None:
+                refill_state, block, left = self.refill
+                state['refill'] = {
+                    'generator': json_state(refill_state),
+                    'bytes': block,
+                    'left': np.packbits(left).tobytes().hex(),
+                    'left_bits': len(left),
+                    'used': len(left) + 8 * block - len(self.buffer)
+                    }
+            return state
+
+    def set_state(self, state):
+        if state['kind'] != self.kind:
+            raise ValueError(f"state of a '{state['kind']}' source, this source is '{self.kind}'")
+        if self.generator is None:
+            return
+        with self.lock:
+            self.buffer = np.zeros(0, dtype=np.uint8)
+            self.refill = None
+            refill = state['refill']
+            if refill is not None:
+                self.generator.bit_generator.state = refill['generator']
+                left = np.unpackbits(np.frombuffer(bytes.fromhex(refill['left']), dtype=np.uint8), count=refill['left_bits'])
+                self.refill = (self.generator.bit_generator.state, refill['bytes'], left)
+                fresh = np.unpackbits(np.frombuffer(self.random_bytes(refill['bytes']), dtype=np.uint8))
+                self.buffer = np.concatenate([left, fresh])[refill['used']:]
+            self.generator.bit_generator.state = state['generator']
+
+    def __generator(self):
+        # crypto mode: other distributions from a generator seeded by the operating system, each time
+        if self.generator is None:
+            return np.random.default_rng(secrets.randbits(128))
+        return self.generator
+
+
+def json_state(value):
+    # state of a NumPy bit generator with lists instead of arrays (the generators accept both)
+    if isinstance(value, dict):
+        return {key: json_state(item) for key, item in value.items()}
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+def party_seed(seed, party):
+    # seed of the stream of one party: same streams of party_sources(kind, seed)
+    return np.random.SeedSequence(seed, spawn_key=(PARTIES.index(party),))
+
+def party_sources(kind = 'pcg64', seed = None):
+    # independent stream for each party, all derived from one seed
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    return {party: RandomSource(kind, party_seed(seed, party)) for party in PARTIES}
+
+
+_default_source = RandomSource()  # used when no source is given
+
+def default_source():
+    return _default_source
+
+def set_default_source(kind = 'pcg64', seed = None, party = None):
+    # party: use the stream of that party (same bits of party_sources(kind, seed)[party])
+    global _default_source
+    origin = (kind, seed, party)
+    if (seed is not None) and (party is not None):
+        seed = party_seed(seed, party)
+    _default_source = RandomSource(kind, seed)
+    _default_source.origin = origin
+    return _default_source
+
+def configure_from_environment(party):
+    # BB84_RNG: kind of generator (default pcg64), BB84_SEED: seed of the run (default: fresh entropy)
+    # without BB84_SEED the entropy is drawn here, so that a trace of the process can record it
+    seed = os.environ.get('BB84_SEED')
+    seed = np.random.SeedSequence().entropy if seed is None else int(seed)
+    return set_default_source(os.environ.get('BB84_RNG', 'pcg64'), seed, party)
@@ -0,0 +1,293 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84replay.py - version 1.0
+
+# Offline replay of a process recorded with BB84_TRACE (see BB84trace.py): the same server or client runs again
+# in this process, without sockets, without screen and without waits, from the same random seed.
+# The recorded messages and typed lines are delivered in the recorded order, each one only after the process
+# has sent what it had sent before it (and finished handling the previous typed line): every message the process
+# sends is compared with the recorded one (in order for each peer and opcode: threads of the same process may
+# interleave differently), so a deterministic run is reproduced exactly, and the first divergence shows
+# where a run went wrong.
+# usage as script:   python BB84replay.py path [--show-output]
+
+import os
+import sys
+import tempfile
+from collections import deque
+from contextlib import redirect_stdout
+from threading import Condition
+from time import perf_counter
+import CUlib
+from CUlib import Console, OP_HELLO, OP_CLIENT_CONNECTED, OP_REJECTED, OPCODE_NAMES
+from BB84codec import CODECS
+from BB84random import set_default_source
+from BB84trace import read_trace, START, SEED, SENT, RECEIVED, INPUT, CLOSED
+
+CAUSAL_TIMEOUT = 5  # seconds to wait for the process before delivering the next record anyway
+MAX_DIVERGENCES = 20  # divergences kept in the report
+
+
+class ReplayConnection:
+    # connection to a recorded peer: what the process sends is compared with the trace
+    def __init__(self, replayer, peer):
+        self.replayer = replayer
+        self.peer = peer
+
+    def send(self, opcode, payload=b''):
+        if type(payload) is str:
+            payload = payload.encode('utf-8')
+        self.replayer.on_send(self.peer, opcode, payload)
+
+    def close(self):
+        pass
+
+
+class ReplayConsole(Console):
+    # recorded lines instead of the keyboard, no screen and no waits
+    def __init__(self, replayer):
+        self.replayer = replayer
+
+    def read_line(self, prompt=''):
+        return self.replayer.next_line()
+
+    def clear(self):
+        pass
+
+    def wait(self, seconds):
+        pass
+
+
+class Replayer:
+    def __init__(self, path):
+        self.path = path
+        self.condition = Condition()
+        self.expected = {}   # (peer, opcode) -> recorded payloads not sent yet by the process
+        self.actual = {}     # (peer, opcode) -> payloads sent by the process and not recorded yet
+        self.expected_count = 0
+        self.sent_count = 0
+        self.lines = deque()   # typed lines delivered, not read yet
+        self.lines_delivered = 0
+        self.lines_read = 0
+        self.waiting_line = False  # the process is waiting for a typed line
+        self.sent_since_line = True  # the trace has messages sent after the last typed line
+        self.matched = 0
+        self.divergences = []
+        self.divergence_count = 0
+        self.sessions = {}  # server: peer -> session of the connected clients
+        self.session_ids = {}  # server: session id -> session (also after the clients disconnected)
+        self.party = None
+        self.process = None
+        self.replayable = True
+
+    def run(self):
+        records = read_trace(self.path)
+        start = perf_counter()
+        delivered = 0
+        for kind, seconds, peer, data in records:
+            if kind == START:
+                self.party, session_id = data.decode('utf-8').split('\n')
+            elif kind == SEED:
+                self.__create_process(session_id, *data.decode('utf-8').split('\n'))
+            elif kind == SENT:
+                self.__expect(peer, data[0], data[1:])
+            elif kind in (RECEIVED, INPUT, CLOSED):
+                self.__wait_causality()
+                if kind == INPUT:
+                    self.__deliver_line(data.decode('utf-8'))
+                elif kind == RECEIVED:
+                    try:
+                        self.__deliver_message(peer, data[0], data[1:])
+                    except Exception as e:  # the process diverged: the recorded messages may not fit its state
+                        self.__diverge(f"{self.party} failed handling {OPCODE_NAMES.get(data[0], data[0])} from {peer}: {e!r}")
+                else:
+                    self.__deliver_closed(peer)
+                delivered += 1
+        # the last answers of the process, until it waits for the next typed line
+        self.__wait_causality(final=True)
+        for (peer, opcode), payloads in self.expected.items():
+            for payload in payloads:
+                self.__diverge(f"missing: {self.party} did not send {OPCODE_NAMES.get(opcode, opcode)} to {peer}")
+        for (peer, opcode), payloads in self.actual.items():
+            for payload in payloads:
+                self.__diverge(f"unexpected: {self.party} sent {OPCODE_NAMES.get(opcode, opcode)} to {peer}")
+        return {
+            'party': self.party,
+            'replayable': self.replayable,
+            'records delivered': delivered,
+            'messages reproduced': self.matched,
+            'divergences': self.divergence_count,
+            'first divergences': list(self.divergences),
+            'replay time (s)': perf_counter() - start,
+            **self.__state()
+            }
+
+
+    def __create_process(self, session_id, kind, seed, party):
+        # the process of the trace, with the recorded random stream
+        from BB84_Alice import Alice
+        from BB84_Bob import Bob
+        from BB84_Eve import Eve
+        from BB84_server import BB84Server
+        if kind == 'crypto' or not seed:
+            self.replayable = False  # random numbers of the operating system: not reproducible
+        if self.party == 'server':
+            self.process = BB84Server()
+            self.process.tr_handle_input.daemon = True
+        else:
+            self.process = {'Alice': Alice, 'Bob': Bob, 'Eve': Eve}[self.party](session_id)
+            self.process.connection = ReplayConnection(self, 'server')
+            self.process.th_handle_menu.daemon = True
+        set_default_source(kind, int(seed) if seed else None, party or None)
+        if self.party == 'server':
+            self.process.tr_handle_input.start()
+
+
+    def __expect(self, peer, opcode, payload):
+        if (opcode == OP_HELLO) and (self.party != 'server'):
+            return  # the client is connected by the replay itself
+        with self.condition:
+            self.expected.setdefault((peer, opcode), deque()).append(payload)
+            self.expected_count += 1
+            self.sent_since_line = True
+            self.__match(peer, opcode)
+
+    def on_send(self, peer, opcode, payload):
+        with self.condition:
+            self.actual.setdefault((peer, opcode), deque()).append(payload)
+            self.sent_count += 1
+            self.__match(peer, opcode)
+            self.condition.notify_all()
+
+    def __match(self, peer, opcode):
+        expected = self.expected.get((peer, opcode))
+        actual = self.actual.get((peer, opcode))
+        while expected and actual:
+            expected_payload = expected.popleft()
+            payload = actual.popleft()
+            if payload == expected_payload:
+                self.matched += 1
+            else:
+                self.__diverge(f"{self.party} sent {OPCODE_NAMES.get(opcode, opcode)} to {peer} with a payload different "
+                               f"from the recorded one ({len(payload)} and {len(expected_payload)} bytes)")
+
+    def __diverge(self, description):
+        self.divergence_count += 1
+        if len(self.divergences) < MAX_DIVERGENCES:
+            self.divergences.append(description)
+
+
+    def __wait_causality(self, final = False):
+        # everything sent before the next record has been sent again, and the last typed line has been handled
+        # (final: the process is idle, waiting for a line, if it reads any)
+        idle = lambda: self.waiting_line or not self.__reads_lines()
+        with self.condition:
+            ready = self.condition.wait_for(lambda: (self.sent_count >= self.expected_count) and
+                                                    (self.lines_read == self.lines_delivered) and
+                                                    (self.sent_since_line or self.waiting_line) and
+                                                    ((not final) or idle()), CAUSAL_TIMEOUT)
+            if not ready:
+                self.__diverge(f"{self.party} did not reach the state of the trace in {CAUSAL_TIMEOUT} seconds")
+
+    def __reads_lines(self):
+        # console of the server or menu of a connected client
+        if self.party == 'server':
+            return True
+        return (self.process is not None) and self.process.th_handle_menu.is_alive()
+
+    def __deliver_line(self, line):
+        with self.condition:
+            self.lines.append(line)
+            self.lines_delivered += 1
+            self.sent_since_line = False
+            self.condition.notify_all()
+
+    def next_line(self):
+        with self.condition:
+            self.waiting_line = True
+            self.condition.notify_all()
+            self.condition.wait_for(lambda: len(self.lines) > 0)
+            self.waiting_line = False
+            self.lines_read += 1
+            return self.lines.popleft()
+
+    def __deliver_message(self, peer, opcode, payload):
+        if self.party == 'server':
+            self.__deliver_to_server(peer, opcode, payload)
+            return
+        client = self.process
+        if opcode == OP_CLIENT_CONNECTED:
+            client.codec = CODECS[payload.decode('utf-8')]
+            client.connected = True
+            if client.menu_max_choices > 0:
+                client.th_handle_menu.start()
+        elif opcode != OP_REJECTED:
+            handler = client.response_handlers.get(opcode)
+            if handler is not None:
+                handler(payload)
+
+    def __deliver_closed(self, peer):
+        # a client of the server disconnected
+        session = self.sessions.pop(peer, None)
+        if (self.party == 'server') and (session is not None):
+            self.process.unregister_client(session, peer.split('@')[0])
+
+    def __deliver_to_server(self, peer, opcode, payload):
+        from BB84_server import parse_hello, client_peer
+        if opcode == OP_HELLO:
+            client_name, offered_codecs, session_id = parse_hello(payload)
+            peer = client_peer(client_name, session_id)
+            session = self.process.register_client(session_id, client_name, (ReplayConnection(self, peer), 'replay'), offered_codecs)
+            if session is not None:
+                self.sessions[peer] = session
+                self.session_ids[session_id] = session
+            return
+        session = self.sessions.get(peer)
+        if session is not None:
+            self.process.dispatch_request(session, peer.split('@')[0], opcode, payload)
+
+
+    def __state(self):
+        # results of the replayed process
+        process = self.process
+        if self.party == 'server':
+            return {f"session '{session_id}': sifted key (bits)": session.key_length for session_id, session in self.session_ids.items()}
+        state = {}
+        if self.party in ('Alice', 'Bob'):
+            key = process.a if self.party == 'Alice' else process.a1
+            state['key (bits)'] = len(key)
+            state['secret key (bits)'] = len(process.secret_key)
+            state['secret key'] = process.secret_key[:64] + ('...' if len(process.secret_key) > 64 else '')
+        return state
+
+
+def replay(path, output = None):
+    # replay a trace: returns the report (dict); output: stream of what the process prints (None: discarded)
+    os.environ['BB84_METRICS_PORT'] = '0'  # no endpoints
+    os.environ.pop('BB84_TRACE', None)      # the replay is not recorded again
+    os.environ['BB84_KEY_POOL'] = tempfile.mkdtemp(prefix='bb84_replay_')  # keys of the replay apart
+    os.environ.pop('BB84_CHECKPOINT', None)  # the replay does not touch the checkpoints of the run
+    replayer = Replayer(path)
+    previous_console = CUlib.console
+    CUlib.set_console(ReplayConsole(replayer))
+    try:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(output if output is not None else devnull):
+            return replayer.run()
+    finally:
+        CUlib.set_console(previous_console)
+
+
+if __name__ == "__main__":
+    import argparse
+    from CUlib import print_in_table
+
+    parser = argparse.ArgumentParser(description="Replay a process recorded with BB84_TRACE, offline and at full speed")
+    parser.add_argument("path", help="trace of the server or of a client")
+    parser.add_argument("--show-output", action="store_true", help="show what the replayed process prints")
+    args = parser.parse_args()
+
+    report = replay(args.path, sys.stdout if args.show_output else None)
+    print_in_table([[key, str(value)] for key, value in report.items() if key != 'first divergences'])
+    for divergence in report['first divergences']:
+        print(divergence)
+    sys.exit(0 if report['divergences'] == 0 else 1)
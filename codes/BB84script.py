@@ -0,0 +1,94 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84script.py - version 1.0
+
+# Scripted mode of the server and of the clients: a run is described by a script (JSON file, every key optional,
+# see SCRIPT_DEFAULTS), and every process started with --script <file> executes it without console and without
+# input(): the server waits for the clients of the session and drives each round (Alice prepares or streams the
+# qubits when the server asks, Eve and Bob measure them, then sifting, detection of Eve, reconciliation and
+# privacy amplification; a round where Eve is detected is aborted after the detection, its key is discarded, and so is a key whose
+# verification hash after the reconciliation differs),
+# then every process writes its results in <results>/<party>_<session>.json.
+# BB84_batch.py starts server and clients with the same script and merges their results.
+# example of script:  {"n": 10000, "rounds": 3, "stream": true, "eve": true, "strategy": "breidbart",
+#                      "sample_bits": 200, "channel": {"length_km": 20, "dark_count": 0.001}}
+
+import os
+import json
+from CUlib import Console, set_console, DEFAULT_SESSION
+from BB84channel import ChannelModel
+from BB84attacks import STRATEGIES, InterceptResendAttack
+
+SCRIPT_DEFAULTS = {
+    'session': DEFAULT_SESSION,  # session of the clients
+    'rounds': 1,                 # key exchanges, one after the other
+    'n': 1000,                   # qubits sent by Alice in each round
+    'stream': False,             # frames of FRAME_QUBITS qubits, sifted while the next ones are sent
+    'eve': False,                # Eve is connected and attacks the qubits
+    'strategy': InterceptResendAttack.name,  # attack of Eve (only the strategies that resend qubits)
+    'intercept': 1.0,            # fraction of the qubits attacked by Eve
+    'sample_bits': 100,          # bits of the key compared to detect Eve (0: no detection)
+    'reconcile': True,           # correct Bob's key with Cascade
+    'amplify': True,             # compress the keys with privacy amplification
+    'rate': 'instant',           # rate at which Bob and Eve show the received qubits (slow, fast, instant)
+    'channel': {},               # parameters of ChannelModel (length_km, attenuation, depolarization, ...)
+    'timeout': 60,               # seconds to wait for the clients, and for the quantum state of each round
+    'results': 'results'         # directory of the results
+    }
+RATES = ('slow', 'fast', 'instant')
+
+
+def load_script(path):
+    # script of a JSON file, completed with the defaults
+    with open(path) as file:
+        return complete_script(json.load(file))
+
+def complete_script(script):
+    unknown = set(script) - set(SCRIPT_DEFAULTS)
+    if unknown:
+        raise ValueError(f"unknown keys in the script: {', '.join(sorted(unknown))}")
+    script = dict(SCRIPT_DEFAULTS, **script)
+    if script['rate'] not in RATES:
+        raise ValueError(f"rate must be one of {', '.join(RATES)}")
+    if script['strategy'] not in STRATEGIES or not STRATEGIES[script['strategy']].resends_qubits:
+        raise ValueError(f"strategy must be one of {', '.join(name for name, strategy in STRATEGIES.items() if strategy.resends_qubits)}")
+    channel_from_script(script)  # unknown parameters of the channel
+    return script
+
+def script_from_arguments(arguments):
+    # --script <file> among the arguments of a process: (script or None, the other arguments)
+    if '--script' not in arguments:
+        return None, arguments
+    position = arguments.index('--script')
+    return load_script(arguments[position + 1]), arguments[:position] + arguments[position + 2:]
+
+
+def channel_from_script(script):
+    return ChannelModel(**script['channel'])
+
+def strategy_from_script(script):
+    return STRATEGIES[script['strategy']](script['intercept'])
+
+
+class HeadlessConsole(Console):
+    # no keyboard, no screen to clear and no waits
+    def read_line(self, prompt=''):
+        raise EOFError("no console in scripted mode")
+
+    def clear(self):
+        pass
+
+    def wait(self, seconds):
+        pass
+
+def start_headless():
+    set_console(HeadlessConsole())
+
+
+def results_path(script, party):
+    return os.path.join(script['results'], f"{party}_{script['session']}.json")
+
+def write_results(script, party, results):
+    os.makedirs(script['results'], exist_ok=True)
+    with open(results_path(script, party), 'w') as file:
+        json.dump(results, file, indent=1)
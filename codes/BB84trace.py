@@ -0,0 +1,132 @@
+# Quantum Key Distribution simulation: BB84 protocol
+# by Manuel Maiuolo (manuelmaiuolo@gmail.com)
+# BB84trace.py - version 1.0
+
+# Binary trace of a process (server, Alice, Bob or Eve): everything that is not decided by the code itself,
+# so that BB84replay.py can run the process again, offline, and obtain the same results:
+# - START:              party and session of the process
+# - SEED:               generator and seed of its random stream
+# - SENT / RECEIVED:    every framed message (peer, opcode, payload)
+# - INPUT:              every line typed by the user
+# - PHASE_BEGIN / END:  boundaries of the phases of the protocol (same names of the metrics)
+# - CLOSED:             a peer disconnected
+# Format: MAGIC, then records = RECORD header (kind, seconds since the start, length of the peer name,
+# length of the data) + peer name + data. Records are written as they happen and read one at a time:
+# traces of any size are never loaded whole.
+# Recording starts when the environment variable BB84_TRACE names a directory: <party>_<session>.trace
+# usage as script:   python BB84trace.py path [--limit n]   (list the records)
+
+import os
+import atexit
+from time import perf_counter
+from struct import Struct
+from threading import Lock
+from CUlib import set_tracer, OPCODE_NAMES
+from BB84metrics import default_metrics
+from BB84random import default_source
+
+MAGIC = b'BB84TRACE\x01'
+RECORD = Struct('<BdHI')  # kind, seconds since the start of the trace, bytes of the peer name, bytes of the data
+START, SEED, SENT, RECEIVED, INPUT, PHASE_BEGIN, PHASE_END, CLOSED = range(8)
+KIND_NAMES = ('start', 'seed', 'sent', 'received', 'input', 'phase begin', 'phase end', 'closed')
+READ_BUFFER = 1 << 20
+
+
+class TraceWriter:
+    def __init__(self, path, party, session_id = None):
+        self.path = path
+        self.lock = Lock()  # records come from the threads of the clients and from the event loop of the server
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.start = perf_counter()
+        self.write(START, data=f"{party}\n{session_id or ''}".encode('utf-8'))
+
+    def write(self, kind, peer = None, data = b''):
+        peer = (peer or '').encode('utf-8')
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(RECORD.pack(kind, perf_counter() - self.start, len(peer), len(data)) + peer)
+            self.file.write(data)
+            # every record reaches the operating system: the trace survives a killed process
+            self.file.flush()
+
+    def message(self, direction, peer, opcode, payload):
+        self.write(SENT if direction == 'sent' else RECEIVED, peer, bytes([opcode]) + payload)
+
+    def input(self, line):
+        self.write(INPUT, data=line.encode('utf-8'))
+
+    def seed(self, origin):
+        # origin of a random source: (kind, seed of the run, party)
+        kind, seed, party = origin
+        self.write(SEED, data=f"{kind}\n{'' if seed is None else seed}\n{party or ''}".encode('utf-8'))
+
+    def phase(self, name, begin):
+        self.write(PHASE_BEGIN if begin else PHASE_END, data=name.encode('utf-8'))
+
+    def closed(self, peer):
+        self.write(CLOSED, peer)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_trace(path):
+    # records of a trace, one at a time: (kind, seconds since the start, peer, data)
+    with open(path, 'rb', buffering=READ_BUFFER) as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"'{path}' is not a BB84 trace")
+        while True:
+            header = file.read(RECORD.size)
+            if len(header) < RECORD.size:  # end of the trace (or record cut by a killed process)
+                return
+            kind, seconds, peer_length, data_length = RECORD.unpack(header)
+            peer = file.read(peer_length).decode('utf-8')
+            data = file.read(data_length)
+            if len(data) < data_length:
+                return
+            yield kind, seconds, peer, data
+
+
+def describe_record(kind, seconds, peer, data):
+    # one line for each record (payloads are shown only by their size)
+    if kind in (SENT, RECEIVED):
+        arrow = '->' if kind == SENT else '<-'
+        return f"{seconds:12.6f}  {KIND_NAMES[kind]:<11} {arrow} {peer:<16} {OPCODE_NAMES.get(data[0], data[0])} ({len(data) - 1} bytes)"
+    if kind == CLOSED:
+        return f"{seconds:12.6f}  {KIND_NAMES[kind]:<11} {peer}"
+    return f"{seconds:12.6f}  {KIND_NAMES[kind]:<11} {data.decode('utf-8')!r}"
+
+
+def start_from_environment(party, session_id = None):
+    # record this process if BB84_TRACE names a directory: returns the writer (None if not recording)
+    directory = os.environ.get('BB84_TRACE')
+    if not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    name = party if session_id is None else f"{party}_{session_id}"
+    writer = TraceWriter(os.path.join(directory, name + '.trace'), party, session_id)
+    if default_source().origin is not None:
+        writer.seed(default_source().origin)
+    set_tracer(writer)
+    default_metrics().phase_hook = writer.phase
+    atexit.register(writer.close)
+    return writer
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="List the records of a BB84 trace")
+    parser.add_argument("path", help="trace recorded with BB84_TRACE")
+    parser.add_argument("--limit", type=int, default=None, help="list only the first n records")
+    args = parser.parse_args()
+
+    counts = [0] * len(KIND_NAMES)
+    for index, record in enumerate(read_trace(args.path)):
+        if (args.limit is None) or (index < args.limit):
+            print(describe_record(*record))
+        counts[record[0]] += 1
+    print(', '.join(f"{count} {name}" for name, count in zip(KIND_NAMES, counts) if count > 0))
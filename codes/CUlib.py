@@ -4,27 +4,181 @@
 
 # Common Useful Library
 from os import system as os_system, name as os_name
+from socket import SOMAXCONN
+from shutil import get_terminal_size
+from struct import Struct
+from threading import Lock, Thread, Event
+from time import sleep, perf_counter
+from BB84metrics import default_metrics
 
 # parameters to create local TCP for BB84_client.py
 SERVER_PORT = 12084
-BUFFER = 1024
+LISTEN_BACKLOG = SOMAXCONN  # connections waiting to be accepted: the clients of many sessions connect at once
+BUFFER = 65536
+REQUEST_TIMEOUT = 10  # seconds the server waits for the answer of a client
+DEFAULT_SESSION = "default"  # session joined by clients that do not ask for a specific one
+FRAME_QUBITS = 4096  # qubits in each frame of the streaming mode
+STREAM_WINDOW = 4  # frames Alice can send before the bases of the oldest one are exchanged
+PROGRESS_FPS = 10  # redraws per second of the progress of a long operation
+PROGRESS_WINDOW = 32  # qubits shown while they are received (the last ones, for longer strings)
+PACED_MAX_QUBITS = 256  # longer receptions are not shown qubit by qubit: only their summary (count, rate, ETA)
+PACED_STEPS = 50  # steps of the summary of a longer reception (one wait of the reception rate each)
 ###
 
-# constants used from BB84_server.py and from BB84_client.py
-TXT_CLIENT_CONNECTED = "client connected"
-TXT_CAN_RECEIVE = "can receive"
-TXT_READY = "ready"
-TXT_NOT_READY = "not ready"
-TXT_WAIT = "wait"
-TXT_CONTINUE = "continue"
+# limits of the tables printed by print_in_table
+TABLE_MAX_COLUMNS = 128  # columns shown at most: the first and the last ones
+TABLE_MAX_CELL = 256     # characters of a cell shown at most: the first and the last ones
+TABLE_PREVIEW = 8        # cells shown at the beginning and at the end of each row of the summary view
 ###
 
+# framing of every message on the sockets: header (payload length, opcode) + payload
+FRAME_HEADER = Struct('!IB')  # 4 bytes unsigned length (big-endian) + 1 byte opcode
+###
+
+# opcodes used from BB84_server.py and from BB84_client.py
+# connection management
+OP_HELLO = 1              # client -> server: client name
+OP_CLIENT_CONNECTED = 2   # server -> client: connection accepted
+OP_REJECTED = 3           # server -> client: connection refused (payload: reason)
+OP_READY = 4
+OP_NOT_READY = 5
+OP_WAIT = 6
+OP_CONTINUE = 7
+# BB84 protocol
+OP_SEND_QUBITS = 10       # Alice/Eve -> server: quantum state sent on the quantum channel
+OP_RECEIVE_QUBITS = 11    # server -> Eve/Bob: quantum state to be measured
+OP_SEND_B = 12            # server -> Alice: request of string b; Alice -> server: string b
+OP_RECEIVE_B1 = 13        # server -> Alice: Bob's string b'
+OP_SEND_SOME_A = 14       # server -> Alice: key-request; Alice -> server: requested bits of a
+OP_SEND_B1 = 15           # server -> Bob: request of string b'; Bob -> server: string b'
+OP_RECEIVE_B = 16         # server -> Bob: Alice's string b
+OP_SEND_SOME_A1 = 17      # server -> Bob: key-request; Bob -> server: requested bits of a'
+# BB84 protocol, streaming mode (frames are prefixed by their index, see BB84codec.encode_frame)
+OP_STREAM_START = 18      # Alice -> server -> Eve/Bob: a stream of frames begins (payload: number of qubits)
+OP_QUBIT_FRAME = 19       # Alice/Eve -> server -> Eve/Bob: one frame of qubits
+OP_FRAME_B1 = 20          # Bob -> server -> Alice: string b' of a measured frame
+OP_FRAME_B = 21           # Alice -> server -> Bob: string b of the same frame (both sift it)
+OP_STREAM_END = 22        # Alice -> server -> Eve/Bob: all the frames are sifted (payload: number of frames)
+OP_STREAM_RESUME = 29     # Bob -> server -> Alice/Eve: first frame of a stream with checkpoints (payload: frame, bits already sifted)
+# BB84 protocol, error reconciliation (Cascade)
+OP_RECONCILE = 23         # server -> Alice/Bob: start (payload: seed, estimated QBER); Bob -> server: done (payload: corrected bits)
+OP_PARITY_QUERIES = 24    # Bob -> server -> Alice: blocks of the key whose parity is asked
+OP_PARITIES = 25          # Alice -> server -> Bob: parities of the asked blocks
+OP_VERIFY = 33            # server -> Alice/Bob: hash the reconciled key (payload: seed); Alice/Bob -> server: the hash
+# BB84 protocol, privacy amplification
+OP_AMPLIFY = 26           # server -> Alice: secret key length; Alice -> server -> Bob: Toeplitz seed; Bob -> server: done
+# scripted mode (see BB84script.py)
+OP_SCRIPT_ROUND = 27      # server -> Alice: prepare and send the qubits of a round (payload: 'classic' or 'stream', n)
+OP_SCRIPT_END = 28        # server -> clients: the script is completed (clients write their results and disconnect)
+# distributed simulation (see BB84_distributed.py), coordinator <-> workers
+OP_WORK_TASK = 30         # coordinator -> worker: a task (payload: JSON)
+OP_WORK_RESULT = 31       # worker -> coordinator: result of the task (payload: JSON, then the packed sifted keys)
+OP_WORK_END = 32          # coordinator -> worker: no more tasks (the worker exits)
+# names of the opcodes (labels of the metrics): opcode -> e.g. 'send_qubits'
+OPCODE_NAMES = {value: name[3:].lower() for name, value in list(globals().items()) if name.startswith('OP_')}
+###
+
+"""console of this process: lines typed by the user, screen and waits (replaced when a trace is replayed)"""
+class Console:
+    def read_line(self, prompt=''):
+        return input(prompt)
+
+    def clear(self):
+        if os_name == 'nt':  # for windows
+            os_system('cls')
+        else:  # for mac and linux(here, os.name is 'posix')
+            os_system('clear')
+
+    def wait(self, seconds):
+        sleep(seconds)
+
+console = Console()
+tracer = None  # BB84trace.TraceWriter recording this process (None: no trace)
+
+def set_console(new_console):
+    global console
+    console = new_console
+
+def set_tracer(new_tracer):
+    global tracer
+    tracer = new_tracer
+
+"""read a line typed by the user (recorded in the trace, if any)"""
+def read_line(prompt=''):
+    line = console.read_line(prompt)
+    if tracer is not None:
+        tracer.input(line)
+    return line
+
+"""wait some seconds (e.g. to show the qubits one by one)"""
+def wait_seconds(seconds):
+    console.wait(seconds)
+
+"""redraw the progress of a long operation, at most PROGRESS_FPS times per second"""
+class ProgressRenderer:
+    # the operation only calls update(done, state): drawing happens in the thread of the renderer, only if something
+    # changed since the last frame, so the console never slows down the operation (draw: function(renderer, state)).
+    # state is a snapshot the operation does not change after update (e.g. a tuple of new objects): the renderer
+    # never reads the objects the operation is changing
+    def __init__(self, total, draw, fps = PROGRESS_FPS):
+        self.total = total
+        self.draw = draw
+        self.interval = 1 / fps
+        self.lock = Lock()
+        self.done = 0
+        self.state = None
+        self.changed = True  # first frame as soon as possible
+        self.start = perf_counter()
+        self.stopped = Event()
+        self.thread = Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def update(self, done, state = None):
+        with self.lock:
+            self.done = done
+            self.state = state
+            self.changed = True
+
+    def finish(self, redraw = True):
+        # stop the thread (and draw the last state, if it was not drawn yet)
+        self.stopped.set()
+        self.thread.join()
+        if redraw:
+            self.__redraw()
+
+    def rate(self):
+        # done per second since the start
+        return self.done / max(perf_counter() - self.start, 1e-9)
+
+    def eta(self):
+        # seconds to the end (None: unknown)
+        rate = self.rate()
+        return (self.total - self.done) / rate if rate > 0 else None
+
+    def summary(self):
+        eta = self.eta()
+        percentage = 100 * self.done // self.total if self.total > 0 else 100
+        return (f"{self.done}/{self.total} ({percentage}%), {self.rate():.1f}/s, "
+                f"ETA {'-' if eta is None else f'{eta:.1f} s'}")
+
+    def __run(self):
+        while not self.stopped.wait(self.interval):
+            self.__redraw()
+
+    def __redraw(self):
+        with self.lock:
+            if not self.changed:
+                return
+            self.changed = False
+            state = self.state
+        self.draw(self, state)
+
 """loop input to get valid integer value in [minVal..maxVal]"""
 def input_int(minVal, maxVal, errorSentence=''):
     valid = False
     while not valid:
         try:
-            result = int(input())
+            result = int(read_line())
             if (result < minVal) or (result > maxVal):
                 print(errorSentence, end='')
             else:
@@ -33,20 +187,90 @@ def input_int(minVal, maxVal, errorSentence=''):
             print(errorSentence, end='')
     return result
 
-"""wait for message from connection_socket"""
-def receive(connection_socket):
-    return connection_socket.recv(BUFFER).decode('utf-8')
+def input_float(minVal, maxVal, errorSentence=''):
+    valid = False
+    while not valid:
+        try:
+            result = float(read_line())
+            if (result < minVal) or (result > maxVal):
+                print(errorSentence, end='')
+            else:
+                valid = True
+        except ValueError:
+            print(errorSentence, end='')
+    return result
+
+"""framed messages over a connected socket: no truncation, no coalescing, thread-safe send"""
+class Connection:
+    def __init__(self, connection_socket):
+        self.socket = connection_socket
+        self.buffer = bytearray()  # bytes received but not yet returned as a frame
+        self.send_lock = Lock()
+        self.peer = None  # name of the other side, in the metrics and in the trace
+
+    def send(self, opcode, payload=b''):
+        if type(payload) is str:
+            payload = payload.encode('utf-8')
+        with self.send_lock:
+            # counted (and traced) before the answer can arrive
+            count_message('sent', opcode, payload, self.peer)
+            self.socket.sendall(FRAME_HEADER.pack(len(payload), opcode) + payload)
+
+    def receive(self):
+        # wait for the header
+        while len(self.buffer) < FRAME_HEADER.size:
+            self.__fill_buffer()
+        length, opcode = FRAME_HEADER.unpack_from(self.buffer)
+        end = FRAME_HEADER.size + length
+        if len(self.buffer) >= end:  # whole frame already buffered
+            payload = bytes(self.buffer[FRAME_HEADER.size:end])
+            del self.buffer[:end]
+            count_message('received', opcode, payload, self.peer)
+            return opcode, payload
+        # big frame: read the rest of the payload directly in place
+        payload = bytearray(length)
+        view = memoryview(payload)
+        received = len(self.buffer) - FRAME_HEADER.size
+        view[:received] = self.buffer[FRAME_HEADER.size:]
+        self.buffer.clear()
+        while received < length:
+            count = self.socket.recv_into(view[received:])
+            if count == 0:
+                raise ConnectionResetError
+            received += count
+        payload = bytes(payload)
+        count_message('received', opcode, payload, self.peer)
+        return opcode, payload
+
+    def __fill_buffer(self):
+        chunk = self.socket.recv(BUFFER)
+        if not chunk:  # connection closed by the other side
+            raise ConnectionResetError
+        self.buffer += chunk
+
+    def close(self):
+        self.socket.close()
+
+"""wait for the next frame from connection: returns (opcode, payload as bytes)"""
+def receive(connection):
+    return connection.receive()
+
+"""send a frame (opcode + payload as string or bytes) to connection"""
+def send(connection, opcode, payload=b''):
+    connection.send(opcode, payload)
 
-"""send message to connection_socket"""
-def send(connection_socket, message):
-    connection_socket.send(message.encode('utf-8'))
+"""count a frame sent or received (direction) in the metrics of this process, and record it in the trace"""
+def count_message(direction, opcode, payload, peer=None):
+    name = OPCODE_NAMES.get(opcode, str(opcode))
+    metrics = default_metrics()
+    metrics.inc(f"messages_{direction}_total", opcode=name)
+    metrics.inc(f"bytes_{direction}_total", FRAME_HEADER.size + len(payload), opcode=name)
+    if tracer is not None:
+        tracer.message(direction, peer, opcode, payload)
 
 """clear console screen"""
 def clear():
-    if os_name == 'nt':  # for windows
-        os_system('cls')
-    else:  # for mac and linux(here, os.name is 'posix')
-        os_system('clear')
+    console.clear()
 
 """set console title"""
 def set_title(title):
@@ -69,61 +293,118 @@ def print_in_box(lines):
     print(boxHorizontal)
 
 """print each tuple in list as row in a table"""
-def print_in_table(rows, min_cols=0):
+def print_in_table(rows, min_cols=0, summary=False, width=None):
     # if element is iterable and not string: expand row to have each element in a new column
-    newRows = []
-    for row in rows:
-        newRow = []
-        for cell in row:
-            if type(cell) is str:
-                newRow.append(cell)
-            else:
-                try:
-                    newRow.extend(cell)
-                except TypeError:
-                    newRow.append(cell)
-        # consider appending columns to respect min_cols request
-        colsToAdd = max(0, min_cols-len(newRow))
-        if colsToAdd > 0:
-            for _ in range(colsToAdd):
-                newRow.append('')
-        newRows.append(newRow)
-    rows = newRows
+    # only the columns shown are read (sequences are sliced, never copied): at most TABLE_MAX_COLUMNS,
+    # the first and the last ones, so a row of 10^5 qubits costs as much as a short one
+    # summary: one row for each row, with its first cell, the number of the other cells and a preview of them
+    # width: characters of a line (default: width of the terminal, no limit if not a terminal); wider tables
+    # are printed in pages of columns, each one starting again with the first column
+    rows = [table_segments(row) for row in rows]
+    if summary:
+        rows = [table_segments(summary_row(segments)) for segments in rows]
+    lengths = [sum(len(segment) for segment in segments) for segments in rows]
+    n_cols = max([min_cols] + lengths)
+
+    # columns shown: all, or the first and the last ones (the others are replaced by a column of '...')
+    if n_cols <= TABLE_MAX_COLUMNS:
+        rows = [table_cells(segments, 0, n_cols) for segments in rows]
+    else:
+        head = TABLE_MAX_COLUMNS // 2
+        tail = n_cols - (TABLE_MAX_COLUMNS - head)
+        rows = [table_cells(segments, 0, head) + ['...' if length > head else ''] + table_cells(segments, tail, n_cols)
+                for segments, length in zip(rows, lengths)]
 
     # calculate lengths
-    maxLens = []
+    maxLens = [0] * (len(rows[0]) if rows else 0)
     for row in rows:
-        for i in range(len(row)):
-            cellLength = len(str(row[i]))
-            try:
-                maxLens[i] = max(maxLens[i], cellLength)
-            except IndexError:
-                maxLens.append(cellLength)
+        for i, cellText in enumerate(row):
+            maxLens[i] = max(maxLens[i], len(cellText))
 
-    strHor = "+"
-    for maxLen in maxLens:
-        # example of cell in table: " abc |" -> count 2 spaces and | paired with +
-        strHor += '-' * (maxLen + 2) + '+'
+    # pages of columns: as many as fit in a line (at least one more than the first column)
+    if width is None:
+        width = get_terminal_size(fallback=(0, 0)).columns
+    pages = [list(range(len(maxLens)))]
+    if width > 0:
+        pages = []
+        page, pageWidth = [], 1
+        for i, maxLen in enumerate(maxLens):
+            # example of cell in table: " abc |" -> count 2 spaces and |
+            if (len(page) > 1) and (pageWidth + maxLen + 3 > width):
+                pages.append(page)
+                page, pageWidth = [0], maxLens[0] + 4
+            page.append(i)
+            pageWidth += maxLen + 3
+        pages.append(page)
 
-    print(strHor)
-    for row in rows:
-        print(end='|')  # start row
-        for i in range(len(maxLens)):
+    # the whole table in one write
+    lines = []
+    for page in pages:
+        strHor = '+' + ''.join('-' * (maxLens[i] + 2) + '+' for i in page)
+        lines.append(strHor)
+        for row in rows:
+            line = '|'
+            for i in page:
+                # calculate spaces before and after to allign text to center
+                spacesBefore = (maxLens[i] - len(row[i])) // 2
+                spacesAfter = maxLens[i] - len(row[i]) - spacesBefore
+                line += ' ' + (' ' * spacesBefore) + row[i] + (' ' * spacesAfter) + ' |'
+            lines.append(line)
+        lines.append(strHor)
+    if n_cols > TABLE_MAX_COLUMNS:
+        lines.append(f"({n_cols} columns: columns from {head + 1} to {tail} not shown)")
+    print('\n'.join(lines))
+
+"""cells of a row as segments of columns: strings and scalars are one column, other iterables one column for each element"""
+def table_segments(row):
+    segments = []
+    for cell in row:
+        if type(cell) is str:
+            segments.append([cell])
+            continue
+        try:
+            len(cell)
+            cell[0:0]  # sequence that can be sliced: only the columns shown will be read
+            segments.append(cell)
+        except (TypeError, KeyError):
             try:
-                cellText = str(row[i])
-                cellLength = len(cellText)
-            except IndexError:
-                # in case this row doesn't have all the cells -> suppose last cells blank
-                cellLength = 0
-                cellText = ''
-            # calculate spaces before and after to allign text to center
-            spacesBefore = (maxLens[i] - cellLength) // 2
-            spacesAfter = maxLens[i] - cellLength - spacesBefore
-            # print cell
-            print(' ', (' ' * spacesBefore), cellText, (' ' * spacesAfter), sep='', end=' |')
-        # end row
-        print()
-    print(strHor)
+                segments.append(list(cell))
+            except TypeError:
+                segments.append([cell])
+    return segments
+
+"""text of the columns from start to stop of a row (blank if the row is shorter)"""
+def table_cells(segments, start, stop):
+    cells = []
+    offset = 0
+    for segment in segments:
+        length = len(segment)
+        if (offset + length > start) and (offset < stop):
+            cells.extend(table_text(cell) for cell in segment[max(0, start - offset):stop - offset])
+        offset += length
+        if offset >= stop:
+            break
+    return cells + [''] * (stop - start - len(cells))
+
+"""text of a cell, at most TABLE_MAX_CELL characters"""
+def table_text(cell):
+    text = str(cell)
+    if len(text) <= TABLE_MAX_CELL:
+        return text
+    head = (TABLE_MAX_CELL - 3) // 2
+    return text[:head] + '...' + text[len(text) - (TABLE_MAX_CELL - 3 - head):]
+
+"""row of the summary view: first cell, number of the other cells, first and last of them"""
+def summary_row(segments):
+    n_cells = sum(len(segment) for segment in segments) - 1
+    if n_cells < 0:
+        return []
+    if n_cells <= 2 * TABLE_PREVIEW:
+        preview = ' '.join(table_cells(segments, 1, n_cells + 1))
+    else:
+        preview = (' '.join(table_cells(segments, 1, TABLE_PREVIEW + 1)) + ' ... ' +
+                   ' '.join(table_cells(segments, n_cells + 1 - TABLE_PREVIEW, n_cells + 1)))
+    return [table_cells(segments, 0, 1)[0], f"{n_cells} cells", preview]
 
 """print list elements as numbered options in a menu"""
 def print_menu_options(structure):